@@ -0,0 +1,451 @@
+#!/usr/bin/python3
+
+# Benchmarks for Munic.
+# Usage: benchmark.py <benchmark> [args]
+#   scan [media dir]    Time library scans, with 1 and SCAN_THREADS threads. Uses a generated tree if no dir is given.
+#   playlist            Time generating the song list for the root and for one artist of a 100k-song library.
+#   render              Time, time to first chunk and peak memory of rendering menu pages of a 100k-song library.
+#   memory [tracks]     Memory (measured with tracemalloc) per track of the library index and of the library built
+#                       from it, for a generated library with realistic path lengths (default 100k tracks).
+#   search [tracks]     Time searches of a generated library (default 400k tracks), and building the library's
+#                       indexes, against searching the names one by one.
+#   throughput [clients] Stream a large file to concurrent local clients with send_file, with sendfile and with the
+#                       buffered copy used for HTTPS, reporting MB/s and server CPU time per stream.
+#   ttfb                Time to the first byte, and to the end, of transcoding a generated test tone (needs ffmpeg).
+#   concurrency [connections] Compare servers (a thread per connection, munic's thread pool, and async) with many
+#                       simultaneous keep-alive connections, each fetching a menu page and a file: request latency,
+#                       server memory (RSS) and threads while the connections are open, and connections refused (503)
+#                       or closed while idle.
+
+import sys
+import os
+import tempfile
+import time
+import logging
+import tracemalloc
+import threading
+import multiprocessing
+import http.client
+import shutil
+import math
+import array
+import wave
+import statistics
+import collections
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+import munic
+
+""" Generate a synthetic media library under 'root': artists/albums/songs, each album with a cover.
+The files are empty: it is the directory structure which matters for scanning.
+Returns the number of files created. """
+def generate_tree(root, num_artists = 200, albums_per_artist = 5, songs_per_album = 12):
+    num_files = 0
+    for artist in range(num_artists):
+        for album in range(albums_per_artist):
+            album_dir = os.path.join(root, "Artist {}".format(artist), "Album {}".format(album))
+            os.makedirs(album_dir)
+            for song in range(songs_per_album):
+                open(os.path.join(album_dir, "{:02d} Song {}.mp3".format(song, song)), "wb").close()
+                num_files += 1
+            with open(os.path.join(album_dir, "folder.jpg"), "wb") as f:
+                f.write(b"x" * (1000 + album))
+            num_files += 1
+    return num_files
+
+""" Generate a synthetic library index (without touching the disk) of artists/albums/songs, each album with a cover.
+The names are "Artist 1", "Album 1", "01 Song 1.mp3" and so on, with the 'title' (if any) after each.
+Returns the LibraryIndex and the media dirs. """
+def generate_index(num_artists = 500, albums_per_artist = 10, songs_per_album = 20, media_dir = "/synthetic", title = ""):
+    index = munic.LibraryIndex(os.devnull)
+    index.dirs[media_dir] = { "mtime":0, "dirs":[], "music":[], "graphics":[], "unknown":[] }
+    for artist in range(num_artists):
+        artist_name = "Artist {}{}".format(artist, title)
+        artist_dir = os.path.join(media_dir, artist_name)
+        index.dirs[media_dir]["dirs"].append(artist_name)
+        index.dirs[artist_dir] = { "mtime":0, "dirs":[], "music":[], "graphics":[], "unknown":[] }
+        for album in range(albums_per_artist):
+            album_name = "Album {}{}".format(album, title)
+            index.dirs[artist_dir]["dirs"].append(album_name)
+            songs = [ "{:02d} Song {}{}.mp3".format(song, song, title) for song in range(songs_per_album) ]
+            index.dirs[os.path.join(artist_dir, album_name)] = { "mtime":0, "dirs":[], "music":songs, "graphics":[("folder.jpg", 1000)], "unknown":[] }
+    return index, [media_dir]
+
+""" Count the files in a directory tree """
+def count_files(root):
+    return sum(len(files) for path, dirs, files in os.walk(root, followlinks=True))
+
+""" Time a full scan (from an empty index) of the given media dirs with each number of threads """
+def benchmark_scan(media_dirs, num_files, thread_counts):
+    for num_threads in thread_counts:
+        munic.SCAN_THREADS = num_threads
+        index = munic.LibraryIndex(os.devnull)
+        start_time = time.perf_counter()
+        index.scan(media_dirs)
+        duration = time.perf_counter() - start_time
+        print("Full scan, {} threads: {} dirs, {} files in {:.3f}s = {:.0f} files/s"
+            .format(num_threads, len(index.dirs), num_files, duration, num_files / duration))
+
+        # A rescan with nothing changed only needs to stat each directory
+        start_time = time.perf_counter()
+        index.scan(media_dirs)
+        duration = time.perf_counter() - start_time
+        print("Rescan (unchanged), {} threads: {:.3f}s = {:.0f} files/s"
+            .format(num_threads, duration, num_files / duration))
+
+def scan(args):
+    thread_counts = sorted({1, munic.SCAN_THREADS})
+    if args:
+        num_files = sum(count_files(media_dir) for media_dir in args)
+        benchmark_scan(args, num_files, thread_counts)
+    else:
+        with tempfile.TemporaryDirectory() as root:
+            num_files = generate_tree(root)
+            benchmark_scan([root], num_files, thread_counts)
+
+def playlist(args):
+    index, media_dirs = generate_index()
+    library = index.build_library(media_dirs)
+    repeats = 5
+
+    start_time = time.perf_counter()
+    for i in range(repeats):
+        songs = munic.get_all_songs(library)
+    duration = (time.perf_counter() - start_time) / repeats
+    print("Root playlist: {} songs in {:.4f}s".format(len(songs), duration))
+
+    start_time = time.perf_counter()
+    for i in range(repeats):
+        songs = munic.get_all_songs(library, ("artist1",))
+    duration = (time.perf_counter() - start_time) / repeats
+    print("Artist playlist: {} songs in {:.4f}s".format(len(songs), duration))
+
+def render(args):
+    index, media_dirs = generate_index()
+    library = index.build_library(media_dirs)
+    munic.playlist_template = munic.load_template("playlist.html")
+    munic.static_files = munic.load_static_files()
+    repeats = 5
+
+    # The full pages (as the earlier figures were), and the root playlist as it is sent by default, lazily loaded
+    lazy_threshold = munic.LAZY_PLAYLIST_THRESHOLD
+    for description, parts, include_songs, threshold in (("Root playlist (/*)", [], True, 0),
+                                                         ("Root playlist, lazy (/*)", [], True, lazy_threshold),
+                                                         ("Root menu (/)", [], False, 0),
+                                                         ("Artist playlist (/artist1/*)", ["artist1"], True, 0)):
+        munic.LAZY_PLAYLIST_THRESHOLD = threshold
+        start_time = time.perf_counter()
+        for i in range(repeats):
+            page = b"".join(munic.render_menu(library, parts, include_songs))
+        duration = (time.perf_counter() - start_time) / repeats
+
+        # Time to the first chunk, which is when a streamed page can start to be sent
+        start_time = time.perf_counter()
+        next(munic.render_menu(library, parts, include_songs))
+        first_chunk_duration = time.perf_counter() - start_time
+
+        # Peak memory when streaming the page (one chunk at a time)
+        tracemalloc.start()
+        for chunk in munic.render_menu(library, parts, include_songs):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        print("{}: {} bytes in {:.4f}s, first chunk in {:.4f}s, peak memory streaming {:.1f}MB"
+            .format(description, len(page), duration, first_chunk_duration, peak / 1000000))
+
+def memory(args):
+    num_tracks = int(args[0]) if args else 100000
+    num_artists = max(num_tracks // 120, 1)
+
+    # Paths about as long as in a real collection, e.g. "/media/NAS_MEDIA/music/Queen/A Day At The Races/01 Tie Your Mother Down.mp3"
+    tracemalloc.start()
+    index, media_dirs = generate_index(num_artists, 10, 12, "/media/NAS_MEDIA/music", " With A Longer Title")
+    index_bytes = tracemalloc.get_traced_memory()[0]
+    num_tracks = num_artists * 10 * 12
+
+    tracemalloc.reset_peak()
+    start_time = time.perf_counter()
+    library = index.build_library(media_dirs)
+    duration = time.perf_counter() - start_time
+    total_bytes, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    library_bytes = total_bytes - index_bytes
+    # (The library was kept referenced until here, so that its memory was counted)
+    del library
+
+    print("{} tracks: index {:.1f}MB ({:.0f} bytes per track), library {:.1f}MB ({:.0f} bytes per track), "
+          "built in {:.2f}s with a peak of {:.1f}MB"
+        .format(num_tracks, index_bytes / 1000000, index_bytes / num_tracks, library_bytes / 1000000,
+                library_bytes / num_tracks, duration, peak_bytes / 1000000))
+
+def search(args):
+    num_tracks = int(args[0]) if args else 400000
+    index, media_dirs = generate_index(max(num_tracks // 120, 1), 10, 12, "/media/NAS_MEDIA/music", " With A Longer Title")
+    library = index.build_library(media_dirs)
+    num_tracks = len(library.songs)
+
+    start_time = time.perf_counter()
+    munic.index_library(library)
+    print("{} tracks: library indexed (including for search) in {:.2f}s".format(num_tracks, time.perf_counter() - start_time))
+
+    # Every name, to search one by one
+    all_names = [ name for name_index in (library.search.artists, library.search.albums, library.search.songs)
+                  for name in name_index.sorted_names ]
+    repeats = 5
+    for query in ("Artist 1234 With A Longer Title", "artist 12", "05 Song 5", "longer title", "ar", "no such name"):
+        start_time = time.perf_counter()
+        for i in range(repeats):
+            artists, albums, songs = library.search.search(query, munic.SEARCH_RESULTS)
+        duration = (time.perf_counter() - start_time) / repeats
+
+        simplified = munic.simplify(query)
+        start_time = time.perf_counter()
+        matches = [ name for name in all_names if simplified in name ]
+        linear_duration = time.perf_counter() - start_time
+
+        print("{!r}: {} artists, {} albums, {} songs in {:.2f}ms ({} matches in {:.1f}ms searching names one by one)"
+            .format(query, len(artists), len(albums), len(songs), duration * 1000, len(matches), linear_duration * 1000))
+
+class FileHandler(munic.Handler):
+    """ Serves the file named by the request path with send_file, and nothing else """
+    def do_GET(self):
+        self.send_file(self.path)
+
+    def log_message(self, format, *args):
+        pass
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class QuietHandler(munic.Handler):
+    """ The real request handler, without the request logging """
+    def log_message(self, format, *args):
+        pass
+
+""" Write a WAV file of a sine-wave test tone """
+def generate_tone(filepath, seconds = 120, frequency = 440, rate = 44100):
+    # One second of samples (a whole number of cycles), repeated
+    second = array.array("h", (int(10000 * math.sin(2 * math.pi * frequency * i / rate)) for i in range(rate)))
+    with wave.open(filepath, "wb") as tone:
+        tone.setnchannels(1)
+        tone.setsampwidth(2)
+        tone.setframerate(rate)
+        for i in range(seconds):
+            tone.writeframes(second.tobytes())
+
+""" Fetch the file at 'path' from the server 'repeats' times, returning the number of bytes received """
+def fetch(port, path, repeats):
+    connection = http.client.HTTPConnection("127.0.0.1", port)
+    received = 0
+    for i in range(repeats):
+        connection.request("GET", path)
+        response = connection.getresponse()
+        while True:
+            data = response.read(1024 * 1024)
+            if not data:
+                break
+            received += len(data)
+    connection.close()
+    return received
+
+def throughput(args):
+    num_clients = int(args[0]) if args else 4
+    repeats = 4
+    file_size = 64 * 1024 * 1024
+
+    server = ThreadingServer(("127.0.0.1", 0), FileHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(file_size))
+        f.flush()
+
+        # The clients run in separate processes, so the CPU time of this process is (almost all) the server's
+        with multiprocessing.Pool(num_clients) as pool:
+            for description, use_https in (("sendfile", False), ("buffered copy", True)):
+                # The buffered copy is what is used with HTTPS; here it is measured without the cost of the encryption
+                munic.USE_HTTPS = use_https
+                start_time = time.perf_counter()
+                start_cpu = time.process_time()
+                received = sum(pool.starmap(fetch, [(port, f.name, repeats)] * num_clients))
+                duration = time.perf_counter() - start_time
+                cpu = time.process_time() - start_cpu
+                streams = num_clients * repeats
+                print("{}: {} clients, {:.0f}MB in {:.2f}s = {:.0f}MB/s, server CPU {:.1f}ms per {}MB stream"
+                    .format(description, num_clients, received / 1000000, duration, received / 1000000 / duration,
+                            cpu * 1000 / streams, file_size // (1024 * 1024)))
+
+    server.shutdown()
+
+def ttfb(args):
+    if not shutil.which("ffmpeg"):
+        print("ffmpeg is needed for this benchmark")
+        return
+    repeats = 3
+
+    with tempfile.TemporaryDirectory() as root:
+        media_dir = os.path.join(root, "media")
+        os.makedirs(media_dir)
+        generate_tone(os.path.join(media_dir, "tone.wav"))
+
+        munic.library_index = munic.LibraryIndex(os.devnull)
+        munic.library = munic.load_library([media_dir])
+        # With no room in the transcode cache, every request is transcoded
+        munic.transcode_cache = munic.TranscodeCache(os.path.join(root, "transcodes"), 0)
+        munic.transcode_cache.load()
+        munic.transcode_scheduler = munic.TranscodeScheduler(1)
+        munic.transcode_scheduler.start()
+
+        server = ThreadingServer(("127.0.0.1", 0), QuietHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        for extension in (".ogg", ".mp3"):
+            first_byte_durations = []
+            durations = []
+            for i in range(repeats):
+                connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1])
+                start_time = time.perf_counter()
+                connection.request("GET", "/tone" + extension)
+                response = connection.getresponse()
+                received = len(response.read(1))
+                first_byte_durations.append(time.perf_counter() - start_time)
+                received += len(response.read())
+                durations.append(time.perf_counter() - start_time)
+                connection.close()
+            print("Transcode to {}: {} bytes, first byte in {:.3f}s, complete in {:.3f}s (best of {})"
+                .format(extension, received, min(first_byte_durations), min(durations), repeats))
+
+        server.shutdown()
+
+class ConcurrencyHandler(QuietHandler):
+    """ The real request handler, which also serves the file at ConcurrencyHandler.filepath as /file """
+    filepath = None
+
+    def do_GET(self):
+        if self.path == "/file":
+            self.send_file(ConcurrencyHandler.filepath)
+        else:
+            super().do_GET()
+
+""" Run a server ("threads", "pool" or "async") for the concurrency benchmark, in its own process, sending its port to
+'pipe' """
+def serve(server_type, filepath, pipe):
+    munic.script_path = os.path.dirname(os.path.realpath(__file__))
+    index, media_dirs = generate_index(100, 5, 10)
+    munic.library = index.build_library(media_dirs)
+    munic.playlist_template = munic.load_template("playlist.html")
+    munic.static_files = munic.load_static_files()
+    munic.page_cache = munic.PageCache(munic.PAGE_CACHE_MAX_BYTES)
+    ConcurrencyHandler.filepath = filepath
+    # The clients all connect from the same address
+    munic.MAX_CONNECTIONS_PER_CLIENT = 0
+    if server_type == "async":
+        server = munic.AsyncServer(("127.0.0.1", 0), ConcurrencyHandler)
+    elif server_type == "pool":
+        server = munic.ThreadingSimpleServer(("127.0.0.1", 0), ConcurrencyHandler)
+    else:
+        server = ThreadingServer(("127.0.0.1", 0), ConcurrencyHandler)
+    pipe.send(server.server_address[1])
+    server.serve_forever()
+
+""" Get the resident memory (in bytes) and the number of threads of a process """
+def process_usage(pid):
+    usage = {}
+    with open("/proc/{}/status".format(pid)) as status:
+        for line in status:
+            name, _, value = line.partition(":")
+            usage[name] = value.split()
+    return int(usage["VmRSS"][0]) * 1024, int(usage["Threads"][0])
+
+""" Fetch 'path' on 'connection' as a browser would: reconnecting if the server has closed the (idle) connection, and
+after waiting if it responds 503 (with Retry-After).  Counts each in 'retries'. """
+def fetch_retrying(connection, path, retries):
+    while True:
+        try:
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+        except (http.client.RemoteDisconnected, ConnectionError):
+            connection.close()
+            retries["closed"] += 1
+            continue
+        if response.status != 503:
+            return
+        retries["503"] += 1
+        time.sleep(int(response.getheader("Retry-After", "1")))
+
+""" A client for the concurrency benchmark: on one connection, fetch each path in turn, wait at the barrier (with the
+connection open and idle), then fetch the first path again.  The times taken are added to 'latencies' (by path, and
+"after idling" for the last). """
+def concurrency_client(port, paths, latencies, retries, barrier):
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    for path in paths:
+        start_time = time.perf_counter()
+        fetch_retrying(connection, path, retries)
+        latencies.setdefault(path, []).append(time.perf_counter() - start_time)
+    barrier.wait()
+    barrier.wait()
+    start_time = time.perf_counter()
+    fetch_retrying(connection, paths[0], retries)
+    latencies.setdefault("after idling", []).append(time.perf_counter() - start_time)
+    connection.close()
+
+def concurrency(args):
+    num_connections = int(args[0]) if args else 200
+    paths = ["/", "/artist1/*", "/file"]
+
+    with tempfile.NamedTemporaryFile() as f:
+        f.write(os.urandom(1024 * 1024))
+        f.flush()
+
+        # The servers are started afresh (not forked from this process, which has the clients' memory and threads)
+        context = multiprocessing.get_context("spawn")
+        for description, server_type in (("thread per connection", "threads"), ("thread pool", "pool"), ("async", "async")):
+            parent_pipe, child_pipe = context.Pipe()
+            process = context.Process(target=serve, args=(server_type, f.name, child_pipe), daemon=True)
+            process.start()
+            port = parent_pipe.recv()
+            idle_rss, idle_threads = process_usage(process.pid)
+
+            latencies = {}
+            retries = collections.Counter()
+            barrier = threading.Barrier(num_connections + 1)
+            clients = [ threading.Thread(target=concurrency_client, args=(port, paths, latencies, retries, barrier))
+                        for i in range(num_connections) ]
+            start_time = time.perf_counter()
+            for client in clients:
+                client.start()
+
+            # Measure the server while every connection is open (and idle)
+            barrier.wait()
+            duration = time.perf_counter() - start_time
+            rss, threads = process_usage(process.pid)
+            barrier.wait()
+            for client in clients:
+                client.join()
+            process.terminate()
+            process.join()
+
+            print("{} server, {} connections: RSS {:.1f}MB with no connections, {:.1f}MB and {} threads with them all open; "
+                  "all requests made in {:.2f}s; {} responses 503, {} idle connections closed"
+                .format(description, num_connections, idle_rss / 1000000, rss / 1000000, threads, duration,
+                        retries["503"], retries["closed"]))
+            for name in paths + ["after idling"]:
+                times = sorted(latencies[name])
+                print("  {}: median {:.1f}ms, 95th percentile {:.1f}ms, max {:.1f}ms"
+                    .format(name, statistics.median(times) * 1000, times[int(len(times) * 0.95) - 1] * 1000, times[-1] * 1000))
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.WARNING)
+    munic.script_path = os.path.dirname(os.path.realpath(__file__))
+
+    benchmarks = { "scan":scan, "playlist":playlist, "render":render, "memory":memory, "search":search, "throughput":throughput, "ttfb":ttfb,
+                   "concurrency":concurrency }
+    if len(sys.argv) < 2 or sys.argv[1] not in benchmarks:
+        print("Specify a benchmark: {}".format(", ".join(benchmarks.keys())))
+        exit(-1)
+
+    benchmarks[sys.argv[1]](sys.argv[2:])
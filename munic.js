@@ -79,17 +79,21 @@ class AudioPlaylist{
         var source_template = '<source src="__FILE__" type="audio/__MIMETYPE__">';
         var sources = "";
 
+        // A transcode profile given in the page's URL (e.g. "?profile=mobile") is passed on to the transcodes
+        var profile = new URLSearchParams(window.location.search).get("profile");
+        var query = profile ? "?profile=" + encodeURIComponent(profile) : "";
+
         // Put the original format first, except if it is FLAC or WAV (because the bandwidth use is too high)
         if(original_format != "flac" && original_format != "wav") {
             sources = sources + source_template.replace("__FILE__", original_url).replace("__MIMETYPE__", this.mimeType(original_format));
         }
         // Offer ogg transcode (if the original was not ogg)
         if(original_format != "ogg") {
-            sources = sources + source_template.replace("__FILE__", stem + ".ogg").replace("__MIMETYPE__", "ogg");
+            sources = sources + source_template.replace("__FILE__", stem + ".ogg" + query).replace("__MIMETYPE__", "ogg");
         }
         // Offer mp3 transcode (if the original was not mp3)
         if(original_format != "mp3") {
-            sources = sources + source_template.replace("__FILE__", stem + ".mp3").replace("__MIMETYPE__", "mpeg");
+            sources = sources + source_template.replace("__FILE__", stem + ".mp3" + query).replace("__MIMETYPE__", "mpeg");
         }
 
         return sources;
@@ -136,6 +140,9 @@ class AudioPlaylist{
         // Update the record of the currently-playing track
         this.trackPos = arrayPos; // update based on array index position
 
+        // If we are getting near the end of what is loaded of a large playlist, load more
+        this.loadMoreIfNeeded();
+
         // Invalidate the pre-loaded track
         this.sparePlayerTrackPos = NaN;
 
@@ -143,6 +150,109 @@ class AudioPlaylist{
         this.activePlayer.focus()
     }
 
+    /** Set up a track list item: record its position in the playlist and handle clicks on it */
+    attachItem(li, index) {
+        var classObj = this;
+        li.setAttribute("index", index);
+
+        // Handle the track link click
+        var link = li.getElementsByTagName("a")[0];
+        link.addEventListener("click", function(e) {
+            e.preventDefault();
+
+            // set track based on index of the list item in the randomised order
+            var listitem = getParentByTag(e.target, "li");
+            var tracknum = parseInt(listitem.getAttribute("index"));
+            var order = classObj.trackOrder.indexOf(tracknum);
+            classObj.setTrack(order);
+            classObj.activePlayer.play();
+        });
+    }
+
+    /** Add songs (as returned by the list API) to the end of the playlist */
+    appendItems(songs) {
+        for(var i=0 ; i<songs.length ; ++i) {
+            var song = songs[i];
+
+            // Build the same structure as the list items in the page
+            var li = document.createElement("li");
+            var link = document.createElement("a");
+            link.href = song.file;
+            link.className = "songlink";
+            var imageDiv = document.createElement("div");
+            var image = document.createElement("img");
+            image.src = song.art;
+            image.loading = "lazy";
+            imageDiv.appendChild(image);
+            var textDiv = document.createElement("div");
+            var name = document.createElement("p");
+            name.textContent = song.name;
+            var album = document.createElement("p");
+            album.textContent = song.album;
+            textDiv.appendChild(name);
+            textDiv.appendChild(album);
+            link.appendChild(imageDiv);
+            link.appendChild(textDiv);
+            li.appendChild(link);
+            this.playlist.appendChild(li);
+
+            var index = this.length;
+            this.attachItem(li, index);
+            this.length += 1;
+
+            // In shuffle mode, put the new track somewhere in the part of the order still to play
+            // (after the next track, which may already be preloaded)
+            if(this.shuffle) {
+                var first = Math.min(this.trackPos + 2, this.trackOrder.length);
+                var pos = first + Math.floor(Math.random() * (this.trackOrder.length - first + 1));
+                this.trackOrder.splice(pos, 0, index);
+            } else {
+                this.trackOrder.push(index);
+            }
+        }
+
+        // If nothing was preloaded because we were at the end of the playlist, there is now a next track to preload
+        if(this.sparePlayerTrackPos == -1)
+            this.sparePlayerTrackPos = NaN;
+    }
+
+    /** Load the next page of a large playlist */
+    loadMore() {
+        if(!this.more || this.loadingMore || this.moreOffset >= this.moreTotal)
+            return;
+        this.loadingMore = true;
+
+        var classObj = this;
+        fetch(this.more + "?offset=" + this.moreOffset)
+            .then(function(response) {
+                if(!response.ok)
+                    throw new Error("HTTP " + response.status);
+                return response.json();
+            })
+            .then(function(list) {
+                classObj.moreOffset = list.offset + list.dirs.length + list.songs.length;
+                classObj.moreTotal = list.total_dirs + list.total_songs;
+                classObj.appendItems(list.songs);
+                classObj.loadingMore = false;
+                // Keep going if that was not enough (e.g. the page is still not full)
+                classObj.loadMoreIfNeeded();
+            })
+            .catch(function(error) {
+                console.log("Failed to load more of the playlist: " + error);
+                classObj.loadingMore = false;
+            });
+    }
+
+    /** Load more of a large playlist if the end of it is nearly visible, or nearly reached by playing */
+    loadMoreIfNeeded() {
+        if(!this.more || this.moreOffset >= this.moreTotal)
+            return;
+        var nearBottom = this.content.scrollTop + 2 * this.content.clientHeight >= this.content.scrollHeight;
+        var nearEnd = this.trackPos >= this.length - 10;
+        if(nearBottom || nearEnd)
+            this.loadMore();
+    }
+
     preloadNextTrack() {
         // if track isn't the last track in array of tracks, preload the next track
         if(this.trackPos < this.length - 1) {
@@ -408,6 +518,14 @@ class AudioPlaylist{
         // Skip to the n'th match
         this.search_skip = 0;
 
+        // For a large playlist, only the first part is in the page: the rest is loaded (in pages) from "more" as needed.
+        // "offset" is the position in the listing from which to continue, and "total" the length of the listing.
+        var playlistDiv = document.getElementById("playlist");
+        this.more = playlistDiv.getAttribute("data-more");
+        this.moreOffset = parseInt(playlistDiv.getAttribute("data-offset"));
+        this.moreTotal = parseInt(playlistDiv.getAttribute("data-total"));
+        this.loadingMore = false;
+
         // Hide the audio player footer and the play controls if there are no tracks
         if(this.length == 0) {
             document.getElementsByClassName("footer")[0].style.display = "none";
@@ -429,22 +547,7 @@ class AudioPlaylist{
 
         var playlist_listitems = this.playlist.getElementsByTagName("li");
         for(var i=0 ; i<playlist_listitems.length ; ++i) {
-            // Set an 'index' attribute for each track li
-            var li = playlist_listitems[i];
-            li.setAttribute("index", i);
-
-            // Handle the track link click
-            var link = playlist_listitems[i].getElementsByTagName("a")[0];
-            link.addEventListener("click", function(e) {
-                e.preventDefault();
-
-                // set track based on index of the list item in the randomised order
-                var listitem = getParentByTag(e.target, "li");
-                var tracknum = parseInt(listitem.getAttribute("index"));
-                var order = classObj.trackOrder.indexOf(tracknum);
-                classObj.setTrack(order);
-                classObj.activePlayer.play();
-            });
+            this.attachItem(playlist_listitems[i], i);
         }
 
         // Handle end of track
@@ -507,8 +610,9 @@ class AudioPlaylist{
             classObj.prevTrack();
         });
 
-        // Resize parts when scrolling or resizing, plus once upon loading (now)
-        this.content.onscroll = function() {classObj.manageSizes();};
+        // Resize parts when scrolling or resizing, plus once upon loading (now).
+        // Scrolling may also need more of a large playlist to be loaded.
+        this.content.onscroll = function() {classObj.manageSizes(); classObj.loadMoreIfNeeded();};
         window.onresize = function() {classObj.manageSizes();};
         this.manageSizes();
 
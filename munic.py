@@ -3,8 +3,8 @@
 # Munic - simple web-based music server
 
 from http.server import HTTPServer, BaseHTTPRequestHandler
-from socketserver import ThreadingMixIn
 import threading
+import queue
 from urllib import parse as urllibparse
 import base64
 import sys
@@ -18,17 +18,201 @@ import re
 import random
 import subprocess
 import time
-import weakref
+import concurrent.futures
+import collections
+import itertools
+import bisect
+import array
+import heapq
+import json
+import hashlib
+import uuid
+import email.utils
+import pickle
+import signal
+import select
+import socket
+import struct
+import ctypes
+import ctypes.util
+import zlib
+import io
+import asyncio
+from errno import ENOSPC
+try:
+    import brotli
+except ImportError:
+    brotli = None
 #import code # For code.interact()
 
 # Whether to use HTTPS
 USE_HTTPS = False
 
-# Maximum number of simultaneous transcodes to allow (or 0 to not allow transcoding)
+# The threaded server (ThreadingSimpleServer) handles connections on a pool of SERVER_THREADS threads.  Up to
+# SERVER_QUEUE_SIZE more connections can wait for a thread; beyond that, or beyond MAX_CONNECTIONS_PER_CLIENT from one
+# address, new connections are sent 503 with a Retry-After of SERVER_BUSY_RETRY_AFTER seconds.  The per-address limit
+# is off (0) by default: behind a reverse proxy such as nginx, every connection comes from the proxy's address.  (It is
+# applied when a connection is accepted, before any X-Forwarded-For header can be read.)  A keep-alive connection is closed after KEEPALIVE_TIMEOUT seconds without a request,
+# or straight away if other connections are waiting for a thread.  SOCKET_TIMEOUT limits how long a client can stall
+# (sending a request, or not reading the response).
+SERVER_THREADS = 16
+SERVER_QUEUE_SIZE = 64
+MAX_CONNECTIONS_PER_CLIENT = 0
+SERVER_BUSY_RETRY_AFTER = 2
+KEEPALIVE_TIMEOUT = 15
+SOCKET_TIMEOUT = 60
+
+# Whether to serve with an asyncio event loop (AsyncServer), rather than the threaded server.
+# The loop holds the connections, waiting for requests and sending files and transcodes, and each request is handled
+# on one of ASYNC_WORKER_THREADS threads.  Idle keep-alive connections, slow downloads and requests waiting for a
+# transcode (to start, or to produce the bytes asked for) then cost no threads.
+# (Idle connections are still closed after KEEPALIVE_TIMEOUT seconds without a request.)
+ASYNC_SERVER = False
+ASYNC_WORKER_THREADS = 4
+
+# Maximum number of simultaneous transcodes to allow (or 0 to not allow transcoding).  Further transcodes are queued.
 MAX_SIMULTANEOUS_TRANSCODES = 1
 
-# Maximum number of completed transcodes to preserve
-MAX_COMPLETED_TRANSCODES = 20
+# Transcode profiles, by name.  Each gives, for each extension it can be requested as, the ffmpeg output format and
+# the arguments choosing the codec and bitrate or quality (none means ffmpeg's defaults); the number of threads for
+# ffmpeg (None means the CPUs to spare, leaving one for serving requests, shared between MAX_SIMULTANEOUS_TRANSCODES);
+# and how much to lower ffmpeg's priority ("nice"), so that transcoding does not starve the HTTP threads.
+# A profile is chosen with "?profile=<name>" on the media URL.  Otherwise a client asking to save data (with the
+# Save-Data header, or a slow connection type in the ECT header) gets TRANSCODE_SAVE_DATA_PROFILE, and others get
+# TRANSCODE_DEFAULT_PROFILE.
+TRANSCODE_PROFILES = {
+    "standard": { "formats":{ ".ogg":("ogg", ()),
+                              ".mp3":("mp3", ()),
+                              ".aac":("adts", ("-c:a", "aac", "-b:a", "160k")) },
+                  "threads":None, "nice":10 },
+    "mobile":   { "formats":{ ".ogg":("ogg", ("-c:a", "libopus", "-b:a", "96k")),
+                              ".mp3":("mp3", ("-b:a", "96k")),
+                              ".aac":("adts", ("-c:a", "aac", "-b:a", "96k")) },
+                  "threads":1, "nice":10 },
+    "high":     { "formats":{ ".ogg":("ogg", ("-c:a", "libvorbis", "-q:a", "8")),
+                              ".mp3":("mp3", ("-b:a", "320k")),
+                              ".aac":("adts", ("-c:a", "aac", "-b:a", "256k")) },
+                  "threads":None, "nice":10 },
+}
+TRANSCODE_DEFAULT_PROFILE = "standard"
+TRANSCODE_SAVE_DATA_PROFILE = "mobile"
+SAVE_DATA_CONNECTION_TYPES = ("slow-2g", "2g", "3g")
+# Browsers only send the ECT header once a page has asked for it, so pages are sent with these client hints in Accept-CH
+ACCEPT_CLIENT_HINTS = "ECT, Save-Data"
+
+# Time in seconds a client will wait for a queued transcode to start before giving up
+TRANSCODE_QUEUE_TIMEOUT = 30
+
+# Size of the in-memory buffer of the most recent output of each transcode, from which clients are sent it
+TRANSCODE_RING_BUFFER_SIZE = 1024 * 1024
+
+# Maximum sizes of the reads from ffmpeg, and of the chunks sent to clients, of transcode output
+TRANSCODE_READ_SIZE = 65536
+TRANSCODE_SEND_SIZE = 131072
+
+# Seeking in a transcode in progress.
+# A range is served from the output as it is produced if it starts less than this many seconds ahead of the output so
+# far (waiting up to TRANSCODE_SEEK_WAIT seconds for the bytes); a range further ahead starts a transcode from that
+# time.  Each range response is at most TRANSCODE_RANGE_SIZE bytes.  (A range starting in the output already produced
+# is sent at once, with what there is; "bytes=0-", which browsers send for every track, gets the output streamed.)
+TRANSCODE_SEEK_AHEAD_TIME = 10
+TRANSCODE_SEEK_WAIT = 5
+TRANSCODE_RANGE_SIZE = 1024 * 1024
+# Bytes of output per second of audio to assume until ffmpeg has reported some progress
+TRANSCODE_DEFAULT_BYTES_PER_SECOND = 16000
+
+# Time in seconds after the last client stops waiting for a transcode before it is cancelled.  (Not immediately,
+# because players often drop a connection and make a new one.)
+TRANSCODE_CANCEL_DELAY = 10
+
+# Predictive transcoding: when a track is transcoded, the next PREFETCH_TRACKS tracks in its directory are transcoded
+# too, at low priority, so that they are ready (in the transcode cache) when the player asks for them.  They are
+# cancelled if not requested within PREFETCH_WINDOW seconds, and whenever a track being played needs the worker.
+# They only start while the load average per CPU is below PREFETCH_MAX_LOAD (checked every PREFETCH_RETRY_INTERVAL
+# seconds while they wait).  PREFETCH_TRACKS = 0 turns this off.
+PREFETCH_TRACKS = 2
+PREFETCH_WINDOW = 600
+PREFETCH_MAX_LOAD = 0.8
+PREFETCH_RETRY_INTERVAL = 5
+
+# Directory to keep completed transcodes in, so that they need not be transcoded again (even after a restart).
+# None means "transcode_cache" in the script directory.
+TRANSCODE_CACHE_DIR = None
+
+# Maximum total size of the completed transcodes to keep, in bytes
+TRANSCODE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Thumbnails of album art for menu pages, made with ffmpeg (WebP for browsers which accept it, otherwise JPEG) and kept
+# on disk: links to directories show THUMBNAIL_LINK_SIZE pixel (at most, square) thumbnails, and songs
+# THUMBNAIL_SONG_SIZE.  (The header still shows the full image.)  They are made in the background, by
+# THUMBNAIL_MAX_SIMULTANEOUS threads, so that requests never wait for ffmpeg: until a thumbnail has been made, the full
+# image (or, for art embedded in a song, the default image) is sent instead, for the browser to check again next time.
+THUMBNAIL_LINK_SIZE = 384
+THUMBNAIL_SONG_SIZE = 96
+THUMBNAIL_MAX_SIMULTANEOUS = 2
+# Time in seconds to allow ffmpeg to make a thumbnail
+THUMBNAIL_TIMEOUT = 30
+# Directory to keep thumbnails in (None means "thumbnail_cache" in the script directory), and their maximum total size
+THUMBNAIL_CACHE_DIR = None
+THUMBNAIL_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Whether the songs in a directory without any images (at or below it) show the cover art embedded in its first song.
+# (If it has none, the default image is shown.)
+EMBEDDED_ART = True
+
+# Playlists with more songs than this are sent in pages: the first page in the menu page, and the rest loaded by the
+# browser as needed, using the JSON API.  (Or 0 to always send the whole playlist in the menu page.)
+LAZY_PLAYLIST_THRESHOLD = 1000
+
+# Number of songs in each page of a lazily-loaded playlist
+LAZY_PLAYLIST_PAGE_SIZE = 500
+
+# Maximum number of entries the JSON API returns at once
+API_LIST_MAX_LIMIT = 1000
+
+# Number of each of artists, albums and songs a search returns, unless the request asks for another number (up to
+# API_LIST_MAX_LIMIT)
+SEARCH_RESULTS = 50
+# Searches shorter than this (in simplified characters) only match the starts of names, as one or two letters would
+# match somewhere in almost everything
+SEARCH_MIN_SUBSTRING = 3
+
+# Compression of text responses (pages, JSON, scripts and stylesheets). Media is never compressed.
+# Levels for responses compressed as they are sent: moderate, to keep the CPU cost down on small machines.
+# Static files are compressed once, at startup, at the best level.
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+# Responses smaller than this are not worth compressing
+COMPRESSION_MIN_BYTES = 1024
+
+# Caching by the browser.  Files and pages are sent with ETags (and files with Last-Modified) so that the browser can
+# check cheaply whether its copy is current.
+# Media and album art: how long the browser may use its copy before checking
+FILE_CACHE_CONTROL = "max-age=1000"
+# Pages: always check, since they change when the library is rescanned
+PAGE_CACHE_CONTROL = "no-cache"
+# Static files requested by their versioned URL: the URL changes if the file does, so keep them forever
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Maximum number of separate ranges to send in one response: a request for more gets the whole file
+MAX_RANGES = 16
+
+# Size of the blocks in which files are copied to the client when they cannot be sent directly by the kernel (with HTTPS)
+SEND_FILE_BUFFER_SIZE = 256 * 1024
+
+# Maximum total size of rendered menu pages to keep in memory, in bytes
+PAGE_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# Interval in seconds at which to rescan the library in the background (or 0 to only rescan on request)
+LIBRARY_RESCAN_INTERVAL = 0
+
+# Number of threads with which to scan the media dirs. (Scanning network mounts benefits from more.)
+SCAN_THREADS = 8
+
+# Whether to watch the media dirs for changes (with inotify, on Linux) and keep the library live without rescans
+WATCH_MEDIA_DIRS = False
+
+# Interval in seconds at which to rescan instead, if watching is not possible (e.g. the watch limit is reached)
+WATCH_FALLBACK_RESCAN_INTERVAL = 600
 
 # The directories in which to look for media
 media_dirs = []
@@ -36,102 +220,1058 @@ media_dirs = []
 # Data structure containing the media library 
 library = None
 
+# Persistent index of the media dirs, from which the library is built
+library_index = None
+
+# The background library scanner
+library_scanner = None
+
+# The media dir watcher, if watching
+library_watcher = None
+
+# Source of numbers identifying each version of the library
+library_generations = itertools.count()
+
+# The parsed playlist page template
+playlist_template = None
+
 # Location of this sript
 script_path = None
 
+# Cache of rendered menu pages
+page_cache = None
+
+# Static text files (scripts and stylesheets), kept in memory with compressed copies
+static_files = {}
+
+# Identifies this run of the server, in the ETags of generated pages
+instance_id = "{:x}".format(time.time_ns())
+
+# Location of the JSON listing API
+API_LIST_PREFIX = "/api/list/"
+
+# Location of the JSON status API
+API_STATUS_PATH = "/api/status"
+
+# Location of the JSON search API
+API_SEARCH_PATH = "/search"
+
 # Ongoing media GETs - for debug
 media_gets = {}
 
-# The cache of transcoders: a dictionary of requestedFilepath:transcoderObject, using weak references
-transcoders_cache = weakref.WeakValueDictionary()
+# Completed transcodes, kept on disk
+transcode_cache = None
 
-# The running transcoders we want to keep alive (MAX_SIMULTANEOUS_TRANSCODES)
-running_transcoders_to_keep = []
+# Runs (and queues) transcode jobs
+transcode_scheduler = None
 
-# The completed transcode jobs we want to keep (MAX_COMPLETED_TRANSCODES)
-completed_transcoders_to_keep = []
+# Makes (and caches) thumbnails of album art
+thumbnailer = None
 
-class Transcoder:
-    # Index for the next transcode temp file
-    nextIndex = 0
+class TranscodeCache:
+    """ A persistent, size-limited cache of completed transcodes on disk.
+    Each transcode is stored in a file named by a hash of the source file's path, size and mtime and of the target
+    format and ffmpeg arguments, so a changed source file, or changed transcode settings, simply miss the cache.
+    The least-recently-used files are deleted to keep the total size within max_bytes.  The order of use is kept in
+    the files' atimes (which are set on each use) so that it survives restarts.  (Not their mtimes, which the ETags and
+    Last-Modified dates of the files sent depend on.)
+    (Thumbnails, which are made with ffmpeg too, are kept in another one.) """
+
+    # Bump this if the way transcodes are made changes in a way the key does not capture
+    VERSION = 1
+
+    """ Constructor """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Cached files (path:size), least-recently-used first
+        self.files = collections.OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    """ Find the existing cached transcodes, and delete any partial ones left over from a previous run """
+    def load(self):
+        os.makedirs(self.directory, exist_ok=True)
+        found = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_file():
+                continue
+            if ".partial" in entry.name:
+                logging.debug("Removing partial transcode {}".format(entry.path))
+                os.remove(entry.path)
+                continue
+            stat = entry.stat()
+            found.append((stat.st_atime, entry.path, stat.st_size))
+        with self.lock:
+            for atime, path, size in sorted(found):
+                self.files[path] = size
+                self.total_bytes += size
+        logging.info("Transcode cache: {} files, {} bytes in {}".format(len(self.files), self.total_bytes, self.directory))
+        self.evict()
+
+    """ Get the cache key for transcoding the given source file with the given ffmpeg output arguments to the given
+    format (extension), or None if the source file cannot be read """
+    def key(self, source_filepath, target_extension, output_args):
+        try:
+            stat = os.stat(source_filepath)
+        except OSError:
+            return None
+        description = "\0".join([ str(TranscodeCache.VERSION), source_filepath, str(stat.st_size), str(stat.st_mtime_ns),
+                                   target_extension ] + list(output_args))
+        return hashlib.sha1(description.encode("utf-8", "surrogateescape")).hexdigest()
+
+    """ The path of the cached transcode for the given key and extension """
+    def path(self, key, target_extension):
+        return os.path.join(self.directory, key + target_extension)
+
+    """ Is there a cached transcode for the key?  (This does not count as a use of it.) """
+    def contains(self, key, target_extension):
+        with self.lock:
+            return self.path(key, target_extension) in self.files
+
+    """ The path to write a transcode in progress to.  It only goes into the cache (by add()) once complete. """
+    def partial_path(self, key, target_extension):
+        return os.path.join(self.directory, "{}.{}.partial{}".format(key, uuid.uuid4().hex[:8], target_extension))
+
+    """ Returns the path of the cached transcode for the key, or None if there is none.  Marks it as recently used. """
+    def get(self, key, target_extension):
+        path = self.path(key, target_extension)
+        with self.lock:
+            if path not in self.files:
+                self.misses += 1
+                return None
+            self.files.move_to_end(path)
+            self.hits += 1
+        try:
+            os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+        except FileNotFoundError:
+            # Deleted behind our back
+            with self.lock:
+                size = self.files.pop(path, None)
+                if size is not None:
+                    self.total_bytes -= size
+            return None
+        return path
+
+    """ Move a completed transcode (at partial_path) into the cache.  Returns the path it is now at. """
+    def add(self, key, target_extension, partial_path):
+        path = self.path(key, target_extension)
+        os.replace(partial_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            old_size = self.files.pop(path, None)
+            if old_size is not None:
+                self.total_bytes -= old_size
+            self.files[path] = size
+            self.total_bytes += size
+        logging.info("Added transcode to cache: {} ({} bytes)".format(path, size))
+        self.evict()
+        return path
+
+    """ Delete the least-recently-used transcodes until the cache is within its size limit.
+    Files being sent are not affected: an open file remains readable after it is deleted. """
+    def evict(self):
+        while True:
+            with self.lock:
+                if self.total_bytes <= self.max_bytes or not self.files:
+                    return
+                path, size = self.files.popitem(last=False)
+                self.total_bytes -= size
+            logging.debug("Evicting transcode {} ({} bytes)".format(path, size))
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
 
-    # TODO use a proper temp directory
-    TRANSCODE_DIR = os.path.dirname(os.path.realpath(__file__))
+class Transcoder:
+    """ A transcode job: one run of ffmpeg, converting a source file to a target format, in a partial file which is
+    moved into the transcode cache when complete.  Jobs are queued, run and cancelled by the TranscodeScheduler.
+    Clients using the output acquire() the job and release() it when done; a job nobody is waiting for is cancelled. """
+
+    # The ffmpeg arguments for the output.
+    # The "-flush_packets 1" argument causes the output to be written to the file more quickly, rather than being buffered.
+    # This helps speed up and avoid glitches at the start of playback if running on slow hardware (e.g. raspberry pi zero).
+    # The "-vn" argument ensures we do not put video in the output, which can mean the entire file must be transcoded
+    # before anything is written to disk.
+    OUTPUT_ARGS = ("-vn", "-flush_packets", "1")
+
+    # States
+    QUEUED = "queued"
+    RUNNING = "running"
+    FINISHED = "finished"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
 
     """ Clean up leftover transcodes """
     def CleanUp():
+        # Transcodes used to be written to the script directory
         logging.info("Cleaning up old transcoded files")
-        for old_transcode in pathlib.Path(Transcoder.TRANSCODE_DIR).glob("TRANSCODE_*.*"):
+        for old_transcode in pathlib.Path(script_path).glob("TRANSCODE_*.*"):
             logging.debug("Removing old transcode output {}".format(old_transcode))
-            os.remove(os.path.join(Transcoder.TRANSCODE_DIR, str(old_transcode)))
+            os.remove(os.path.join(script_path, str(old_transcode)))
 
-    """ Constructor """
-    def __init__(self, requested_filepath, source_filepath, target_extension):
-        self.finished = False
-        self.requested_filepath = requested_filepath
+        # Find the cached transcodes and remove any partial ones
+        transcode_cache.load()
 
-        out_file = "TRANSCODE_{}{}".format(Transcoder.nextIndex, target_extension)
-        Transcoder.nextIndex += 1
+    """ Constructor.
+    A job with a seek_time transcodes from that time in the source, to serve a seek ahead of the full transcode.  Its
+    output stands for the full transcode's output from byte 'origin', and it is not kept in the transcode cache. """
+    def __init__(self, cache_key, requested_filepath, source_filepath, target_extension, profile, priority, seek_time = 0, origin = 0):
+        self.cache_key = cache_key
+        self.requested_filepath = requested_filepath
+        self.source_filepath = source_filepath
+        self.target_extension = target_extension
+        self.profile = profile
+        self.priority = priority
+        self.seek_time = seek_time
+        self.origin = origin
+        self.state = Transcoder.QUEUED
+        self.out_file = transcode_cache.partial_path(cache_key, target_extension)
+
+        # The clients waiting for (or reading) the output, and when the last one went away.
+        # The job is cancelled once nobody has wanted it for cancel_delay seconds.
+        self.waiters = 0
+        self.idle_since = time.monotonic()
+        self.cancel_delay = TRANSCODE_CANCEL_DELAY
+
+        # Whether this is a speculative transcode which no client has asked for yet
+        self.prefetch = False
+
+        # Progress reported by ffmpeg: the time in the output reached, and the output size at that point
+        self.out_time = 0.0
+        self.out_size = 0
+        self.progress_values = {}
+
+        # For monitoring
+        self.queued_time = time.monotonic()
+        self.started_time = None
+
+        # The most recent output, for clients keeping up with the transcode; and the file, for those which are not
+        self.ring_buffer = RingBuffer(TRANSCODE_RING_BUFFER_SIZE)
+        self.read_file = None
+
+        # Signalled when the state changes, or there is more output (see changed())
+        self.condition = threading.Condition()
+        # Functions to call then too, for the async server's senders.  (Called with the condition held.)
+        self.listeners = []
+
+    """ Register a client which wants the output """
+    def acquire(self):
+        with self.condition:
+            self.waiters += 1
+
+    """ Unregister a client.  If no clients are left, the job will be cancelled after TRANSCODE_CANCEL_DELAY. """
+    def release(self):
+        with self.condition:
+            self.waiters -= 1
+            if self.waiters == 0:
+                self.idle_since = time.monotonic()
+            self.close_read_file()
+
+    """ Has nobody wanted the output for long enough that the job should be cancelled? """
+    def abandoned(self):
+        with self.condition:
+            return self.waiters == 0 and time.monotonic() - self.idle_since > self.cancel_delay
+
+    """ The number of bytes of output produced so far """
+    def produced(self):
+        with self.condition:
+            return self.ring_buffer.end
+
+    """ Estimate the number of bytes of output per second of audio, from the progress so far """
+    def bytes_per_second(self):
+        with self.condition:
+            if self.out_time > 1 and self.out_size > 0:
+                return self.out_size / self.out_time
+        return TRANSCODE_DEFAULT_BYTES_PER_SECOND
+
+    """ Handle lines of progress output from ffmpeg (key=value, as produced by "-progress") """
+    def parse_progress(self, lines):
+        for line in lines:
+            key, _, value = line.strip().partition("=")
+            self.progress_values[key] = value
+            # Each block of progress values ends with "progress"
+            if key == "progress":
+                try:
+                    # (out_time_ms is in microseconds too)
+                    out_time = int(self.progress_values.get("out_time_us", self.progress_values.get("out_time_ms"))) / 1000000
+                    out_size = int(self.progress_values["total_size"])
+                except (KeyError, ValueError, TypeError):
+                    continue
+                with self.condition:
+                    self.out_time = out_time
+                    self.out_size = out_size
+
+    """ Run the transcode (called on a worker thread).  Returns when it has finished, failed or been cancelled.
+    ffmpeg writes to a pipe, which is read here and written both to the partial file and to the ring buffer, from which
+    clients are sent the output as soon as it is produced. """
+    def run(self):
+        with self.condition:
+            if self.state != Transcoder.QUEUED:
+                return
+            self.state = Transcoder.RUNNING
+            self.started_time = time.monotonic()
+            self.changed()
 
-        logging.info("Creating transcode session for {} -> {} (Temp file: {})".format(source_filepath, target_extension, out_file))
+        logging.info("Starting transcode {} -> {} ({}) (Temp file: {})".format(self.source_filepath, self.target_extension, self.profile, self.out_file))
+        profile = TRANSCODE_PROFILES[self.profile]
+        output_format = profile["formats"][self.target_extension][0]
 
-        self.out_file = os.path.join(Transcoder.TRANSCODE_DIR, out_file)
+        # Start the transcode
+        # The "-v quiet" supresses output -- nobody will read it anyway, and it can leave the console in a bad state if cancelled.
+        # Progress is reported on stderr instead, so that we know how many bytes of output there are per second.
+        # The output goes to a pipe, so the format must be given explicitly.
+        # A seek ("-ss") before the input is fast: ffmpeg skips straight to that point of the source.
+        seek_args = ["-ss", "{:.3f}".format(self.seek_time)] if self.seek_time else []
+        out = None
+        try:
+            out = open(self.out_file, "wb")
+            self.read_file = open(self.out_file, "rb")
+            process = subprocess.Popen(["ffmpeg", "-v", "quiet", "-nostats", "-progress", "pipe:2"] + seek_args
+                                       + ["-i", self.source_filepath] + transcode_args(self.profile, self.target_extension)
+                                       + ["-threads", str(transcode_threads(profile)), "-f", output_format, "pipe:1"],
+                                       stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as e:
+            logging.error("Failed to start transcode: {}".format(e))
+            if out is not None:
+                out.close()
+            self.remove_partial()
+            self.set_state(Transcoder.FAILED)
+            return
 
-        # Delete the file if it exists (probably left over from a previous session)
-        if os.path.exists(self.out_file):
+        # Lower ffmpeg's priority.  (This is done from here rather than in the child with preexec_fn, which is not safe
+        # in a program with threads.)
+        if profile["nice"]:
+            try:
+                os.setpriority(os.PRIO_PROCESS, process.pid, os.getpriority(os.PRIO_PROCESS, 0) + profile["nice"])
+            except OSError as e:
+                logging.warning("Failed to lower the priority of ffmpeg: {}".format(e))
+
+        # Copy the output to the file and the ring buffer as it arrives, stopping if nobody wants it any more
+        cancelled = False
+        with out:
+            pipe = process.stdout.fileno()
+            progress_pipe = process.stderr.fileno()
+            progress = b""
+            while True:
+                readable, _, _ = select.select([pipe, progress_pipe] if progress_pipe is not None else [pipe], [], [], 1)
+                if self.abandoned():
+                    cancelled = True
+                    break
+                if progress_pipe in readable:
+                    data = os.read(progress_pipe, 4096)
+                    if not data:
+                        progress_pipe = None
+                    progress += data
+                    lines = progress.split(b"\n")
+                    progress = lines.pop()
+                    self.parse_progress(line.decode("utf-8", "replace") for line in lines)
+                if pipe not in readable:
+                    continue
+                data = os.read(pipe, TRANSCODE_READ_SIZE)
+                if not data:
+                    break
+                # Write to the file first, so that everything in the ring buffer is also in the file
+                out.write(data)
+                out.flush()
+                with self.condition:
+                    self.ring_buffer.write(data)
+                    self.changed()
+
+        if cancelled:
+            logging.info("Cancelling abandoned transcode of {}".format(self.requested_filepath))
+            process.terminate()
+        returncode = process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+        # Keep a successful transcode in the cache.  The file can still be read (by clients reading from it through
+        # read_file) after it is moved.
+        if cancelled:
+            self.remove_partial()
+            self.set_state(Transcoder.CANCELLED)
+        elif returncode == 0 and self.seek_time:
+            # The output of a seek is only for the clients reading it now
+            self.remove_partial()
+            self.set_state(Transcoder.FINISHED)
+        elif returncode == 0:
+            out_file = transcode_cache.add(self.cache_key, self.target_extension, self.out_file)
+            with self.condition:
+                self.out_file = out_file
+            self.set_state(Transcoder.FINISHED)
+        else:
+            logging.warning("Transcode of {} failed with return code {}".format(self.requested_filepath, returncode))
+            self.remove_partial()
+            self.set_state(Transcoder.FAILED)
+
+    """ Wake everyone waiting for the state to change or for more output.  (Call with the condition held.) """
+    def changed(self):
+        self.condition.notify_all()
+        for listener in self.listeners:
+            listener()
+
+    def add_listener(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            self.listeners.remove(listener)
+
+    """ Cancel the job if it has not started """
+    def cancel(self):
+        with self.condition:
+            if self.state != Transcoder.QUEUED:
+                return False
+            self.state = Transcoder.CANCELLED
+            self.changed()
+        return True
+
+    def set_state(self, state):
+        with self.condition:
+            self.state = state
+            self.changed()
+            self.close_read_file()
+
+    """ Close read_file once the transcode has ended and no client is left to read it.  (Call with the condition
+    held.) """
+    def close_read_file(self):
+        if self.read_file is not None and self.waiters == 0 and self.transcode_finished():
+            self.read_file.close()
+            self.read_file = None
+
+    def remove_partial(self):
+        try:
             os.remove(self.out_file)
+        except FileNotFoundError:
+            pass
 
-        # Start the transcode
-        # The "-flush_packets 1" argument causes the output to be written to the file more quickly, rather than being buffered.
-        # This helps speed up and avoid glitches at the start of playback if running on slow hardware (e.g. raspberry pi zero).
-        # The "-vn" argument ensures we do not put video in the output, which can mean the entire file must be transcoded
-        # before anything is written to disk.
-        # The "-v quiet" supresses output -- nobody will read it anyway, and it can leave the console in a bad state if cancelled.
-        self.transcode_process = subprocess.Popen(["ffmpeg", "-v", "quiet", "-i", source_filepath, "-vn", "-flush_packets", "1", self.out_file],
-                                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    """ Has the transcoding completed (successfully or not)? """
+    def transcode_finished(self):
+        return self.state in (Transcoder.FINISHED, Transcoder.FAILED, Transcoder.CANCELLED)
+
+    """ Has the job left the queue (started, or been cancelled)? """
+    def started(self):
+        return self.state != Transcoder.QUEUED
+
+    """ Has the output reached the given position (or the transcode ended)?  (Call with the condition held.) """
+    def reached(self, position):
+        return self.ring_buffer.end >= position or self.transcode_finished()
+
+    """ Wait up to 'timeout' seconds until ready() (called with the condition held) is true.  Returns whether it is. """
+    def wait_until(self, ready, timeout):
+        with self.condition:
+            return self.condition.wait_for(ready, timeout=timeout)
+
+    """ Read up to max_length bytes of the output from the given position, waiting up to 'timeout' seconds for them
+    to be produced.  Returns the data; b"" at the end of a complete transcode; or None if there was nothing to read
+    in time, or the transcode failed or was cancelled (in which case the state says so). """
+    def read(self, position, max_length, timeout):
+        with self.condition:
+            self.condition.wait_for(lambda: self.ring_buffer.end > position or self.transcode_finished(), timeout=timeout)
+            available = self.ring_buffer.end - position
+            if available <= 0:
+                return b"" if self.state == Transcoder.FINISHED else None
+            # Recent output is in memory.  A reader which has fallen further behind reads it from the file.
+            data = self.ring_buffer.read(position, max_length)
+            # (The file stays open while this client holds the job: see close_read_file())
+            read_file = self.read_file
+        if data is None:
+            data = os.pread(read_file.fileno(), min(max_length, available), position)
+        return data
+
+""" Get the ffmpeg output arguments for transcoding to the given extension with the given profile.  (These, with the
+extension, are what the transcode cache key depends on.) """
+def transcode_args(profile, target_extension):
+    return list(Transcoder.OUTPUT_ARGS) + list(TRANSCODE_PROFILES[profile]["formats"][target_extension][1])
+
+""" Get the number of threads for ffmpeg to use with the given profile """
+def transcode_threads(profile):
+    if profile["threads"]:
+        return profile["threads"]
+    return max(1, ((os.cpu_count() or 1) - 1) // max(1, MAX_SIMULTANEOUS_TRANSCODES))
+
+class Thumbnailer:
+    """ Makes thumbnails of images (or of the cover art embedded in music files) with ffmpeg, keeping them in a
+    TranscodeCache.  Thumbnails are made in the background, on max_simultaneous threads, so that request threads (of
+    which there are few) are never held waiting for ffmpeg.  Each is queued once, however many times it is asked for.
+    Sources which ffmpeg cannot make a thumbnail of are remembered, so that it is not tried again and again. """
+
+    # The ffmpeg output format and encoder arguments for each type of thumbnail
+    FORMATS = { ".webp":("webp", ("-c:v", "libwebp", "-quality", "75")),
+                ".jpg":("mjpeg", ("-q:v", "5")) }
+
+    """ Constructor """
+    def __init__(self, cache, max_simultaneous):
+        self.cache = cache
+        self.lock = threading.Lock()
+        # The thumbnails to make: tuples of (cache key, source filepath, extension, ffmpeg arguments)
+        self.queue = queue.Queue()
+        # The cache keys of the thumbnails queued or being made
+        self.pending = set()
+        # The cache keys of the thumbnails which could not be made
+        self.failed = set()
+        for i in range(max_simultaneous):
+            threading.Thread(target=self.work, name="Thumbnailer{}".format(i), daemon=True).start()
+
+    """ The ffmpeg output arguments for a thumbnail of the given size and type (extension) """
+    def args(self, size, extension):
+        # Scale down (never up) to fit in a size x size square, keeping the aspect ratio
+        return (["-map", "0:v:0", "-frames:v", "1",
+                 "-vf", "scale='min({0},iw)':'min({0},ih)':force_original_aspect_ratio=decrease".format(size)]
+                + list(Thumbnailer.FORMATS[extension][1]))
+
+    """ Get the path of a thumbnail of the source file, at most size pixels square, of the given type (extension).
+    Returns None if it has not been made yet (in which case it is queued to be made), or cannot be made. """
+    def get(self, source_filepath, size, extension):
+        args = self.args(size, extension)
+        key = self.cache.key(source_filepath, extension, args)
+        if not key:
+            return None
+        path = self.cache.get(key, extension)
+        if path:
+            return path
+        with self.lock:
+            if key in self.failed or key in self.pending:
+                return None
+            self.pending.add(key)
+        self.queue.put((key, source_filepath, extension, args))
+        return None
+
+    """ Worker thread: make the queued thumbnails, one at a time """
+    def work(self):
+        while True:
+            key, source_filepath, extension, args = self.queue.get()
+            try:
+                self.make(key, source_filepath, extension, args)
+            except Exception:
+                logging.exception("Failed to make thumbnail of {}".format(source_filepath))
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+
+    """ Make a thumbnail with ffmpeg and put it in the cache.  Returns its path, or None if it could not be made. """
+    def make(self, key, source_filepath, extension, args):
+        partial_path = self.cache.partial_path(key, extension)
+        logging.info("Making thumbnail of {}".format(source_filepath))
+        try:
+            returncode = subprocess.run(["ffmpeg", "-v", "quiet", "-i", source_filepath] + args
+                                        + ["-f", Thumbnailer.FORMATS[extension][0], "-y", partial_path],
+                                        stdin=subprocess.DEVNULL, timeout=THUMBNAIL_TIMEOUT).returncode
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logging.warning("Failed to run ffmpeg: {}".format(e))
+            returncode = None
+        if returncode == 0 and os.path.exists(partial_path) and os.path.getsize(partial_path):
+            return self.cache.add(key, extension, partial_path)
+
+        logging.warning("Could not make a thumbnail of {}".format(source_filepath))
+        try:
+            os.remove(partial_path)
+        except FileNotFoundError:
+            pass
+        with self.lock:
+            self.failed.add(key)
+        return None
 
-    """ Destructor """
-    def __del__(self):
-        logging.info("Destructing transcode job for {} -> {}".format(self.requested_filepath, self.out_file))
+    """ Statistics for monitoring """
+    def status(self):
+        with self.cache.lock:
+            return { "files":len(self.cache.files),
+                     "bytes":self.cache.total_bytes,
+                     "hits":self.cache.hits,
+                     "misses":self.cache.misses,
+                     "queued":len(self.pending),
+                     "failed":len(self.failed) }
 
-        # Stop the active transcode
-        if not self.transcode_finished():
-            self.transcode_process.terminate()
+""" The URL of the thumbnail, of the given size, of the album art at the given constructed filepath """
+def thumbnail_url(art_constructed_filepath, size):
+    return "{}?thumb={}".format(art_constructed_filepath, size)
 
-        # Remove the output file from disk
-        if os.path.exists(self.out_file):
-            os.remove(self.out_file)
+class RingBuffer:
+    """ A fixed-size buffer holding the most recent bytes of a stream.  Bytes are addressed by their position in the
+    whole stream; 'end' is the number of bytes written so far.  Not thread-safe: the owner must lock it. """
 
-    """ Has the transcoding completed? """
-    def transcode_finished(self):
-        if self.finished:
+    """ Constructor """
+    def __init__(self, size):
+        self.buffer = bytearray(size)
+        self.size = size
+        self.end = 0
+
+    """ Append data to the stream, overwriting the oldest bytes """
+    def write(self, data):
+        if len(data) > self.size:
+            self.end += len(data) - self.size
+            data = data[-self.size:]
+        start = self.end % self.size
+        first = min(len(data), self.size - start)
+        self.buffer[start:start + first] = data[:first]
+        self.buffer[:len(data) - first] = data[first:]
+        self.end += len(data)
+
+    """ Read up to max_length bytes from the given position in the stream.  Returns None if they have been overwritten. """
+    def read(self, position, max_length):
+        if position < self.end - self.size:
+            return None
+        length = min(max_length, self.end - position)
+        start = position % self.size
+        first = min(length, self.size - start)
+        return bytes(self.buffer[start:start + first]) + bytes(self.buffer[:length - first])
+
+class TranscodeScheduler:
+    """ Runs transcode jobs on a fixed pool of worker threads (MAX_SIMULTANEOUS_TRANSCODES), so that there are never
+    more ffmpeg processes than that, however many clients there are.
+    Jobs wait in a priority queue: the track a client is playing comes before speculative (prefetch) transcodes.
+    Requests for a transcode which is already queued or running share that job, rather than starting another.
+    Prefetch jobs have nobody waiting for them, so they are cancelled (by the usual mechanism) if nobody asks for them
+    within PREFETCH_WINDOW.  A running one is also cancelled if a track being played has to wait for a worker. """
+
+    # Priorities (lower runs first)
+    PRIORITY_PLAY = 0
+    PRIORITY_PREFETCH = 1
+
+    """ Constructor """
+    def __init__(self, num_workers):
+        self.num_workers = num_workers
+        self.condition = threading.Condition()
+        # The heap of (priority, sequence number, job) waiting to run.  A job whose priority is raised is pushed again,
+        # so the heap can contain stale entries, which are skipped.
+        self.queue = []
+        self.sequence = itertools.count()
+        # The queued and running jobs, by cache key
+        self.jobs = {}
+
+        # For monitoring
+        self.running = 0
+        self.completed = collections.Counter()
+        self.shared = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.started = 0
+
+        # Prefetching: the keys of the transcodes completed by prefetch jobs which nobody has asked for yet, and stats
+        self.prefetched = set()
+        self.prefetch_queued = 0
+        self.prefetch_hits = 0
+        self.prefetch_misses = 0
+        self.prefetch_cancelled = 0
+
+    """ Start the worker threads """
+    def start(self):
+        for i in range(self.num_workers):
+            threading.Thread(target=self.work, name="Transcoder{}".format(i), daemon=True).start()
+
+    """ Get the job to transcode the source file to the target format (starting one if there is none), and acquire it
+    for the caller, who must release() it when done.  A job already queued is moved up if this request is more urgent. """
+    def request(self, cache_key, requested_filepath, source_filepath, target_extension, profile, priority):
+        with self.condition:
+            job = self.jobs.get(cache_key)
+            if job is not None and (job.transcode_finished() or job.cancel_delay == 0):
+                job = None
+            if job is None:
+                job = Transcoder(cache_key, requested_filepath, source_filepath, target_extension, profile, priority)
+                self.jobs[cache_key] = job
+                heapq.heappush(self.queue, (priority, next(self.sequence), job))
+                logging.debug("Queued transcode of {} (priority {}, queue depth {})".format(requested_filepath, priority, self.queue_depth()))
+                if priority == TranscodeScheduler.PRIORITY_PLAY:
+                    self.prefetch_misses += 1
+                    self.preempt_prefetch()
+            else:
+                if job.prefetch:
+                    logging.info("Prefetched transcode of {} requested".format(requested_filepath))
+                    job.prefetch = False
+                    job.cancel_delay = TRANSCODE_CANCEL_DELAY
+                    self.prefetch_hits += 1
+                else:
+                    self.shared += 1
+                if priority < job.priority and job.state == Transcoder.QUEUED:
+                    job.priority = priority
+                    heapq.heappush(self.queue, (priority, next(self.sequence), job))
+            job.acquire()
+            self.condition.notify()
+        return job
+
+    """ Queue a speculative transcode of the source file to the target format, unless it is already queued or running.
+    Nobody is waiting for the job. """
+    def prefetch(self, cache_key, requested_filepath, source_filepath, target_extension, profile):
+        with self.condition:
+            if cache_key in self.jobs:
+                return
+            job = Transcoder(cache_key, requested_filepath, source_filepath, target_extension, profile, TranscodeScheduler.PRIORITY_PREFETCH)
+            job.prefetch = True
+            job.cancel_delay = PREFETCH_WINDOW
+            self.jobs[cache_key] = job
+            heapq.heappush(self.queue, (job.priority, next(self.sequence), job))
+            self.prefetch_queued += 1
+            logging.debug("Queued prefetch transcode of {} (queue depth {})".format(requested_filepath, self.queue_depth()))
+            self.condition.notify()
+
+    """ Count a request for a cached transcode as a prefetch hit if a prefetch job made it """
+    def cached_transcode_used(self, cache_key):
+        with self.condition:
+            if cache_key in self.prefetched:
+                self.prefetched.discard(cache_key)
+                self.prefetch_hits += 1
+
+    """ If every worker is busy, cancel a running prefetch job nobody has asked for, to make way for a track being
+    played.  (Call with the condition held.) """
+    def preempt_prefetch(self):
+        if self.running < self.num_workers:
+            return
+        for job in self.jobs.values():
+            if job.prefetch and job.state == Transcoder.RUNNING and job.cancel_delay:
+                logging.info("Cancelling prefetch transcode of {} to make way".format(job.requested_filepath))
+                # It is abandoned as soon as nobody having wanted it for 0s counts
+                job.cancel_delay = 0
+                return
+
+    """ May a prefetch job start now?  Only if the load is low enough. """
+    def prefetch_allowed(self):
+        try:
+            return os.getloadavg()[0] / (os.cpu_count() or 1) < PREFETCH_MAX_LOAD
+        except OSError:
             return True
-        if self.transcode_process.poll() is not None:
-            self.finished = True
-            self.transcode_process = None
-
-        return self.finished
-
-    """ Returns the name of the transcoded file.  Waits for it to be created if it does not already exist. """
-    def get_transcoded_filepath(self):
-        # If we have finished transcoding, the file should have been created already 
-        if self.transcode_finished():
-            if os.path.exists(self.out_file):
-                return self.out_file
+
+    """ Get a job (acquired for the caller, as for request()) producing the output of the given (running) job from
+    byte 'position', which it has not reached.  This is a job transcoding from the corresponding time in the source,
+    estimated from the output's bytes per second so far, or an existing one which will soon reach the position.
+    The original job is cancelled as soon as nobody is reading it. """
+    def seek(self, transcoder, position):
+        bytes_per_second = transcoder.bytes_per_second()
+        with self.condition:
+            transcoder.cancel_delay = 0
+            job = self.find_seek_job(transcoder.cache_key, position)
+            if not job:
+                seek_time = position / bytes_per_second
+                logging.info("Seeking transcode of {} to byte {} ({:.1f}s)".format(transcoder.requested_filepath, position, seek_time))
+                job = Transcoder(transcoder.cache_key, transcoder.requested_filepath, transcoder.source_filepath,
+                                 transcoder.target_extension, transcoder.profile, TranscodeScheduler.PRIORITY_PLAY, seek_time, position)
+                self.jobs[(transcoder.cache_key, position)] = job
+                heapq.heappush(self.queue, (job.priority, next(self.sequence), job))
+                self.preempt_prefetch()
+            # Move the client to the new job, so that the old one can be cancelled if nobody else is reading it
+            job.acquire()
+            transcoder.release()
+            self.condition.notify()
+        return job
+
+    """ Find an unfinished seek job (see seek()) for the output with the given key which has reached, or will soon
+    reach, byte 'position'.  (Call with the condition held.) """
+    def find_seek_job(self, cache_key, position):
+        for job in self.jobs.values():
+            if (job.cache_key == cache_key and job.origin and not job.transcode_finished()
+                and job.origin <= position <= job.origin + job.produced() + job.bytes_per_second() * TRANSCODE_SEEK_AHEAD_TIME):
+                return job
+        return None
+
+    """ Get an existing seek job which can serve the output with the given key from byte 'position', acquired for the
+    caller, or None """
+    def request_seek(self, cache_key, position):
+        with self.condition:
+            job = self.find_seek_job(cache_key, position)
+            if job:
+                job.acquire()
+                self.shared += 1
+            return job
+
+    """ The number of jobs waiting to run """
+    def queue_depth(self):
+        return sum(1 for job in self.jobs.values() if job.state == Transcoder.QUEUED)
+
+    """ Take the next job to run from the queue, waiting for one if necessary.  Jobs nobody wants any more are dropped. """
+    def next_job(self):
+        with self.condition:
+            while True:
+                deferred = None
+                while self.queue:
+                    priority, sequence, job = heapq.heappop(self.queue)
+                    if job.state != Transcoder.QUEUED or priority != job.priority:
+                        continue
+                    if job.abandoned() and job.cancel():
+                        logging.info("Dropping abandoned transcode of {} from queue".format(job.requested_filepath))
+                        self.job_done(job)
+                        continue
+                    if job.prefetch and not self.prefetch_allowed():
+                        # Try again when the load may have dropped.  (The rest of the queue is prefetches too.)
+                        deferred = (priority, sequence, job)
+                        heapq.heappush(self.queue, deferred)
+                        break
+                    self.running += 1
+                    return job
+                self.condition.wait(PREFETCH_RETRY_INTERVAL if deferred else None)
+
+    """ Forget a job which has finished or been cancelled.  (Call with the condition held.) """
+    def job_done(self, job):
+        job_key = (job.cache_key, job.origin) if job.origin else job.cache_key
+        if self.jobs.get(job_key) is job:
+            del self.jobs[job_key]
+        self.completed[job.state] += 1
+        if job.prefetch:
+            if job.state == Transcoder.FINISHED:
+                self.prefetched.add(job.cache_key)
             else:
-                logging.warning("Transcode finished but destination file not created")
+                self.prefetch_cancelled += 1
+
+    """ Worker thread: run jobs from the queue, one at a time """
+    def work(self):
+        while True:
+            job = self.next_job()
+            wait = time.monotonic() - job.queued_time
+            job.run()
+            with self.condition:
+                self.running -= 1
+                self.job_done(job)
+                if job.started_time is not None:
+                    self.started += 1
+                    self.total_wait += wait
+                    self.max_wait = max(self.max_wait, wait)
+
+    """ Statistics for monitoring.  Wait times are from a job being queued to it starting, in seconds. """
+    def status(self):
+        with self.condition:
+            now = time.monotonic()
+            queued_waits = [ now - job.queued_time for job in self.jobs.values() if job.state == Transcoder.QUEUED ]
+            return { "workers":self.num_workers,
+                     "running":self.running,
+                     "queue_depth":len(queued_waits),
+                     "longest_queued_wait":max(queued_waits, default=None),
+                     "shared_requests":self.shared,
+                     "finished":self.completed[Transcoder.FINISHED],
+                     "failed":self.completed[Transcoder.FAILED],
+                     "cancelled":self.completed[Transcoder.CANCELLED],
+                     "average_wait":self.total_wait / self.started if self.started else None,
+                     "max_wait":self.max_wait,
+                     "cache_hits":transcode_cache.hits,
+                     "cache_misses":transcode_cache.misses,
+                     # Hits are requests for prefetched transcodes; misses are requests which had to start one
+                     "prefetch":{ "queued":self.prefetch_queued,
+                                  "hits":self.prefetch_hits,
+                                  "misses":self.prefetch_misses,
+                                  "cancelled":self.prefetch_cancelled,
+                                  "unused":len(self.prefetched) } }
+
+class PageCache:
+    """ A least-recently-used cache of rendered pages (as encoded bytes), limited by total size.
+    Keys should include the library generation and the content encoding of the page, and the cache should be cleared
+    when a new library is swapped in. """
+
+    """ Constructor """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        # Don't let one huge page flush everything else
+        self.max_page_bytes = max_bytes // 2
+        self.total_bytes = 0
+        self.pages = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    """ Get the page for the given key, or None if it is not cached """
+    def get(self, key):
+        with self.lock:
+            page = self.pages.get(key)
+            if page is None:
+                self.misses += 1
                 return None
+            self.pages.move_to_end(key)
+            self.hits += 1
+            return page
+
+    """ Store a page, evicting the least-recently-used ones to make room """
+    def put(self, key, page):
+        if len(page) > self.max_page_bytes:
+            logging.debug("Not caching page of {} bytes".format(len(page)))
+            return
 
-        # If we are still transcoding, wait up to 10s for the file to appear
-        for i in range(0,100):
-            if os.path.exists(self.out_file):
-                return self.out_file
-            time.sleep(0.1)
+        with self.lock:
+            old_page = self.pages.pop(key, None)
+            if old_page is not None:
+                self.total_bytes -= len(old_page)
+            self.pages[key] = page
+            self.total_bytes += len(page)
+            while self.total_bytes > self.max_bytes:
+                evicted_key, evicted_page = self.pages.popitem(last=False)
+                self.total_bytes -= len(evicted_page)
+
+    """ Statistics for monitoring """
+    def status(self):
+        with self.lock:
+            return { "pages":len(self.pages), "bytes":self.total_bytes, "hits":self.hits, "misses":self.misses }
+
+    """ Remove everything from the cache (e.g. because the library has changed) """
+    def clear(self):
+        with self.lock:
+            self.pages.clear()
+            self.total_bytes = 0
+        logging.debug("Page cache cleared")
+
+""" The content type of all our pages """
+HTML_CONTENT_TYPE = "text/html; charset=utf-8"
+
+""" Content encodings we can compress with, in order of preference """
+CONTENT_ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+""" Choose the content encoding to use for a compressible response, given the request's Accept-Encoding header.
+Returns "br", "gzip", or None to send the response uncompressed. """
+def choose_encoding(accept_encoding):
+    if not accept_encoding:
+        return None
 
+    # Get the quality for each coding the client accepts (e.g. "gzip, deflate;q=0.5, br;q=0")
+    accepted = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        quality = 1.0
+        match = re.search(r"q=([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    for encoding in CONTENT_ENCODINGS:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+""" The ETag of a page generated from the given library, sent with the given content encoding (or None).
+Pages only change when the library does, or when the server is restarted (e.g. with new templates). """
+def page_etag(lib, encoding):
+    return '"{}-{}-{}"'.format(instance_id, lib.generation, encoding or "identity")
+
+""" Returns True if the value of an If-None-Match header (a list of ETags, or "*") matches the given ETag.
+This is the weak comparison, which is what If-None-Match uses. """
+def etag_matches(header, etag):
+    if header.strip() == "*":
+        return True
+    tags = [ tag.strip() for tag in header.split(",") ]
+    return etag in [ tag[2:] if tag.startswith("W/") else tag for tag in tags ]
+
+""" Parse an HTTP date (as in If-Modified-Since), returning a timestamp, or None if it is missing or invalid """
+def parse_http_date(value):
+    if not value:
+        return None
+    try:
+        return int(email.utils.parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError, IndexError):
         return None
 
+""" Parse a Range header (e.g. "bytes=0-499", "bytes=500-", "bytes=-500" or "bytes=0-0,-1"), returning a list of
+(first, last) pairs, where first is None for a suffix range (the last 'last' bytes), and last is None for a range
+running to the end of the file.  Returns None if the header is not a valid set of byte ranges, in which case it is
+ignored and the whole file is sent. """
+def parse_range_header(header):
+    match = re.match(r"\s*bytes\s*[= :]\s*(.*)$", header, re.IGNORECASE)
+    if not match:
+        return None
+    ranges = []
+    for spec in match.group(1).split(","):
+        spec = spec.strip()
+        # Empty elements are allowed in the list
+        if not spec:
+            continue
+        spec_match = re.match(r"(\d*)\s*-\s*(\d*)$", spec)
+        if not spec_match or not (spec_match.group(1) or spec_match.group(2)):
+            return None
+        first = int(spec_match.group(1)) if spec_match.group(1) else None
+        last = int(spec_match.group(2)) if spec_match.group(2) else None
+        if first is not None and last is not None and last < first:
+            return None
+        ranges.append((first, last))
+    return ranges or None
+
+""" Resolve ranges (as returned by parse_range_header()) against the length of a file, returning a sorted list of
+(start, end) byte positions, inclusive.  Ranges which cannot be satisfied are dropped, and overlapping or adjacent
+ranges are merged.  If none can be satisfied, the list is empty. """
+def resolve_ranges(ranges, length):
+    byte_ranges = []
+    for first, last in ranges:
+        if first is None:
+            # Suffix range: the last 'last' bytes (or the whole file, if it is shorter)
+            if last == 0 or length == 0:
+                continue
+            byte_ranges.append((max(length - last, 0), length - 1))
+        elif first < length:
+            byte_ranges.append((first, length - 1 if last is None else min(last, length - 1)))
+
+    merged = []
+    for start, end in sorted(byte_ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+class Compressor:
+    """ Compresses a response with a content encoding ("gzip" or "br"), a piece at a time, so that it can be sent as
+    it is produced. """
+
+    """ Constructor """
+    def __init__(self, encoding, best = False):
+        self.encoding = encoding
+        if encoding == "br":
+            self.compressor = brotli.Compressor(quality=11 if best else BROTLI_QUALITY)
+        else:
+            # wbits of 31 gives the gzip format
+            self.compressor = zlib.compressobj(9 if best else GZIP_LEVEL, zlib.DEFLATED, 31)
+
+    """ Compress the next piece of data, returning all the compressed data so far that has not already been returned.
+    The output is flushed, so that the client can decompress everything it has been sent. """
+    def compress(self, data):
+        if self.encoding == "br":
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    """ Finish the compressed stream, returning the last of the compressed data """
+    def finish(self):
+        if self.encoding == "br":
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+""" Compress data (bytes) in one go with the given content encoding """
+def compress(data, encoding, best = False):
+    compressor = Compressor(encoding, best)
+    return compressor.compress(data) + compressor.finish()
+
+class StaticFile:
+    """ A static text file (script or stylesheet), read once and kept in memory along with a copy compressed with each
+    content encoding we support, so that it can be sent without touching the disk or compressing it again. """
+
+    """ Constructor """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.mime_type = guess_mime_type(filepath)
+        with open(filepath, "rb") as f:
+            data = f.read()
+        # The version, which changes whenever the contents do, so that the URL including it can be cached forever
+        self.version = hashlib.sha1(data).hexdigest()[:12]
+        self.url = os.path.basename(filepath) + "?v=" + self.version
+        # The file contents for each encoding, where None is uncompressed
+        self.encoded = { None:data }
+        for encoding in CONTENT_ENCODINGS:
+            self.encoded[encoding] = compress(data, encoding, best=True)
+        logging.debug("Loaded {}: {}".format(filepath, ", ".join("{} {} bytes".format(encoding or "uncompressed", len(data))
+                                                                 for encoding, data in self.encoded.items())))
+
+    """ The ETag of the file as sent with the given content encoding (or None for uncompressed) """
+    def etag(self, encoding):
+        return '"{}-{}"'.format(self.version, encoding or "identity")
+
+""" Load the static text files, keyed by the path they are requested as """
+def load_static_files():
+    return { "/" + filename:StaticFile(os.path.join(script_path, filename))
+             for filename in ("munic.js", "muneq.js", "munic.css") }
+
 class Handler(BaseHTTPRequestHandler):
 
+    # With the AsyncServer, the ResponseBuffer the response is written to (as wfile), to be sent by the event loop
+    response_buffer = None
+
+    # Timeout for socket operations (used by StreamRequestHandler)
+    timeout = SOCKET_TIMEOUT
+
     """ Constructor """
     def __init__(self, request, client_address, server):
         # Override the default protocol (HTTP/1.0).
@@ -141,10 +1281,46 @@ class Handler(BaseHTTPRequestHandler):
         # Call the BaseHTTPRequestHandler constructor
         super(Handler, self).__init__(request, client_address, server)
 
+    def handle(self):
+        "Handles requests on the connection until it is closed, or it is idle for too long between them."
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection and self.wait_for_request():
+            self.handle_one_request()
+
+    def wait_for_request(self):
+        "Waits for another request on a keep-alive connection. Returns False if it should be closed instead (see KEEPALIVE_TIMEOUT)."
+        # The next request may already have been read (into rfile's buffer)
+        self.connection.settimeout(0)
+        try:
+            if self.rfile.peek(1):
+                return True
+        except OSError:
+            # Nothing to read yet (BlockingIOError, or SSLWantReadError with HTTPS), or the connection has failed
+            pass
+        finally:
+            self.connection.settimeout(self.timeout)
+
+        server_busy = getattr(self.server, "busy", lambda: False)
+        deadline = time.monotonic() + KEEPALIVE_TIMEOUT
+        while not server_busy():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logging.debug("Closing idle connection")
+                return False
+            # Check for other connections waiting now and then.  (A closed connection is readable too.)
+            readable, _, _ = select.select([self.connection], [], [], min(remaining, 0.5))
+            if readable:
+                return True
+        logging.debug("Closing idle connection to make way for others")
+        return False
+
     def do_GET(self):
         logging.info("GET path: {} on thread {}".format(self.path, threading.get_ident()))
 
-        name = urllibparse.unquote(self.path)
+        # The query (if any) is not part of the name
+        url = urllibparse.urlsplit(self.path)
+        name = urllibparse.unquote(url.path)
 
         # Front page
         if name == "":
@@ -153,16 +1329,25 @@ class Handler(BaseHTTPRequestHandler):
             self.end_headers()
             self.wfile.write("Coming soon".encode("utf-8"))
         # If requesting a static file...
-        elif name == "/munic.js":
-            self.send_file(os.path.join(script_path, "munic.js"))
-        elif name == "/muneq.js":
-            self.send_file(os.path.join(script_path, "muneq.js"))
+        elif name in static_files:
+            self.send_static(static_files[name], url.query)
         elif name == "/favicon.png":    
             self.send_file(os.path.join(script_path, "favicon.png"))
         elif name == "/munic.png":
             self.send_file(os.path.join(script_path, "munic.png"))
-        elif name == "/munic.css":
-            self.send_file(os.path.join(script_path, "munic.css"))
+        # The server status, for monitoring
+        elif name == API_STATUS_PATH:
+            self.send_json({ "server":self.server.status(),
+                             "library":library_scanner.status(),
+                             "page_cache":page_cache.status(),
+                             "transcodes":transcode_scheduler.status(),
+                             "thumbnails":thumbnailer.status() })
+        # Search by name
+        elif name == API_SEARCH_PATH:
+            self.send_search(url.query)
+        # The JSON API for listing a location
+        elif name.startswith(API_LIST_PREFIX):
+            self.send_list(self.path)
         # If the url ends with a "/" or "/*", treat it as a menu/playlist request for that location 
         elif name.endswith("/") or name.endswith("/*"):
             self.send_menu(name)
@@ -171,28 +1356,44 @@ class Handler(BaseHTTPRequestHandler):
             self.refresh_library(name)
         # Otherwise, assume the request is for a media file 
         else:
-            self.send_media(name)
+            self.send_media(name, url.query)
     
         logging.info("GET completed: {} on thread {}".format(self.path, threading.get_ident()))
 
     def refresh_library(self, name):
         logging.info("Refreshing media library")
 
-        # Perform the refresh
-        global library
-        library = load_library(media_dirs)
-
-        # Redirect the browser to the same location, without the trailing _
-        redirect = name[:-1]
+        # Kick off a background rescan. The new library will be swapped in when it is ready.
+        library_scanner.request_scan()
+
+        # Report the scan status, then send the browser back to the same location, without the trailing _
+        status = library_scanner.status()
+        redirect = os.path.basename(name[:-1]) or "./"
+        last_duration = "{:.2f}s".format(status["last_scan_duration"]) if status["last_scan_duration"] is not None else "-"
+        html = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="UTF-8">
+    <meta http-equiv="refresh" content="2; url=__REDIRECT__">
+    <title>Munic</title>
+</head>
+<body>
+  <p>Library scan in progress: __SCANNING__</p>
+  <p>Last scan duration: __DURATION__</p>
+  <p>Directories re-listed: __LISTED__</p>
+  <p>Songs added: __ADDED__</p>
+  <p>Songs removed: __REMOVED__</p>
+  <p><a href="__REDIRECT__">Back</a></p>
+</body>
+</html>
+""".replace("__REDIRECT__", redirect) \
+            .replace("__SCANNING__", "yes" if status["scanning"] else "no") \
+            .replace("__DURATION__", last_duration) \
+            .replace("__LISTED__", str(status["directories_listed"])) \
+            .replace("__ADDED__", str(status["songs_added"])) \
+            .replace("__REMOVED__", str(status["songs_removed"]))
         logging.info("Redirecting to " + redirect)
-        self.send_response(303)
-        self.send_header('Location', redirect)
-        self.end_headers()
-
-        # If we don't call self.finish(), the redirect does not work when we are behind an nginx proxy. I don't understand why.
-        # If we do call it, we get a ValueError (which is caught, but looks a mess.)
-        # Therefore we do it only for redirects. Ideally we'd understand why it doesn't work behind nginx and fix it.
-        self.finish()
+        self.send_html(html)
 
     def send_menu(self, name):
         # If the request is for a directory, we treat it as requesting a list of subdirs (artists, albums etc.) in that location.
@@ -204,450 +1405,1133 @@ class Handler(BaseHTTPRequestHandler):
         if name.endswith("/*"):
             include_songs = True
 
-        # The root location, relative to the requested location
-        root = ""
-
-        # Get the requested path and navigate to it.
-        # As we go, build up "display_name" with the properly-formatted names of the directories.
-        # Also keep track of the most specific part of the name, for the title.
-        title = "Munic"
         requested_path = name.rstrip("/")
         logging.debug("Requested path: {}".format(requested_path))
+
+        # Take a reference to the library once, in case a rescan swaps in a new one while we are working
+        lib = library
+
+        # If the browser already has this page from the same library, it need not be sent at all
+        encoding = self.accepted_encoding()
+        etag = page_etag(lib, encoding)
+        if self.check_not_modified(etag, None, PAGE_CACHE_CONTROL):
+            return
+
+        # If we have rendered this page before (from the same library, with the same compression), send it again
+        cache_key = (requested_path, include_songs, lib.generation, encoding)
+        encoded = page_cache.get(cache_key)
+        if encoded is not None:
+            logging.debug("Sending menu page from cache")
+            self.send_encoded(encoded, HTML_CONTENT_TYPE, encoding, etag, PAGE_CACHE_CONTROL)
+            return
+
         parts = requested_path.split("/")
-        base_dict = library
-        display_names = []
-        dirs = base_dict["dirs"]
         # Remove empty parts which result from splitting empty strings etc.
         parts = [ part for part in parts if part and part != "*"]
-        for part in parts:
-            # If that directory does not exist
-            if part not in dirs.keys():
-                logging.warning("Failed to find {} - failed at {}".format(requested_path, part))
-                self.send_response(404)
-                self.end_headers()
-                return
-            base_dict = dirs[part]
-            root += "../"
-            display_names.append(base_dict["display_name"])
-            title = base_dict["display_name"]
-            dirs = base_dict["dirs"]
 
-        # Get all media files at (but not below) this location
-        media_items = get_all_songs(base_dict, recurse=False)
+        # Check the requested directory exists
+        base_dict = library_node(lib, parts)
+        if base_dict is None:
+            logging.warning("Failed to find {}".format(requested_path))
+            self.send_response(404)
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+        dirs = base_dict.dirs
 
         # If there are no files in this directory, and exactly one subdirectory, redirect to it.
         # (So if you view artist X, and that artist has exactly one album, automatically enter it.)
-        if len(media_items) == 0 and len(dirs) == 1:
+        if len(base_dict.media) == 0 and len(dirs) == 1:
             redirect = list(dirs.keys())[0] + "/"
             if include_songs:
                 redirect += "*"
             logging.info("No direct media and only one subdir -> redirecting down one level to %s" % redirect)
             self.send_response(303)
             self.send_header("Location", redirect)
+            if self.response_buffer is not None:
+                # The AsyncServer keeps the connection open, so the (empty) body must have a length
+                self.send_header("Content-Length", 0)
             self.end_headers()
 
             # If we don't call self.finish(), the redirect does not work when we are behind an nginx proxy. I don't understand why.
             # If we do call it, we get a ValueError (which is caught, but looks a mess.)
             # Therefore we do it only for redirects. Ideally we'd understand why it doesn't work behind nginx and fix it.
-            self.finish()
+            # (With the AsyncServer there is no connection to finish: the event loop sends the response.)
+            if self.response_buffer is None:
+                self.finish()
             return
 
-        # Read the playlist page template html from file
-        with open(os.path.join(script_path, "playlist.html")) as html_file:
-            html = html_file.read()
-
-        # Construct the page. This will be all the directories directly under this one, as links,
-        # and all the files from this directory onwards, as a playlist.
-
-        # Drop in the page title
-        html = html.replace("__TITLE__", title)
-
-        # Drop in the audioplayer and equaliser javascript files
-        html = html.replace("__AUDIOPLAY_JS__", root + "munic.js") 
-        html = html.replace("__MUNEQ_JS__", root + "muneq.js") 
-
-        # Get the titles: the display names of the path, or "Munic" if none.
-        if not display_names:
-            display_names.append("Munic")
-
-        # Lazy way to ensure there are enough items in the list to replace the titles
-        display_names.append("")
-        display_names.append("")
-
-        # Drop in the titles
-        for h in range(0,3):
-            html = html.replace("__TITLE{}__".format(h), display_names[h])
-
-        # Generate some colours and drop them in
-        # TODO Get these from the selected image
-        r = [ random.randint(1,3) for a in range (0,9) ]
-        colours = [ "#{}{}{}".format(r.pop(), r.pop(), r.pop()) for a in range(0,3) ]
-        for c in range(0,3):
-            html = html.replace("__BG_COL{}__".format(c), colours[c])
-
-        # Build the playlist (subdir) links section
-        playlist_links = ""
-        # If we are not showing the songs in the folder, the first link is always "All songs"
-        if not include_songs:
-            playlist_links = """<li id="speciallink"><a href="*"><img src="__ALBUMART__" loading="lazy"/><p>All Songs</p></a></li>\n""" \
-                .replace("__ALBUMART__", "__ROOT__munic.png")
-
-        if dirs:
-            # Sort the keys (dir names) alphabetically
-            # Note that we are sorting by "simplified name", so "The Beatles" is in with the Bs, not the Ts.
-            dir_names = [ dir_name for dir_name in dirs.keys() ]
-            dir_names.sort()
-            for dir_name in dir_names:
-                display_name = dirs[dir_name]["display_name"]
-                link = dir_name + "/*"  # Include '*' to take us to the playlist
-                art_constructed_filepath = get_art_filepath(base_dict["dirs"][dir_name])
-                if art_constructed_filepath:
-                    art_constructed_filepath = dir_name + "/" + art_constructed_filepath
-                else:
-                    art_constructed_filepath = "__ROOT__munic.png"
-                playlist_link = """<li><a href="__LINK__" class="playlistlink"><img src="__ALBUMART__" loading="lazy"/><p>__NAME__</p></a></li>\n""" \
-                    .replace("__LINK__", link) \
-                    .replace("__ALBUMART__", art_constructed_filepath) \
-                    .replace("__NAME__", display_name)
-                playlist_links = playlist_links + playlist_link
-
-        # Drop the links into the html document
-        html = html.replace("__PLAYLIST_LINKS__", playlist_links)
-        # If there are no playlist links, hide the whole section
-        if playlist_links:
-            html = html.replace("__LINKS_CLASS__", "")
-            logging.info("*** SHOWING")
+        # Render the page a chunk at a time.  If it is small, send it in one go with a Content-Length.
+        # Otherwise stream it with chunked transfer encoding, so that the browser can start rendering the top of the
+        # page while we are still producing the (possibly enormous) playlist.
+        chunks = render_menu(lib, parts, include_songs)
+        first_chunks = []
+        for chunk in chunks:
+            first_chunks.append(chunk)
+            if len(first_chunks) > 1:
+                break
         else:
-            html = html.replace("__LINKS_CLASS__", "hidden")
-            logging.info("*** HIDDEN")
-
-        # Build the playlist contents.  
-        playlist_items = ""
-
-        # The path to request to refresh the library
-        refresh_path = "_"
-
-        if include_songs:
-            # Get all media files at or below this location
-            media_items = get_all_songs(base_dict, recurse=True)
+            encoded = b"".join(first_chunks)
+            if encoding:
+                encoded = compress(encoded, encoding)
+            page_cache.put(cache_key, encoded)
+            self.send_encoded(encoded, HTML_CONTENT_TYPE, encoding, etag, PAGE_CACHE_CONTROL)
+            return
 
-            # Construct the list items
-            for (song_display_name, song_display_album, song_constructed_filepath, art_constructed_filepath) in media_items:
-                playlist_item = """<li><a href="__SONG_FILENAME__" class="songlink"><div><img src="__ALBUMART__" loading="lazy"/></div><div><p>__SONG_NAME__</p><p>__ALBUM_NAME__</p></div></a></li>\n""" \
-                    .replace("__ALBUMART__", art_constructed_filepath) \
-                    .replace("__SONG_FILENAME__", song_constructed_filepath) \
-                    .replace("__SONG_NAME__", song_display_name) \
-                    .replace("__ALBUM_NAME__", song_display_album)
-                playlist_items = playlist_items + playlist_item
+        self.send_response(200)
+        self.send_header("Content-Type", HTML_CONTENT_TYPE)
+        self.send_header("Accept-CH", ACCEPT_CLIENT_HINTS)
+        self.send_header("Transfer-Encoding", "chunked")
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_cache_headers(etag, None, PAGE_CACHE_CONTROL)
+        self.end_headers()
 
-            refresh_path = "*_"
+        # Keep the chunks (as sent) to put the page in the cache -- unless it gets too big to be cached anyway
+        to_cache = []
+        size = 0
+        sent = 0
+        compressor = Compressor(encoding) if encoding else None
+        try:
+            for chunk in itertools.chain(first_chunks, chunks, (None,)):
+                # None marks the end of the page, which is where a compressed stream is finished
+                if chunk is None:
+                    if not compressor:
+                        break
+                    data = compressor.finish()
+                else:
+                    size += len(chunk)
+                    data = compressor.compress(chunk) if compressor else chunk
+                # An empty chunk would end the response
+                if not data:
+                    continue
+                self.write_chunk(data)
+                sent += len(data)
+                if to_cache is not None:
+                    to_cache.append(data)
+                    if sent > page_cache.max_page_bytes:
+                        to_cache = None
+
+            # Send an empty chunk to indicate the end of the page
+            self.write_chunk(b"")
+            logging.info("Streamed HTML ({} bytes, {} bytes sent)".format(size, sent))
+        except BrokenPipeError:
+            logging.warning("Broken pipe error sending menu after {} bytes".format(size))
+            return
+        except ConnectionResetError:
+            logging.warning("Connetion reset by peer sending menu after {} bytes".format(size))
+            return
 
-        # Drop the playlist content into the html template
-        html = html.replace("__PLAYLIST_ITEMS__", playlist_items)
+        if to_cache is not None:
+            page_cache.put(cache_key, b"".join(to_cache))
+
+    def send_list(self, path):
+        # Send a page of the contents of a location as JSON, for clients which load playlists as they go.
+        # The path is /api/list/<location>/?offset=<n>&limit=<n>&recurse=<0|1>, where the location is as for send_menu.
+        # The contents are the subdirectories of the location then the songs at (and, if recurse is 1, below) it,
+        # and offset and limit select a page of those.  Paths are relative to the location, as they are in the menu page.
+        url = urllibparse.urlsplit(path)
+        requested_path = urllibparse.unquote(url.path)[len(API_LIST_PREFIX):].rstrip("/")
+        query = urllibparse.parse_qs(url.query)
+        try:
+            offset = max(int(query.get("offset", ["0"])[0]), 0)
+            limit = min(max(int(query.get("limit", [str(API_LIST_MAX_LIMIT)])[0]), 0), API_LIST_MAX_LIMIT)
+            recurse = query.get("recurse", ["1"])[0] != "0"
+        except ValueError:
+            logging.warning("Bad list query: {}".format(url.query))
+            self.send_response(400)
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
 
-        # Drop in the album art
-        art_filepath = get_art_filepath(base_dict)
-        if not art_filepath:
-            art_filepath = "__ROOT__munic.png"
+        # Take a reference to the library once, in case a rescan swaps in a new one while we are working
+        lib = library
 
-        html = html.replace("__ALBUMART__", art_filepath);
+        # If the browser already has this page from the same library, it need not be sent at all
+        etag = page_etag(lib, self.accepted_encoding())
+        if self.check_not_modified(etag, None, PAGE_CACHE_CONTROL):
+            return
 
-        # Drop in the redirect path, which is either "_" if we are not showing songs, or "*_" if we are
-        html = html.replace("__REFRESH__", refresh_path)
+        parts = [ part for part in requested_path.split("/") if part and part != "*"]
+        base_dict = library_node(lib, parts)
+        if base_dict is None:
+            logging.warning("Failed to find {}".format(requested_path))
+            self.send_response(404)
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+        key = tuple(parts)
+        default_art = "../" * len(parts) + "munic.png"
+
+        # The subdirectories in this page
+        dir_names = sorted(base_dict.dirs.keys())
+        dirs = []
+        for dir_name in dir_names[offset:offset + limit]:
+            art_constructed_filepath = get_art_filepath(lib, key + (dir_name,))
+            dirs.append({ "name":base_dict.dirs[dir_name].display_name,
+                          "link":dir_name + "/*",
+                          "art":thumbnail_url(dir_name + "/" + art_constructed_filepath, THUMBNAIL_LINK_SIZE)
+                                if art_constructed_filepath else default_art })
+
+        # The songs in this page, which follow the subdirectories
+        song_offset = max(offset - len(dir_names), 0)
+        song_limit = limit - len(dirs)
+        songs = [ { "name":song_display_name,
+                    "album":song_display_album,
+                    "file":song_constructed_filepath,
+                    "art":thumbnail_url(art_constructed_filepath, THUMBNAIL_SONG_SIZE)
+                          if art_constructed_filepath is not DEFAULT_ART else default_art }
+                  for (song_display_name, song_display_album, song_constructed_filepath, art_constructed_filepath)
+                  in get_all_songs(lib, key, recurse, song_offset, song_offset + song_limit) ]
+
+        self.send_json({ "title":base_dict.display_name or "Munic",
+                         "offset":offset,
+                         "limit":limit,
+                         "total_dirs":len(dir_names),
+                         "total_songs":count_songs(lib, key, recurse),
+                         "dirs":dirs,
+                         "songs":songs },
+                       etag)
+
+    def send_search(self, query_string):
+        # Send the artists, albums and songs whose names match a query as JSON.
+        # The path is /search?q=<query>&limit=<n>, and there are up to limit (default SEARCH_RESULTS) of each, best
+        # first: names equal to the query, then starting with it, then containing it (see NameIndex).  Names are
+        # matched simplified, so "guns n roses" finds "Guns'n'Roses".  Paths are relative to the root.
+        query = urllibparse.parse_qs(query_string)
+        try:
+            limit = min(max(int(query.get("limit", [str(SEARCH_RESULTS)])[0]), 0), API_LIST_MAX_LIMIT)
+        except ValueError:
+            logging.warning("Bad search query: {}".format(query_string))
+            self.send_response(400)
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+        search = query.get("q", [""])[0]
 
-        # Drop in the root location (last, in case it is used in any substituted values)
-        html = html.replace("__ROOT__", root)
+        # Take a reference to the library once, in case a rescan swaps in a new one while we are working
+        lib = library
 
-        self.send_html(html)
+        # If the browser already has the results from the same library, they need not be sent at all
+        etag = page_etag(lib, self.accepted_encoding())
+        if self.check_not_modified(etag, None, PAGE_CACHE_CONTROL):
+            return
 
-    def send_media(self, name):
+        start_time = time.perf_counter()
+        artist_paths, album_paths, song_positions = lib.search.search(search, limit)
+        logging.info("Searched for {} in {:.2f}ms".format(search, (time.perf_counter() - start_time) * 1000))
+
+        def dir_result(constructed_path):
+            art_constructed_filepath = get_art_filepath(lib, tuple(constructed_path.rstrip("/").split("/")))
+            return { "name":lib.paths[constructed_path].display_name,
+                     "link":constructed_path + "*",
+                     "art":thumbnail_url(constructed_path + art_constructed_filepath, THUMBNAIL_LINK_SIZE)
+                           if art_constructed_filepath else "munic.png" }
+
+        songs = []
+        for position in song_positions:
+            song_display_name, song_display_album, song_constructed_filepath, art_constructed_filepath = lib.songs[position]
+            songs.append({ "name":song_display_name,
+                           "album":song_display_album,
+                           "file":song_constructed_filepath,
+                           "art":thumbnail_url(art_constructed_filepath, THUMBNAIL_SONG_SIZE)
+                                 if art_constructed_filepath is not DEFAULT_ART else "munic.png" })
+
+        self.send_json({ "query":search,
+                         "artists":[ dir_result(path) for path in artist_paths ],
+                         "albums":[ dir_result(path) for path in album_paths ],
+                         "songs":songs },
+                       etag)
+
+    def send_media(self, name, query = ""):
         logging.debug("Attempting to get file {}".format(name))
 
-        # Get the file range, if specified by the requester
+        # Get the file ranges, if specified by the requester
         range_header = self.headers.get("Range")
-        range_start = None
-        range_end = None
+        ranges = None
         if range_header:
             logging.debug("Range header: {}".format(range_header))
-            match = re.match("bytes[= :](\\d+|)\\-(\\d+|)$", range_header, re.IGNORECASE)
-            if match and match.lastindex == 2:
-                groups = match.groups()
-                range_start = int(groups[0]) if groups[0].isnumeric() else None
-                range_end = int(groups[1]) if groups[1].isnumeric() else None 
-                logging.debug("Requested range {}-{}".format(range_start, range_end))
-
-        # Get the dict representing the path of the requested file by walking down the structure to the right directory
-        parts = name.lstrip("/").split("/")
-        base_dict = library
-        for dir_part in parts[:-1]:
-            dirs = base_dict["dirs"]
-            if dir_part not in dirs.keys():
-                logging.warning("Requested unknown file: {} - failed at {}".format(name, dir_part))
-                self.send_response(404)
-                self.end_headers()
-                return
-            base_dict = dirs[dir_part]
-
-        # Remove the extension from the constructed filename to give the display name
-        constructed_filename = parts[-1]
-        basename, requested_extension = os.path.splitext(constructed_filename)
+            ranges = parse_range_header(range_header)
+            logging.debug("Requested ranges {}".format(ranges))
+
+        # Look up the requested file in the library's path index: a graphic, or a song in its own format, by its
+        # constructed path.  A song requested in another format is found by its simplified name in its directory.
+        paths = library.paths
+        constructed_filepath = name.lstrip("/")
+        basename, requested_extension = os.path.splitext(constructed_filepath)
+        path = paths.get(constructed_filepath)
+        if path is None:
+            dir_path, _, simplified_name = basename.rpartition("/")
+            node = paths.get(dir_path + "/" if dir_path else "")
+            if node is not None and node.kind == "dir":
+                path = node.media.get(simplified_name)
+        kind = path.kind if path is not None else None
 
         found = False
 
-        # If the requested file is the graphic in this directory
-        if constructed_filename == base_dict["graphic_name"]:
-            filepath = base_dict["graphic_filepath"]
-            self.send_file(filepath, range_start, range_end)
+        # A thumbnail of album art is asked for with the size in the query
+        thumbnail_size = self.thumbnail_size(query)
+
+        # If the requested file is a graphic
+        if kind == "graphic":
+            filepath = path.filepath
+            if thumbnail_size:
+                self.send_thumbnail(filepath, thumbnail_size, filepath)
+            else:
+                self.send_file(filepath, ranges, mime_type=path.mime_type)
             found = True
-        else:
-            # Find the song in the dictionary (display name is key) and get its real filepath (the value)
-            media = base_dict["media"]
-            if basename in media.keys():
-                filepath = media[basename][1]
-
-                # If the file is already in the requested format, just send it
-                actual_extension = os.path.splitext(filepath)[1]
-                if (actual_extension == requested_extension):
-                    self.send_file(filepath, range_start, range_end)
-                    found = True
-                # Otherwise if the requested format is a supported type, transcode and send 
-                elif MAX_SIMULTANEOUS_TRANSCODES and requested_extension in (".ogg", ".mp3"):
-                    self.send_transcoded_file(name, filepath, requested_extension, range_start, range_end)
-                    self.housekeep_transcoders()
+        elif kind == "song":
+            filepath = path.filepath
+            actual_extension = path.extension
+            if thumbnail_size and actual_extension == requested_extension:
+                # The cover art embedded in the song, or the default image if there is none
+                self.send_thumbnail(filepath, thumbnail_size, os.path.join(script_path, "munic.png"))
+                found = True
+            # If the file is already in the requested format, just send it
+            elif (actual_extension == requested_extension):
+                self.send_file(filepath, ranges, mime_type=path.mime_type)
+                found = True
+            # Otherwise if the requested format is a supported type, transcode and send 
+            elif MAX_SIMULTANEOUS_TRANSCODES:
+                profile = self.transcode_profile(query)
+                if profile and requested_extension in TRANSCODE_PROFILES[profile]["formats"]:
+                    self.send_transcoded_file(name, filepath, requested_extension, profile, ranges,
+                                              self.transcode_vary(query))
                     found = True
 
         if not found:
             logging.warning("File {}{} not found in library".format(basename, requested_extension))
             self.send_response(404)
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
+
+    def thumbnail_size(self, query):
+        "Returns the size of thumbnail asked for in the query, or None if there is none (or it is not one of the sizes made)."
+        try:
+            size = int(urllibparse.parse_qs(query).get("thumb", ["0"])[0])
+        except ValueError:
+            return None
+        return size if size in (THUMBNAIL_LINK_SIZE, THUMBNAIL_SONG_SIZE) else None
+
+    def send_thumbnail(self, filepath, size, fallback_filepath):
+        "Sends a thumbnail of the image (or the art embedded in the music file) filepath, or the file fallback_filepath if one cannot be made."
+        extension = ".webp" if "image/webp" in self.headers.get("Accept", "") else ".jpg"
+        thumbnail_filepath = thumbnailer.get(filepath, size, extension)
+        # (The type of thumbnail depends on the Accept header)
+        if thumbnail_filepath:
+            self.send_file(thumbnail_filepath, vary="Accept")
+        else:
+            # The thumbnail is being made in the background (or cannot be made).  The browser must check again next time.
+            self.send_file(fallback_filepath, vary="Accept", cache_control="no-cache")
+
+    def transcode_vary(self, query):
+        "Returns the Vary header for a transcode: the request headers which choose its profile if the query does not name one (see transcode_profile), otherwise None."
+        return None if "profile" in urllibparse.parse_qs(query) else "Save-Data, ECT"
+
+    def transcode_profile(self, query):
+        "Returns the name of the transcode profile to use: the one in the query, or the default for the client. None if the query names an unknown one."
+        profile = urllibparse.parse_qs(query).get("profile", [None])[0]
+        if profile is not None:
+            if profile not in TRANSCODE_PROFILES:
+                logging.warning("Unknown transcode profile {}".format(profile))
+                return None
+            return profile
+        if (self.headers.get("Save-Data", "").strip().lower() == "on"
+            or self.headers.get("ECT", "").strip().lower() in SAVE_DATA_CONNECTION_TYPES):
+            return TRANSCODE_SAVE_DATA_PROFILE
+        return TRANSCODE_DEFAULT_PROFILE
+
+    def send_file_data(self, f, offset, length):
+        "Sends length bytes of the open file f, from offset. On return (or exception), f is positioned after the last byte sent."
+        if self.response_buffer is not None:
+            # The event loop will send it (with sendfile), after the rest of the response so far
+            self.response_buffer.add_file(f, offset, length)
+            f.seek(offset + length)
+            return
+
+        if not USE_HTTPS:
+            # Have the kernel copy straight from the file to the socket (using sendfile), without the data passing
+            # through Python at all
+            self.connection.sendfile(f, offset, length)
+            return
+
+        # The data must be encrypted, so copy it through a buffer, a large block at a time
+        f.seek(offset)
+        buffer = memoryview(bytearray(SEND_FILE_BUFFER_SIZE))
+        while length > 0:
+            length_read = f.readinto(buffer[:min(SEND_FILE_BUFFER_SIZE, length)])
+            if not length_read:
+                logging.warning("File ended {} bytes early".format(length))
+                break
+            self.wfile.write(buffer[:length_read])
+            length -= length_read
+
+    """ Send a range of the output of a transcode in progress: the bytes which exist, waiting briefly for any which are
+    about to be produced.  A range far ahead of the transcode is served by a new job, transcoding from the corresponding
+    time.  At most TRANSCODE_RANGE_SIZE bytes are sent; the client asks for more as it needs them. """
+    def send_transcoder_range(self, transcoder, byte_range, mime_type, vary = None):
+        first, last = byte_range
+        job = transcoder
+        if first - transcoder.origin > transcoder.produced() + transcoder.bytes_per_second() * TRANSCODE_SEEK_AHEAD_TIME:
+            job = transcode_scheduler.seek(transcoder, first)
+        try:
+            self.after_transcoder(job, job.started, TRANSCODE_QUEUE_TIMEOUT,
+                                  lambda: self.send_started_transcoder_range(job, byte_range, mime_type, vary))
+        finally:
+            if job is not transcoder:
+                # (The caller releases the original job)
+                transcoder.acquire()
+                job.release()
+
+    """ Send a range of the output of a job (see send_transcoder_range()) once it has started """
+    def send_started_transcoder_range(self, job, byte_range, mime_type, vary):
+        if not self.check_transcoder_started(job):
+            return
+
+        # Wait for at least the start of the range, then send as much of it as there is.  (A range ahead of the output
+        # waits for a block of it, rather than being sent a few bytes at a time.)
+        # The position in the job's output is relative to its origin.
+        first, last = byte_range
+        position = first - job.origin
+        length = TRANSCODE_RANGE_SIZE if last is None else min(1 + last - first, TRANSCODE_RANGE_SIZE)
+        wanted = position + (1 if position < job.produced() else min(length, TRANSCODE_SEND_SIZE))
+        self.after_transcoder(job, lambda: job.reached(wanted), TRANSCODE_SEEK_WAIT,
+                              lambda: self.send_produced_transcoder_range(job, first, position, length, mime_type, vary))
+
+    """ Send up to 'length' bytes of the output of a job from 'position' (byte 'first' of the whole output), as much of
+    it as has been produced """
+    def send_produced_transcoder_range(self, job, first, position, length, mime_type, vary):
+        try:
+            data = job.read(position, length, 0)
+
+            if not data:
+                if job.state == Transcoder.FINISHED and not job.origin:
+                    # The range is beyond the end of the complete output
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{}".format(job.produced()))
+                else:
+                    logging.warning("Transcode of {} did not reach byte {}".format(job.requested_filepath, first))
+                    self.send_response(503)
+                    self.send_header("Retry-After", 1)
+                self.send_header("Content-Length", 0)
+                self.end_headers()
+                return
+
+            # The complete length is only known once the transcode has finished
+            complete_length = job.produced() if job.state == Transcoder.FINISHED and not job.origin else "*"
+            logging.info("Sending transcoded range {}-{}/{}".format(first, first + len(data) - 1, complete_length))
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(first, first + len(data) - 1, complete_length))
+            self.send_header("Content-Length", len(data))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Cache-Control", "no-cache")
+            if vary:
+                self.send_header("Vary", vary)
+            if mime_type:
+                self.send_header("Content-Type", mime_type)
             self.end_headers()
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            logging.warning("Connection lost sending transcoded range of {}".format(job.requested_filepath))
+
+    """ Call then() once ready() (called with the job's condition held) is true, or after 'timeout' seconds.  With the
+    AsyncServer the event loop does the waiting, and then() is called later, on a worker thread, to write the rest of
+    the response: so waiting for a transcode holds none of its few threads. """
+    def after_transcoder(self, job, ready, timeout, then):
+        if self.response_buffer is not None and not job.wait_until(ready, 0):
+            self.response_buffer.add_wait(job, ready, timeout, then)
             return
+        job.wait_until(ready, timeout)
+        then()
+
+    """ Check that a job which has been waited for has started.  If it is still queued, sends 503 and returns False. """
+    def check_transcoder_started(self, job):
+        if job.started():
+            return True
+        logging.warning("Transcode of {} still queued after {}s".format(job.requested_filepath, TRANSCODE_QUEUE_TIMEOUT))
+        self.send_response(503)
+        self.send_header("Retry-After", TRANSCODE_QUEUE_TIMEOUT)
+        self.send_header("Content-Length", 0)
+        self.end_headers()
+        return False
+
+    def client_disconnected(self):
+        "Returns True if the client has closed the connection. (Only useful while we are not expecting a request.)"
+        try:
+            readable, _, _ = select.select([self.connection], [], [], 0)
+            return bool(readable) and not self.connection.recv(1, socket.MSG_PEEK)
+        except (OSError, ValueError):
+            return True
 
     def send_html(self, htmlstr):
-        "Simply sends htmlstr with status 200 and the correct content-type and content-length."
+        "Simply sends htmlstr (a string, or already-encoded bytes) with status 200 and the correct content-type and content-length."
 
         # Encode the HTML
-        encoded = htmlstr.encode("utf-8")
+        encoded = htmlstr.encode("utf-8") if isinstance(htmlstr, str) else htmlstr
         logging.info("Sending HTML ({} bytes)".format(len(encoded)))
+        self.send_compressed(encoded, HTML_CONTENT_TYPE)
+
+    def send_json(self, obj, etag = None):
+        "Sends obj, encoded as JSON, with status 200 and the correct content-type and content-length."
+        encoded = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        logging.info("Sending JSON ({} bytes)".format(len(encoded)))
+        self.send_compressed(encoded, "application/json; charset=utf-8", etag, PAGE_CACHE_CONTROL if etag else None)
+
+    def accepted_encoding(self):
+        "Returns the content encoding to compress the response with, according to the request, or None."
+        return choose_encoding(self.headers.get("Accept-Encoding"))
+
+    def send_compressed(self, encoded, content_type, etag = None, cache_control = None):
+        "Sends encoded (bytes) with status 200, compressed if it is worth it and the client accepts that."
+        encoding = self.accepted_encoding() if len(encoded) >= COMPRESSION_MIN_BYTES else None
+        if encoding:
+            encoded = compress(encoded, encoding)
+        self.send_encoded(encoded, content_type, encoding, etag, cache_control)
+
+    def send_encoded(self, encoded, content_type, encoding, etag = None, cache_control = None):
+        "Sends encoded (bytes, already compressed with the content encoding 'encoding', or None) with status 200."
+        if encoding:
+            logging.debug("Sending {} bytes compressed with {}".format(len(encoded), encoding))
 
         self.send_response(200)
         self.send_header("Content-Length", len(encoded))
-        self.send_header("Content-Type", 'text/html; charset=utf-8')
+        self.send_header("Content-Type", content_type)
+        if content_type == HTML_CONTENT_TYPE:
+            self.send_header("Accept-CH", ACCEPT_CLIENT_HINTS)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_cache_headers(etag, None, cache_control)
         self.end_headers()
 
         self.wfile.write(encoded)
 
+    def send_static(self, static_file, query):
+        "Sends a static file from memory. If it was requested by its versioned URL, the browser may cache it forever."
+        versioned = urllibparse.parse_qs(query).get("v") == [static_file.version]
+        cache_control = STATIC_CACHE_CONTROL if versioned else "no-cache"
+        encoding = self.accepted_encoding()
+        etag = static_file.etag(encoding)
+        if self.check_not_modified(etag, None, cache_control):
+            return
+        self.send_encoded(static_file.encoded[encoding], static_file.mime_type, encoding, etag, cache_control)
+
+    def send_cache_headers(self, etag, last_modified, cache_control):
+        "Sends the headers which let the browser cache a response and check whether its copy is current."
+        if etag:
+            self.send_header("ETag", etag)
+        if last_modified is not None:
+            self.send_header("Last-Modified", email.utils.formatdate(last_modified, usegmt=True))
+        if cache_control:
+            self.send_header("Cache-Control", cache_control)
+        self.send_header("Vary", "Accept-Encoding")
+
+    def check_not_modified(self, etag, last_modified, cache_control):
+        "If the browser's copy is current (according to If-None-Match or If-Modified-Since), sends 304 and returns True."
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = parse_http_date(self.headers.get("If-Modified-Since"))
+        # If-Modified-Since is only used if there is no If-None-Match
+        if if_none_match is not None:
+            current = etag_matches(if_none_match, etag)
+        elif last_modified is not None and if_modified_since is not None:
+            current = int(last_modified) <= if_modified_since
+        else:
+            current = False
+
+        if current:
+            logging.info("Not modified")
+            self.send_response(304)
+            self.send_cache_headers(etag, last_modified, cache_control)
+            self.end_headers()
+        return current
+
+    """ Write one chunk of a response sent with chunked transfer encoding.  An empty chunk marks the end. """
+    def write_chunk(self, data):
+        self.wfile.write("{:x}\r\n".format(len(data)).encode("utf-8"))
+        self.wfile.write(data)
+        self.wfile.write(b"\r\n")
+
     """Send the specified file with status 200. and correct content-type and content-length."""
-    def send_file(self, filepath, range_start:int = None, range_end:int = None):
+    def send_file(self, filepath, ranges = None, vary = None, mime_type = None, cache_control = FILE_CACHE_CONTROL):
+        # ranges is the list of byte ranges requested, as returned by parse_range_header(), or None for the whole file.
+        # vary is the value for a Vary header, if the file sent depends on request headers.
+        # mime_type is the file's type, if already known (e.g. from the library's path index).
+        # cache_control is the value for the Cache-Control header.
         logging.info("Sending file {}".format(filepath))
         media_gets[threading.get_ident()] = filepath
+        try:
+            self.send_file_ranges(filepath, ranges, vary, mime_type, cache_control)
+        finally:
+            media_gets.pop(threading.get_ident(), None)
+        logging.info("File send finished on thread {}".format(threading.get_ident()))
+        logging.debug("Ongoing transfers: " + str(media_gets))
 
-        # Was a range requested?
-        range_requested = True if range_start is not None or range_end is not None else False
-
+    def send_file_ranges(self, filepath, ranges, vary = None, mime_type = None, cache_control = FILE_CACHE_CONTROL):
         # Get the mime type of the file
-        mime_type, encoding = mimetypes.guess_type(filepath)
+        if mime_type is None:
+            mime_type = guess_mime_type(filepath)
 
         with open(filepath, 'rb') as f:
             # If the file is not seekable, send the whole thing.
             # (We could read and discard if this is a problem, but it is not expected to happen.)
-            if range_requested and not f.seekable():
+            if ranges is not None and not f.seekable():
                 logging.warning("File not seekable: not sending range")
-                range_requested = False
-                range_start = None
-                range_end = None
+                ranges = None
 
             # Find the length of the file
-            file_length = os.fstat(f.fileno()).st_size
+            stat = os.fstat(f.fileno())
+            file_length = stat.st_size
             logging.debug("File length: {}".format(file_length))
 
-            # Populate ranges if not already done
-            if range_start is None:
-                range_start = 0
-            if range_end is None:
-                range_end = file_length - 1
-            # Sanity check them
-            if range_start>range_end or range_start<0 or range_end>=file_length:
-                self.send_response(416)
-                self.end_headers()
+            # If the browser's copy is current, there is nothing to send
+            etag = '"{:x}-{:x}"'.format(stat.st_mtime_ns, file_length)
+            if self.check_not_modified(etag, stat.st_mtime, cache_control):
                 return
 
-            if range_requested:
+            # Only send a range if the browser's partial copy (identified by If-Range) is current: otherwise send it all
+            if_range = self.headers.get("If-Range")
+            if ranges is not None and if_range:
+                if if_range.startswith('"'):
+                    current = if_range == etag
+                else:
+                    current = parse_http_date(if_range) == int(stat.st_mtime)
+                if not current:
+                    logging.info("If-Range does not match: sending entire file")
+                    ranges = None
+
+            # Work out which bytes to send
+            byte_ranges = None
+            if ranges is not None:
+                byte_ranges = resolve_ranges(ranges, file_length)
+                if not byte_ranges:
+                    logging.info("Range not satisfiable: {} for length {}".format(ranges, file_length))
+                    self.send_response(416)
+                    self.send_header("Content-Range", "bytes */{}".format(file_length))
+                    self.send_header("Content-Length", 0)
+                    self.end_headers()
+                    return
+                # Lots of little ranges would cost more than sending the whole file
+                if len(byte_ranges) > MAX_RANGES:
+                    logging.warning("Too many ranges ({}): sending entire file".format(len(byte_ranges)))
+                    byte_ranges = None
+
+            if byte_ranges is None:
+                logging.info("Sending entire file")
+                parts = [ (0, file_length, b"") ]
+                content_length = file_length
+                self.send_response(200)
+            elif len(byte_ranges) == 1:
+                range_start, range_end = byte_ranges[0]
+                parts = [ (range_start, 1 + range_end - range_start, b"") ]
                 content_length = 1 + range_end - range_start
                 logging.info("Sending range {}-{} ({} bytes) out of {}".format(range_start, range_end, content_length, file_length))
                 self.send_response(206) # Partial content
                 self.send_header("Content-Range", "bytes {}-{}/{}".format(range_start, range_end, file_length))
             else:
-                logging.info("Sending entire file")
-                content_length = file_length
-                self.send_response(200)
+                # Several ranges: send them as the parts of a multipart/byteranges body, each with its own headers
+                boundary = uuid.uuid4().hex
+                parts = [ (range_start, 1 + range_end - range_start,
+                           "\r\n--{}\r\n{}Content-Range: bytes {}-{}/{}\r\n\r\n"
+                           .format(boundary, "Content-Type: {}\r\n".format(mime_type) if mime_type else "",
+                                   range_start, range_end, file_length).encode("utf-8"))
+                          for range_start, range_end in byte_ranges ]
+                closing = "\r\n--{}--\r\n".format(boundary).encode("utf-8")
+                content_length = sum(length + len(part_header) for start, length, part_header in parts) + len(closing)
+                logging.info("Sending {} ranges ({} bytes) out of {}".format(len(parts), content_length, file_length))
+                self.send_response(206) # Partial content
+                mime_type = "multipart/byteranges; boundary=" + boundary
 
             self.send_header("Accept-Ranges", 'bytes')
             self.send_header("Content-Length", content_length)
-            self.send_header("Cache-Control", "max-age=1000")
+            if vary:
+                self.send_header("Vary", vary)
+            self.send_cache_headers(etag, stat.st_mtime, cache_control)
             if mime_type:
                 self.send_header("Content-Type", mime_type)
             self.end_headers()
 
+            total_sent = 0
             try:
-                # Seek to the desired start (lazily just asusming it worked)
-                f.seek(range_start)
-
-                # Read and send 16kB at a time
-                total_sent = 0
-                while content_length > 0:
-                    length_to_read = min(16384, content_length)
-                    data = f.read(length_to_read)
-                    length_read = len(data)
-                    self.wfile.write(data)
-                    content_length -= length_read
-                    total_sent += length_read
-
+                for start, length, part_header in parts:
+                    self.wfile.write(part_header)
+                    try:
+                        self.send_file_data(f, start, length)
+                    finally:
+                        total_sent += f.tell() - start
+                if len(parts) > 1:
+                    self.wfile.write(closing)
                 logging.info("Successfully sent file {}".format(filepath))
             except BrokenPipeError:
                 logging.warning("Broken pipe error sending {} after {} bytes".format(filepath, total_sent))
             except ConnectionResetError:
                 logging.warning("Connetion reset by peer sending {} after {} bytes".format(filepath, total_sent))
-        logging.info("File send finished on thread {}".format(threading.get_ident()))
-        media_gets.pop(threading.get_ident())
-        logging.debug("Ongoing transfers: " + str(media_gets))
 
     """ Send the given file, transcoded to the specified format"""
-    def send_transcoded_file(self, requested_filepath, source_filepath, requested_extension, range_start:int = None, range_end:int = None):
-        logging.info("Sending transcoded file {} -> {}".format(source_filepath, requested_filepath))
-
-        # Get the existing transcoder if it exists
-        try:
-            transcoder = transcoders_cache[requested_filepath]
-        except KeyError:
-            # Else create a new one and store it
-            transcoder = Transcoder(requested_filepath, source_filepath, requested_extension)
-            transcoders_cache[requested_filepath] = transcoder
+    def send_transcoded_file(self, requested_filepath, source_filepath, requested_extension, profile, ranges = None, vary = None):
+        # vary is the value for a Vary header, if the profile was chosen by request headers
+        logging.info("Sending transcoded file {} -> {} ({})".format(source_filepath, requested_filepath, profile))
 
-        # Put the transcoder at the end of the appropriate "to keep" list
-        self.refresh_transcoder(transcoder)
+        cache_key = transcode_cache.key(source_filepath, requested_extension, transcode_args(profile, requested_extension))
+        if not cache_key:
+            logging.warning("Cannot read {} to transcode it".format(source_filepath))
+            self.send_response(404)
+            self.send_header("Content-Length", 0)
+            self.end_headers()
+            return
 
-        # Housekeep existing transcoders after (possibly) adding one
-        self.housekeep_transcoders()
+        # When a track is started, the ones after it are got ready (after it, in the queue)
+        track_started = ranges is None or ranges[0][0] == 0
+
+        # If this file has been transcoded before, send the result without transcoding it again
+        cached_filepath = transcode_cache.get(cache_key, requested_extension)
+        if cached_filepath:
+            logging.info("Sending cached transcode {}".format(cached_filepath))
+            transcode_scheduler.cached_transcode_used(cache_key)
+            if track_started:
+                self.prefetch_following(requested_filepath, requested_extension, profile)
+            self.send_file(cached_filepath, ranges, vary)
+            return
 
-        # Get the name of the transcoded file (also waits for it to be created)
-        transcoded_filepath = transcoder.get_transcoded_filepath()
+        # A range which a job transcoding from part way through the file is producing (or will soon) is sent from it
+        if ranges is not None and len(ranges) == 1 and ranges[0][0]:
+            transcoder = transcode_scheduler.request_seek(cache_key, ranges[0][0])
+            if transcoder:
+                try:
+                    self.send_transcoder_range(transcoder, ranges[0], guess_mime_type(requested_filepath), vary)
+                finally:
+                    transcoder.release()
+                return
 
-        # If the file was not created, send a 404.  Note that it could just be very slow.
-        if not transcoded_filepath:
-            logging.warning("Transcoded file not found")
-            self.send_response(404)
-            self.end_headers
+        # Get the job transcoding this file (which may have been started by another client), or start one
+        transcoder = transcode_scheduler.request(cache_key, requested_filepath, source_filepath, requested_extension, profile,
+                                                 TranscodeScheduler.PRIORITY_PLAY)
+        if track_started:
+            self.prefetch_following(requested_filepath, requested_extension, profile)
+        try:
+            self.send_transcoder_output(transcoder, ranges, vary)
+        finally:
+            transcoder.release()
+
+    """ Queue prefetch transcodes of the PREFETCH_TRACKS tracks after the requested one in its directory (in playlist
+    order), in the same format and profile, if they need transcoding and are not in the transcode cache """
+    def prefetch_following(self, requested_filepath, requested_extension, profile):
+        for following_filepath, source_filepath in get_following_songs(library, requested_filepath, PREFETCH_TRACKS):
+            if os.path.splitext(source_filepath)[1] == requested_extension:
+                continue
+            cache_key = transcode_cache.key(source_filepath, requested_extension, transcode_args(profile, requested_extension))
+            if cache_key and not transcode_cache.contains(cache_key, requested_extension):
+                transcode_scheduler.prefetch(cache_key, os.path.splitext(following_filepath)[0] + requested_extension,
+                                             source_filepath, requested_extension, profile)
+
+    """ Send the output of a transcode job, as it is produced.  vary is the value for a Vary header, if any. """
+    def send_transcoder_output(self, transcoder, ranges, vary = None):
+        # Wait for the job to start: there may be others ahead of it in the queue
+        self.after_transcoder(transcoder, transcoder.started, TRANSCODE_QUEUE_TIMEOUT,
+                              lambda: self.send_started_transcoder_output(transcoder, ranges, vary))
+
+    """ Send the output of a job (see send_transcoder_output()) once it has started """
+    def send_started_transcoder_output(self, transcoder, ranges, vary):
+        requested_filepath = transcoder.requested_filepath
+        if not self.check_transcoder_started(transcoder):
             return
 
         # If the transcode has already finished, send it as a regular file -- offering ranges
         if transcoder.transcode_finished():
-            self.send_file(transcoded_filepath, range_start, range_end)
+            if transcoder.state == Transcoder.FINISHED:
+                self.send_file(transcoder.out_file, ranges, vary)
+            else:
+                logging.warning("Transcode {} without creating the destination file".format(transcoder.state))
+                self.send_response(404)
+                self.send_header("Content-Length", 0)
+                self.end_headers()
             return
 
         # Get the mime type of the transcoded file
-        mime_type, encoding = mimetypes.guess_type(requested_filepath)
+        mime_type = guess_mime_type(requested_filepath)
 
-        with open(transcoded_filepath, 'rb') as f:
-            self.send_response(200)
-            self.send_header("Cache-Control", "max-age=1000")
-            if mime_type:
-                self.send_header("Content-Type", mime_type)
-            self.send_header("Transfer-Encoding", "chunked")
-            self.end_headers()
+        # A single range from a given position can be served while transcoding.  (Others need the length, which is not
+        # known yet, so the whole output is sent, as if no range was requested.  So is "bytes=0-": streaming it is
+        # quicker to start, and the client does not have to ask for each block.)
+        if ranges is not None and len(ranges) == 1 and ranges[0][0] is not None and ranges[0] != (0, None):
+            self.send_transcoder_range(transcoder, ranges[0], mime_type, vary)
+            return
 
-            total_sent = 0
-            FIRST_CHUNK_SIZE = 131072 # 128kB in first chunk 
-            TRANSCODING_CHUNK_SIZE = 65536  # 64kB at a time while transcoding
-            TRANSCOMPLETE_CHUNK_SIZE = 131072  # 128kB chunks once transcode has finished
-            time.sleep(1)
-            try:
-                # While we are still transcoding, send a chunk at a time
-                chunk_size = FIRST_CHUNK_SIZE
-                while not transcoder.transcode_finished():
-                    file_length_remaining = os.fstat(f.fileno()).st_size - f.tell()
-                    if file_length_remaining >= chunk_size:
-                        data = f.read(chunk_size)
-                        length_read = len(data)
-                        chunk_size_string = "%x\r\n" % length_read
-                        self.wfile.write(chunk_size_string.encode("utf-8"))
-                        self.wfile.write(data)
-                        self.wfile.write("\r\n".encode("utf-8"))
-                        self.wfile.flush()
-                        total_sent += length_read
-                        chunk_size = TRANSCODING_CHUNK_SIZE
-                    else:
-                        time.sleep(0.5)
-
-                # In case this transcode was not one of the "to keep" ones (becuase there were more than
-                # MAX_SIMULTANEOUS_TRANSCODES connections), add it to the completed "to keep" list
-                self.refresh_transcoder(transcoder)
-
-                # Send the rest
-                chunk_size = TRANSCOMPLETE_CHUNK_SIZE
-                # While there is file remaining
-                file_remaining = os.fstat(f.fileno()).st_size - f.tell()
-                while file_remaining > 0:
-                    length_to_read = min(chunk_size, file_remaining)
-                    data = f.read(length_to_read)
-                    length_read = len(data)
-                    chunk_size_string = "%x\r\n" % length_read
-                    self.wfile.write(chunk_size_string.encode("utf-8"))
-                    self.wfile.write(data)
-                    self.wfile.write("\r\n".encode("utf-8"))
-                    total_sent += length_read
-                    file_remaining = os.fstat(f.fileno()).st_size - f.tell()
-
-                # Send an empty chunk to indicate the end of file
-                self.wfile.write("0\r\n\r\n".encode("utf-8"))
-
-                logging.info("Successfully sent transcoded file ({} bytes)".format(total_sent))
-            except BrokenPipeError:
-                logging.warning("Broken pipe error sending {} after {} bytes".format(requested_filepath, total_sent))
-            except ConnectionResetError:
-                logging.warning("Connetion reset by peer sending {} after {} bytes".format(requested_filepath, total_sent))
+        self.send_response(200)
+        self.send_header("Cache-Control", "max-age=1000")
+        if vary:
+            self.send_header("Vary", vary)
+        self.send_header("Accept-Ranges", "bytes")
+        if mime_type:
+            self.send_header("Content-Type", mime_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        # The event loop can send the output, without holding this thread while it waits for it
+        if self.response_buffer is not None:
+            self.response_buffer.add_transcoder(transcoder)
+            return
 
-    """ Put the given transcoder at the end of the appropriate to-keep list"""
-    def refresh_transcoder(self, transcoder):
-        # Remove the transcoder from any of the "to keep" lists it is in.
-        # (We will add it at the end below.)
+        # Send the output as it is produced
+        total_sent = 0
         try:
-            running_transcoders_to_keep.remove(transcoder)
-        except ValueError:
-            pass
+            while True:
+                data = transcoder.read(total_sent, TRANSCODE_SEND_SIZE, timeout=1)
+                if data is None:
+                    if transcoder.transcode_finished():
+                        # Failed or cancelled: close the connection without ending the response, so that the client
+                        # knows it is incomplete
+                        logging.warning("Transcode {} after sending {} bytes".format(transcoder.state, total_sent))
+                        self.close_connection = True
+                        return
+                    if self.client_disconnected():
+                        # Stop waiting, so that the transcode can be cancelled if nobody else wants it
+                        logging.warning("Client disconnected waiting for {} after {} bytes".format(requested_filepath, total_sent))
+                        return
+                    continue
+                if not data:
+                    break
+                self.write_chunk(data)
+                total_sent += len(data)
+
+            # Send an empty chunk to indicate the end of file
+            self.write_chunk(b"")
+
+            logging.info("Successfully sent transcoded file ({} bytes)".format(total_sent))
+        except BrokenPipeError:
+            logging.warning("Broken pipe error sending {} after {} bytes".format(requested_filepath, total_sent))
+        except ConnectionResetError:
+            logging.warning("Connetion reset by peer sending {} after {} bytes".format(requested_filepath, total_sent))
+
+class ThreadingSimpleServer(HTTPServer):
+    """ An HTTP server which handles connections on a fixed pool of threads, so that however many connections there are
+    (a menu page can have hundreds of images), the number of threads, and so the memory used, stays the same.
+    Accepted connections wait in a queue for a thread.  When that is full, or the client already has too many
+    connections, the connection is sent 503 with Retry-After, and closed.  (See SERVER_THREADS etc.) """
+
+    # The listen backlog: connections not yet accepted
+    request_queue_size = 128
 
+    """ Constructor """
+    def __init__(self, server_address, handler_class, num_threads = SERVER_THREADS, queue_size = SERVER_QUEUE_SIZE):
+        super().__init__(server_address, handler_class)
+        self.num_threads = num_threads
+        # The connections waiting for a thread: (socket, client address)
+        self.queue = queue.Queue(queue_size)
+        self.lock = threading.Lock()
+        # The number of connections (queued or being handled) from each client address
+        self.client_connections = collections.Counter()
+        self.rejected = 0
+        for i in range(num_threads):
+            threading.Thread(target=self.work, name="Server{}".format(i), daemon=True).start()
+
+    """ Queue an accepted connection for a thread, or refuse it """
+    def process_request(self, request, client_address):
+        host = client_address[0]
+        with self.lock:
+            too_many = MAX_CONNECTIONS_PER_CLIENT and self.client_connections[host] >= MAX_CONNECTIONS_PER_CLIENT
+            if not too_many:
+                self.client_connections[host] += 1
+        if too_many:
+            self.refuse(request, "{} already has {} connections".format(host, MAX_CONNECTIONS_PER_CLIENT))
+            return
         try:
-            completed_transcoders_to_keep.remove(transcoder)
-        except ValueError:
+            self.queue.put_nowait((request, client_address))
+        except queue.Full:
+            self.connection_closed(host)
+            self.refuse(request, "all threads busy, and {} connections waiting".format(self.queue.qsize()))
+
+    """ Send 503 on a new connection, and close it """
+    def refuse(self, request, reason):
+        logging.warning("Refusing connection: {}".format(reason))
+        with self.lock:
+            self.rejected += 1
+        try:
+            # Read what has arrived of the request, so that closing the connection does not reset it before the client
+            # has read the response
+            request.setblocking(False)
+            try:
+                request.recv(65536)
+            except BlockingIOError:
+                pass
+            request.send("HTTP/1.1 503 Service Unavailable\r\nRetry-After: {}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"
+                         .format(SERVER_BUSY_RETRY_AFTER).encode("utf-8"))
+        except OSError:
             pass
+        self.shutdown_request(request)
 
-        if transcoder.transcode_finished():
-            completed_transcoders_to_keep.append(transcoder)
-        else:
-            running_transcoders_to_keep.append(transcoder)
-
-    """ Housekeep the list of transcoders:
-        - Move completed ones to the completed "to keep" list.
-        - Remove the oldest in each "to keep" list if we have too many. """
-    def housekeep_transcoders(self):
-        global running_transcoders_to_keep, completed_transcoders_to_keep
-        # Move any completed transcodes from the running to the completed "to keep" list
-        for t in running_transcoders_to_keep:
-            if t.transcode_finished():
-                logging.debug("Moving transcode {} from running list to completed".format(t.requested_filepath))
-                running_transcoders_to_keep.remove(t)
-                completed_transcoders_to_keep.append(t)
-
-        # Prune the lists of transoders
-        running_transcoders_to_keep = running_transcoders_to_keep[-MAX_SIMULTANEOUS_TRANSCODES:]
-        completed_transcoders_to_keep = completed_transcoders_to_keep[-MAX_COMPLETED_TRANSCODES:]
+    """ Worker thread: handle connections from the queue, one at a time """
+    def work(self):
+        while True:
+            request, client_address = self.queue.get()
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+                self.connection_closed(client_address[0])
+
+    def connection_closed(self, host):
+        with self.lock:
+            self.client_connections[host] -= 1
+            if not self.client_connections[host]:
+                del self.client_connections[host]
+
+    """ Are there connections waiting for a thread?  (Then idle keep-alive connections should make way.) """
+    def busy(self):
+        return not self.queue.empty()
+
+    """ Statistics for monitoring """
+    def status(self):
+        with self.lock:
+            return { "threads":self.num_threads,
+                     "connections":sum(self.client_connections.values()),
+                     "waiting":self.queue.qsize(),
+                     "clients":len(self.client_connections),
+                     "rejected":self.rejected }
+
+class ResponseBuffer:
+    """ A response made by a Handler for the AsyncServer: the bytes written to it (as the handler's wfile), and the parts
+    of files and transcodes to send after them, which the event loop sends without a thread. """
 
-        # Items with no remaining references will magically disappear from the transcoders_cache
+    """ Constructor """
+    def __init__(self):
+        # A list of bytes, (file, offset, length), transcoders and TranscoderWaits, to send in order.  (A wait's then()
+        # appends to it while it is being sent.)
+        self.parts = []
+
+    def write(self, data):
+        if self.parts and isinstance(self.parts[-1], bytearray):
+            self.parts[-1] += data
+        else:
+            self.parts.append(bytearray(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    """ Add length bytes of the open file f from offset.  The loop sends them from a file of its own, and closes it. """
+    def add_file(self, f, offset, length):
+        self.parts.append((os.fdopen(os.dup(f.fileno()), "rb"), offset, length))
+
+    """ Add the output of a transcode, sent as it is produced with chunked transfer encoding.  The job is acquired
+    until it has been sent. """
+    def add_transcoder(self, transcoder):
+        transcoder.acquire()
+        self.parts.append(transcoder)
+
+    """ Add a wait until ready() (called with the transcode job's condition held) is true, or for up to 'timeout'
+    seconds, after which then() is called on a worker thread to write the rest of the response here.  The loop does the
+    waiting, without a thread.  The job is acquired until the response has been sent. """
+    def add_wait(self, transcoder, ready, timeout, then):
+        transcoder.acquire()
+        self.parts.append(TranscoderWait(transcoder, ready, timeout, then))
+
+    """ Give up on what has not been sent """
+    def discard(self):
+        for part in self.parts:
+            if isinstance(part, tuple):
+                part[0].close()
+            elif isinstance(part, Transcoder):
+                part.release()
+            elif isinstance(part, TranscoderWait):
+                part.transcoder.release()
+        self.parts = []
+
+class TranscoderWait:
+    """ A wait for a transcode job in a ResponseBuffer (see ResponseBuffer.add_wait()) """
+    __slots__ = ("transcoder", "ready", "timeout", "then")
 
-        logging.debug("Running transcoders to keep: {}, completed: {}, cache: {}"
-            .format(len(running_transcoders_to_keep), len(completed_transcoders_to_keep), len(transcoders_cache)))
+    """ Constructor """
+    def __init__(self, transcoder, ready, timeout, then):
+        self.transcoder = transcoder
+        self.ready = ready
+        self.timeout = timeout
+        self.then = then
+
+class AsyncServer:
+    """ An HTTP server running on an asyncio event loop.  The loop holds each connection, waiting for requests on it, and
+    each request is handled by handler_class (a Handler) on one of ASYNC_WORKER_THREADS threads, writing the response to
+    a ResponseBuffer.  The loop then sends that, including files (with loop.sendfile) and transcodes (as they are
+    produced).  So a connection only has a thread while its request is being handled, and not while it is idle
+    (between keep-alive requests), waiting for a transcode, or being sent a file or transcode. """
+
+    """ Constructor: listen on the address (host, port) straight away """
+    def __init__(self, server_address, handler_class, ssl_context = None):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(128)
+        self.server_address = self.socket.getsockname()
+        self.handler_class = handler_class
+        self.ssl_context = ssl_context
+        self.executor = concurrent.futures.ThreadPoolExecutor(ASYNC_WORKER_THREADS, thread_name_prefix="Request")
+        self.loop = None
+        self.server = None
+        self.connections = 0
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.server = await asyncio.start_server(self.handle_connection, sock=self.socket, ssl=self.ssl_context)
+        async with self.server:
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                # Closed by shutdown()
+                pass
+
+    """ Statistics for monitoring """
+    def status(self):
+        return { "threads":ASYNC_WORKER_THREADS,
+                 "connections":self.connections }
+
+    """ Stop serving (from another thread) """
+    def shutdown(self):
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.server.close)
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info("peername")
+        self.connections += 1
+        try:
+            while True:
+                # Wait for a request (without a thread), closing the connection if it is idle for KEEPALIVE_TIMEOUT
+                try:
+                    head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logging.debug("Closing idle connection")
+                    break
+                except asyncio.IncompleteReadError:
+                    break
+                except asyncio.LimitOverrunError:
+                    logging.warning("Request headers too long from {}".format(client_address))
+                    break
+
+                # Handle it on a worker thread
+                response = ResponseBuffer()
+                try:
+                    close = await self.loop.run_in_executor(self.executor, self.handle_request, head, response, writer, client_address)
+                except Exception:
+                    logging.exception("Error handling request from {}".format(client_address))
+                    response.discard()
+                    break
+
+                # Send the response
+                if not await self.send_response(reader, writer, response) or close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    """ Handle one request (on a worker thread), writing the response to the response buffer.  Returns whether the
+    connection should then be closed. """
+    def handle_request(self, head, response, writer, client_address):
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.protocol_version = "HTTP/1.1"
+        handler.request = handler.connection = writer.get_extra_info("socket")
+        handler.client_address = client_address
+        handler.server = self
+        handler.rfile = io.BytesIO(head)
+        handler.wfile = handler.response_buffer = response
+        handler.close_connection = True
+        handler.handle_one_request()
+        return handler.close_connection
+
+    """ Send a response.  Returns False if it could not all be sent (and so the connection must be closed). """
+    async def send_response(self, reader, writer, response):
+        try:
+            for part in response.parts:
+                if isinstance(part, bytearray):
+                    writer.write(part)
+                elif isinstance(part, tuple):
+                    f, offset, length = part
+                    await writer.drain()
+                    await self.loop.sendfile(writer.transport, f, offset, length)
+                elif isinstance(part, TranscoderWait):
+                    if not await self.wait_for_transcoder(reader, writer, part):
+                        return False
+                else:
+                    if not await self.send_transcoder_output(reader, writer, part):
+                        return False
+            await writer.drain()
+            return True
+        except ConnectionError:
+            return False
+        finally:
+            response.discard()
+
+    """ Wait, without a thread, for a transcode job as the response asks (see ResponseBuffer.add_wait()), then have the
+    rest of the response written on a worker thread.  Returns False if the client went away, or writing it failed. """
+    async def wait_for_transcoder(self, reader, writer, wait):
+        changed = asyncio.Event()
+        listener = lambda: self.loop.call_soon_threadsafe(changed.set)
+        transcoder = wait.transcoder
+        transcoder.add_listener(listener)
+        try:
+            deadline = self.loop.time() + wait.timeout
+            while True:
+                changed.clear()
+                with transcoder.condition:
+                    if wait.ready():
+                        break
+                remaining = deadline - self.loop.time()
+                if remaining <= 0:
+                    break
+                # Stop waiting if the client has gone, so that the transcode can be cancelled if nobody else wants it
+                if reader.at_eof() or writer.transport.is_closing():
+                    logging.warning("Client disconnected waiting for {}".format(transcoder.requested_filepath))
+                    return False
+                try:
+                    await asyncio.wait_for(changed.wait(), min(remaining, 1))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            transcoder.remove_listener(listener)
 
-class ThreadingSimpleServer(ThreadingMixIn, HTTPServer):
-    pass
+        try:
+            await self.loop.run_in_executor(self.executor, wait.then)
+        except Exception:
+            logging.exception("Error sending {}".format(transcoder.requested_filepath))
+            return False
+        return True
+
+    """ Send the output of a transcode as it is produced, in chunks (the headers having been sent), waiting for it
+    without a thread.  Returns False if the transcode failed, or the client went away. """
+    async def send_transcoder_output(self, reader, writer, transcoder):
+        more = asyncio.Event()
+        listener = lambda: self.loop.call_soon_threadsafe(more.set)
+        transcoder.add_listener(listener)
+        position = 0
+        try:
+            while True:
+                more.clear()
+                data = transcoder.read(position, TRANSCODE_SEND_SIZE, 0)
+                if data is None:
+                    if transcoder.transcode_finished():
+                        logging.warning("Transcode {} after sending {} bytes".format(transcoder.state, position))
+                        return False
+                    # Stop waiting if the client has gone, so that the transcode can be cancelled if nobody else wants it
+                    if reader.at_eof() or writer.transport.is_closing():
+                        logging.warning("Client disconnected waiting for {} after {} bytes".format(transcoder.requested_filepath, position))
+                        return False
+                    try:
+                        await asyncio.wait_for(more.wait(), 1)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                writer.write("{:x}\r\n".format(len(data)).encode("utf-8") + data + b"\r\n")
+                if not data:
+                    logging.info("Successfully sent transcoded file ({} bytes)".format(position))
+                    return True
+                await writer.drain()
+                position += len(data)
+        finally:
+            transcoder.remove_listener(listener)
 
 """Return a simplified (searchable) version of the string, with all accents replaced with un-accented charaters,
 all spaces and punctuation removed, leading 'the' removed, and lower-case"""
@@ -658,171 +2542,1247 @@ def simplify(string):
     string = ''.join([c for c in string if c.isalnum()])    # Remove anything non-alpha-numeric
     return string
 
-""" Get a complete, flat list of all songs in the library.
+# The art to use if there is none: the Munic logo
+DEFAULT_ART = "__ROOT__munic.png"
+
+class LibraryFile:
+    """ A song or graphic in the library.  The directory is the path string of the library index, shared by every file
+    from that directory, and the filename is the index's own string too, so that the full path need not be held for
+    every file.  (Slots, rather than a dict, as there is one of these for every song.) """
+    __slots__ = ("kind", "name", "directory", "filename")
+
+    """ Constructor.  Kind is "song" or "graphic", and name is the display name of a song. """
+    def __init__(self, kind, name, directory, filename):
+        self.kind = kind
+        self.name = name
+        self.directory = directory
+        self.filename = filename
+
+    @property
+    def filepath(self):
+        return os.path.join(self.directory, self.filename)
+
+    @property
+    def extension(self):
+        return os.path.splitext(self.filename)[1]
+
+    @property
+    def mime_type(self):
+        return guess_mime_type(self.filename)
+
+class LibraryNode:
+    """ A directory in the library (see load_library): its display name, songs (by simplified name), subdirectories (by
+    simplified name) and graphic.  Nodes are shared between successive versions of the library, so once a library has
+    been swapped in its nodes are never modified. """
+    __slots__ = ("display_name", "media", "dirs", "graphic")
+    kind = "dir"
+
+    """ Constructor """
+    def __init__(self, display_name, media = None, dirs = None, graphic = None):
+        self.display_name = display_name
+        self.media = media if media is not None else {}
+        self.dirs = dirs if dirs is not None else {}
+        self.graphic = graphic
+
+class Library(LibraryNode):
+    """ The root of the library, which also holds the flattened lists and indexes built by index_library() """
+    __slots__ = ("songs", "graphics", "ranges", "paths", "search", "generation")
+
+    """ Constructor """
+    def __init__(self, display_name, media = None, dirs = None, graphic = None):
+        super().__init__(display_name, media, dirs, graphic)
+        self.songs = []
+        self.graphics = []
+        self.ranges = {}
+        self.paths = {}
+        self.search = None
+        self.generation = None
+
+class NameIndex:
+    """ An index of simplified names (see simplify()) for searching, each identified by its position in the list it was
+    built from.  Names starting with a query are found by bisecting a sorted copy of the names, and names containing
+    it by str.find() over all of them joined into one string, which searches in C: a few milliseconds for the names of
+    400k songs.  (A trigram index of those names took over fifteen times as long to build, and more memory.) """
+
+    """ Constructor """
+    def __init__(self, names):
+        # The names, and their positions in 'names', in alphabetical order
+        order = sorted(range(len(names)), key=names.__getitem__)
+        self.sorted_names = [ names[i] for i in order ]
+        self.order = array.array("I", order)
+        # All the names, each followed by a newline (which a simplified name cannot contain), and where each starts
+        self.joined = "\n".join(names) + "\n"
+        self.starts = array.array("I", itertools.accumulate(itertools.chain((0,), names), lambda start, name: start + len(name) + 1))
+
+    """ Find the names matching the simplified query: those which are equal to it, then those which start with it (in
+    alphabetical order), then those which contain it (in their original order).  Queries of fewer than
+    SEARCH_MIN_SUBSTRING characters only match the starts of names.  Returns a list of the positions of up to 'limit'. """
+    def search(self, query, limit):
+        if not query or limit <= 0:
+            return []
+
+        # Names starting with the query (the one equal to it, if any, first)
+        found = []
+        sorted_names = self.sorted_names
+        i = bisect.bisect_left(sorted_names, query)
+        while i < len(sorted_names) and len(found) < limit and sorted_names[i].startswith(query):
+            found.append(self.order[i])
+            i += 1
+        if len(found) >= limit or len(query) < SEARCH_MIN_SUBSTRING:
+            return found
+
+        # Then names containing it (other than at the start)
+        joined = self.joined
+        starts = self.starts
+        position = joined.find(query)
+        while position >= 0:
+            index = bisect.bisect_right(starts, position) - 1
+            if position != starts[index]:
+                found.append(index)
+                if len(found) >= limit:
+                    break
+            # Carry on from the next name
+            position = joined.find(query, starts[index + 1])
+        return found
+
+class SearchIndex:
+    """ Indexes of the simplified names of the artists (top-level directories), albums (those below them) and songs in a
+    library, built along with it by index_library().  Artists and albums are identified by constructed path, and songs
+    by position in library.songs. """
+
+    """ Constructor """
+    def __init__(self, artist_paths, artist_names, album_paths, album_names, song_names):
+        self.artist_paths = artist_paths
+        self.artists = NameIndex(artist_names)
+        self.album_paths = album_paths
+        self.albums = NameIndex(album_names)
+        self.songs = NameIndex(song_names)
+
+    """ Search for the query (which is simplified).  Returns a tuple of lists of (up to 'limit' each of) artists'
+    constructed paths, albums' constructed paths and songs' positions in library.songs, best matches first. """
+    def search(self, query, limit):
+        query = simplify(query)
+        return ([ self.artist_paths[i] for i in self.artists.search(query, limit) ],
+                [ self.album_paths[i] for i in self.albums.search(query, limit) ],
+                self.songs.search(query, limit))
+
+""" Build the flattened song and graphic lists for the library, so that getting all the songs or graphics at or below
+any directory is a slice rather than a traversal of the tree.
+Walking the tree depth-first, with songs and subdirectories in alphabetical order, puts the songs (and graphics) for
+every directory and all its subdirectories in one contiguous range.  The following are set on the Library (the root node):
+ - "songs" (list of tuples of (song display name, album display name, constructed filepath, art constructed filepath)
+   in playlist order, with paths relative to the root)
+ - "graphics" (list of constructed filepaths of graphics, relative to the root)
+ - "ranges" (dict of directory key (tuple of simplified names):tuple of (first song, end of songs in that directory,
+   end of songs below it, first graphic, end of graphics, constructed path prefix length, display path prefix length))
+ - "paths" (dict of constructed path, relative to the root, to its LibraryNode (for a directory, whose path ends in "/")
+   or LibraryFile (for a song or graphic), so that a request is resolved with one lookup rather than by walking the
+   tree.  The keys of songs are the same strings as in "songs".  A song requested in another format is found in its
+   directory's media.)
+ - "search" (a SearchIndex of the names of the artists, albums and songs)
+ - "generation" (a number identifying this version of the library, e.g. for caching pages rendered from it)
+An album's art is the graphic in its directory or, failing that, one chosen at random from below it. """
+def index_library(library):
+    songs = []
+    graphics = []
+    ranges = {}
+    paths = {}
+    # For searching: the simplified names of the songs (in the same order), and the paths and names of the artists
+    # (top-level directories) and albums (directories below them)
+    song_names = []
+    artist_paths = []
+    artist_names = []
+    album_paths = []
+    album_names = []
+
+    def visit(dir_dict, key, constructed_path, display_path):
+        song_start = len(songs)
+        graphic_start = len(graphics)
+        paths[constructed_path] = dir_dict
+        if len(key) == 1:
+            artist_paths.append(constructed_path)
+            artist_names.append(key[-1])
+        elif key:
+            album_paths.append(constructed_path)
+            album_names.append(key[-1])
+
+        # Get graphic file in this directory, if it exists
+        if dir_dict.graphic:
+            graphics.append(constructed_path + dir_dict.graphic.filename)
+            paths[graphics[-1]] = dir_dict.graphic
+
+        # Reserve space for the songs in this directory: we need the graphics below it before we can choose the art
+        media = dir_dict.media
+        song_end = song_start + len(media)
+        songs.extend([None] * len(media))
+        song_names.extend([None] * len(media))
+
+        # Recurse into all sub-dirs (in alphabetical order), appending the directory name to the path
+        for sub_dir in sorted(dir_dict.dirs.keys()):
+            sub_dir_dict = dir_dict.dirs[sub_dir]
+            sub_display_path = display_path + ": " + sub_dir_dict.display_name if key else sub_dir_dict.display_name
+            visit(sub_dir_dict, key + (sub_dir,), constructed_path + sub_dir + "/", sub_display_path)
+
+        # Choose the album art
+        if dir_dict.graphic:
+            art_filepath = graphics[graphic_start]
+        elif len(graphics) > graphic_start:
+            art_filepath = random.choice(graphics[graphic_start:])
+        elif EMBEDDED_ART and media:
+            # The art embedded in the first song (which is only ever requested as a thumbnail)
+            first_name, first_song = min(media.items(), key=lambda item: item[1].name.casefold())
+            art_filepath = constructed_path + first_name + first_song.extension
+        else:
+            # If no graphic found, use the default logo
+            art_filepath = DEFAULT_ART
+
+        # Fill in the songs in this directory, sorted alphabetically
+        # (This includes the extension (e.g. .mp3) in case the browser requires it to play the file.)
+        dir_songs = []
+        for media_simplified_name, song in media.items():
+            constructed_filepath = constructed_path + media_simplified_name + song.extension
+            paths[constructed_filepath] = song
+            dir_songs.append( ((song.name, display_path, constructed_filepath, art_filepath), media_simplified_name) )
+        dir_songs.sort(key=lambda item: item[0][0].casefold())
+        songs[song_start:song_end] = [ song for song, simplified_name in dir_songs ]
+        song_names[song_start:song_end] = [ simplified_name for song, simplified_name in dir_songs ]
+
+        # Paths below this directory are made relative to it by stripping its path (and the ": " after the display path)
+        ranges[key] = (song_start, song_end, len(songs), graphic_start, len(graphics),
+                       len(constructed_path), len(display_path) + 2 if key else 0)
+
+    visit(library, (), "", "")
+    library.songs = songs
+    library.graphics = graphics
+    library.ranges = ranges
+    library.paths = paths
+    library.search = SearchIndex(artist_paths, artist_names, album_paths, album_names, song_names)
+    library.generation = next(library_generations)
+    return library
+
+""" Get a complete, flat list of all songs in the given directory (identified by its key) and, if recurse is True, below it.
 Returns an alphabetical list of tuples of (song display name, album display name, constructed filepath, art constructed filepath).
-"Constructed filepath" is the apparent filepath relative to the given dir-dict, e.g. "queen/adayattheraces/drowse.mp3".
+"Constructed filepath" is the apparent filepath relative to the given directory, e.g. "queen/adayattheraces/drowse.mp3".
 "Art constructed filepath" is the path to request for the album art.
-(This includes the extension (e.g. .mp3) in case the browser requires it to play the file.)"""
-def get_all_songs(dir_dict, constructed_path: str = "", display_path: str = "", recurse = True):
-    media = dir_dict["media"]
-    dirs = dir_dict["dirs"]
-    art_filepath = get_art_filepath(dir_dict)
-    if art_filepath:
-        art_filepath = constructed_path + art_filepath
-    else:
-        # If no graphic found, use the default logo
-        art_filepath = "__ROOT__munic.png"
-
-    results = []
-    # Get all media files in this directory, sorted alphabetically
-    for media_simplified_name in media.keys():
-        media_filepath = media[media_simplified_name][1]
-        extension = os.path.splitext(media_filepath)[1]
-        constructed_filepath = constructed_path + media_simplified_name + extension
-        media_display_name = media[media_simplified_name][0]
-
-        # If there is a path, add it on the end (suitably formatted)
-        formatted_display_path = display_path.rstrip("/").replace("/", ": ")
-        # if formatted_display_path:
-        #     media_display_name += " ({})".format(formatted_display_path)
-        results.append( (media_display_name, formatted_display_path, constructed_filepath, art_filepath) )
-        results.sort(key=lambda tup: tup[0].casefold())
-
-    # Recurse into all sub-dirs (in alphabetical order), appending the directory name to the path
+If start and/or stop are given, only that slice of the list is returned. """
+def get_all_songs(library, key = (), recurse = True, start = 0, stop = None):
+    song_start, song_end, song_recurse_end, _, _, constructed_prefix_len, display_prefix_len = library.ranges[key]
     if recurse:
-        sub_dirs = [sd for sd in dirs.keys()]
-        sub_dirs.sort()
-        for sub_dir in sub_dirs:
-            sub_dir_dict = dirs[sub_dir]
-            sub_dir_display_path = sub_dir_dict["display_name"]
-            results = results + get_all_songs(sub_dir_dict, constructed_path + sub_dir + "/", display_path + sub_dir_display_path + "/", True)
-
-    return results
-
-""" Get album art for a given dictionary.
+        song_end = song_recurse_end
+    if stop is not None:
+        song_end = min(song_end, song_start + stop)
+    songs = library.songs[song_start + start:song_end]
+
+    # Paths in the list are relative to the root. For the root itself (the biggest list) there is nothing more to do.
+    if not constructed_prefix_len and not display_prefix_len:
+        return songs
+
+    # Otherwise make them relative to the requested directory
+    return [ (name, album[display_prefix_len:], filepath[constructed_prefix_len:],
+              art[constructed_prefix_len:] if art is not DEFAULT_ART else art)
+             for (name, album, filepath, art) in songs ]
+
+""" Get up to 'count' songs following the one at the given constructed filepath (e.g. "/queen/adayattheraces/drowse.ogg",
+which may have a different extension to the song's file) in its directory, in the order of get_all_songs.
+Returns a list of tuples of (constructed filepath, source filepath). """
+def get_following_songs(library, constructed_filepath, count):
+    parts = constructed_filepath.lstrip("/").split("/")
+    key = tuple(parts[:-1])
+    dir_dict = library_node(library, key)
+    if dir_dict is None or not count:
+        return []
+    basename = os.path.splitext(parts[-1])[0]
+    songs = get_all_songs(library, key, recurse=False)
+    for i, song in enumerate(songs):
+        if os.path.splitext(song[2])[0] == basename:
+            break
+    else:
+        return []
+    prefix = "/" + "/".join(key) + "/" if key else "/"
+    following = []
+    for name, album, filepath, art in songs[i + 1:i + 1 + count]:
+        simplified_name = os.path.splitext(filepath)[0]
+        following.append((prefix + filepath, dir_dict.media[simplified_name].filepath))
+    return following
+
+""" Get the number of songs in the given directory (identified by its key) and, if recurse is True, below it """
+def count_songs(library, key = (), recurse = True):
+    song_start, song_end, song_recurse_end, _, _, _, _ = library.ranges[key]
+    return (song_recurse_end if recurse else song_end) - song_start
+
+""" Get album art for the given directory (identified by its key).
 If there is one at the base level, returns it.
-If there is not one at that level, but there is one or more beneath, return one at random.
+If there is not one at that level, but there is one or more beneath, return one at random (using rng, if given).
 If there is none, return None """
-def get_art_filepath(base_dict):
-    # If there is a graphic at this level, use it
-    album_art = None
-    if base_dict["graphic_name"]:
-        album_art = base_dict["graphic_name"]
-    # Otherwise get a random image from anywhere below this
+def get_art_filepath(library, key, rng = random):
+    _, _, _, graphic_start, graphic_end, constructed_prefix_len, _ = library.ranges[key]
+    if graphic_end == graphic_start:
+        return None
+
+    # If there is a graphic at this level it is the first in the range; otherwise get a random image from anywhere below
+    graphics = library.graphics
+    if library_node(library, key).graphic:
+        album_art = graphics[graphic_start]
     else:
-        album_arts = get_all_graphics(base_dict)
-        if album_arts:
-            album_art = random.choice(album_arts)
+        album_art = graphics[rng.randint(graphic_start, graphic_end - 1)]
 
-    return album_art
+    return album_art[constructed_prefix_len:]
 
-""" Get a complete, flat list of all graphics in the library.
+""" Get a complete, flat list of all graphics in the given directory (identified by its key) and below.
 Returns a list of constructed filepaths.
-"Constructed filepath" is the apparent filepath relative to the given dir-dict, e.g. "Queen/A Day At The Races/folder.jpg".
+"Constructed filepath" is the apparent filepath relative to the given directory, e.g. "queen/adayattheraces/folder.jpg".
 (This includes the extension (e.g. .jpg).)"""
-def get_all_graphics(dir_dict, constructed_path: str = "", display_path: str = ""):
-    dirs = dir_dict["dirs"]
+def get_all_graphics(library, key = ()):
+    _, _, _, graphic_start, graphic_end, constructed_prefix_len, _ = library.ranges[key]
+    return [ graphic[constructed_prefix_len:] for graphic in library.graphics[graphic_start:graphic_end] ]
+
+""" Get the directory dict for the given key, or None if there is no such directory """
+def library_node(library, key):
+    node = library.paths.get("".join(part + "/" for part in key))
+    return node if node is not None and node.kind == "dir" else None
+
+# Mime types by file extension: mimetypes.guess_type() parses the whole path as a URL each time
+extension_mime_types = {}
+
+""" Get the mime type of a file from its extension (or None if it is unknown) """
+def guess_mime_type(filepath):
+    extension = os.path.splitext(filepath)[1]
+    try:
+        return extension_mime_types[extension]
+    except KeyError:
+        mime_type = mimetypes.guess_type("file" + extension)[0]
+        extension_mime_types[extension] = mime_type
+        return mime_type
+
+class Template:
+    """ A page template, parsed once into literal text and slots (named like __NAME__).
+    A page is rendered with a single join, rather than by one replace() pass over the whole document per slot.
+    Pages are rendered straight to UTF-8 bytes: a page containing emoji held as a str takes 4 bytes per character. """
+
+    SLOT_PATTERN = re.compile(r"__([A-Z0-9_]+?)__")
 
-    result = []
+    """ Constructor """
+    def __init__(self, text):
+        # Alternating literal text and slot names: literal, slot, literal, ..., slot, literal
+        self.parts = Template.SLOT_PATTERN.split(text)
+
+        # The same, with the literal text already encoded
+        self.encoded_parts = [ part.encode("utf-8") if i % 2 == 0 else part for i, part in enumerate(self.parts) ]
+
+        # The same as a format string, for filling small fragments quickly
+        self.format_string = "".join(part.replace("{", "{{").replace("}", "}}") if i % 2 == 0 else "{" + part + "}"
+                                     for i, part in enumerate(self.parts))
+
+    """ Render the template to UTF-8 bytes. 'values' is a dict of slot name:value, where each value is a string, or an
+    iterable (e.g. a generator) of encoded fragments (e.g. from fill()) to be inserted in order. """
+    def render(self, values):
+        return b"".join(self.render_chunks(values))
+
+    """ Render the template as a sequence of encoded chunks of about chunk_size bytes, which joined together make the page.
+    Iterable values are only consumed as the chunks are, so a page can be sent as it is produced. """
+    def render_chunks(self, values, chunk_size = 65536):
+        pending = []
+        pending_size = 0
+        for i, part in enumerate(self.encoded_parts):
+            if i % 2 == 0:
+                pieces = (part,)
+            else:
+                value = values[part]
+                pieces = (value.encode("utf-8"),) if isinstance(value, str) else value
+            for piece in pieces:
+                pending.append(piece)
+                pending_size += len(piece)
+                if pending_size >= chunk_size:
+                    yield b"".join(pending)
+                    pending = []
+                    pending_size = 0
+        if pending:
+            yield b"".join(pending)
+
+    """ Fill the template's slots from keyword arguments, returning UTF-8 bytes. Best for small, repeated fragments. """
+    def fill(self, **values):
+        return self.format_string.format_map(values).encode("utf-8")
+
+""" Load and parse a template file from the script directory """
+def load_template(filename):
+    with open(os.path.join(script_path, filename)) as template_file:
+        return Template(template_file.read())
+
+# Fragments of the playlist page: the links to subdirectories, and the songs
+PLAYLIST_LINK_TEMPLATE = Template("""<li><a href="__LINK__" class="playlistlink"><img src="__ALBUMART__" loading="lazy"/><p>__NAME__</p></a></li>\n""")
+SPECIAL_LINK_TEMPLATE = Template("""<li id="speciallink"><a href="*"><img src="__ALBUMART__" loading="lazy"/><p>All Songs</p></a></li>\n""")
+PLAYLIST_ITEM_TEMPLATE = Template("""<li><a href="__SONG_FILENAME__" class="songlink"><div><img src="__ALBUMART__" loading="lazy"/></div><div><p>__SONG_NAME__</p><p>__ALBUM_NAME__</p></div></a></li>\n""")
+
+""" Render the menu/playlist page, as a sequence of chunks of UTF-8 bytes, for the directory at the given path (list of
+simplified names), which must exist.  The playlist is produced lazily, as the chunks are consumed.
+The page will be all the directories directly under this one, as links, and, if include_songs is True, all the files
+from this directory onwards, as a playlist. """
+def render_menu(lib, parts, include_songs):
+    # The key by which the flattened song and graphic lists are indexed
+    key = tuple(parts)
+
+    # The root location, relative to the requested location
+    root = "../" * len(parts)
+    default_art = root + "munic.png"
+
+    # The random choices (colours, and art for directories without their own) are made the same way each time
+    # the page is rendered from the same library, so that caching the page makes no difference.
+    rng = random.Random("{}:{}".format("/".join(parts), lib.generation))
+
+    # Navigate to the requested path, building up "display_names" with the properly-formatted names of the directories.
+    # The most specific part of the name is the title.
+    base_dict = lib
+    display_names = []
+    for part in parts:
+        base_dict = base_dict.dirs[part]
+        display_names.append(base_dict.display_name)
+    title = display_names[-1] if display_names else "Munic"
+    dirs = base_dict.dirs
+
+    # Get the titles: the display names of the path, or "Munic" if none.
+    if not display_names:
+        display_names.append("Munic")
+
+    # Lazy way to ensure there are enough items in the list to replace the titles
+    display_names.append("")
+    display_names.append("")
+
+    # Generate some colours
+    # TODO Get these from the selected image
+    r = [ rng.randint(1,3) for a in range (0,9) ]
+    colours = [ "#{}{}{}".format(r.pop(), r.pop(), r.pop()) for a in range(0,3) ]
+
+    # Build the playlist (subdir) links section
+    playlist_links = []
+    # If we are not showing the songs in the folder, the first link is always "All songs"
+    if not include_songs:
+        playlist_links.append(SPECIAL_LINK_TEMPLATE.fill(ALBUMART=default_art))
+
+    # Sort the keys (dir names) alphabetically
+    # Note that we are sorting by "simplified name", so "The Beatles" is in with the Bs, not the Ts.
+    for dir_name in sorted(dirs.keys()):
+        art_constructed_filepath = get_art_filepath(lib, key + (dir_name,), rng)
+        if art_constructed_filepath:
+            art_constructed_filepath = thumbnail_url(dir_name + "/" + art_constructed_filepath, THUMBNAIL_LINK_SIZE)
+        else:
+            art_constructed_filepath = default_art
+        playlist_links.append(PLAYLIST_LINK_TEMPLATE.fill(LINK=dir_name + "/*",  # Include '*' to take us to the playlist
+                                                          ALBUMART=art_constructed_filepath,
+                                                          NAME=dirs[dir_name].display_name))
 
-    # Get graphic file in this directory, if it exists
-    if dir_dict["graphic_name"]:
-        result.append(constructed_path + dir_dict["graphic_name"])
+    # Build the playlist contents.
+    playlist_items = []
 
-    # Recurse into all sub-dirs, appending the directory name to the path
-    for sub_dir in dirs.keys():
-        sub_dir_dict = dirs[sub_dir]
-        sub_dir_display_path = sub_dir_dict["display_name"]
-        result = result + get_all_graphics(sub_dir_dict, constructed_path + sub_dir + "/", display_path + sub_dir_display_path + "/")
+    # The path to request to refresh the library
+    refresh_path = "_"
 
-    # Sort alphabetially
-    result.sort(key=lambda tup: tup[0].casefold())
+    # For a large playlist, where the rest of the playlist can be loaded from (if there is more), and from what offset
+    playlist_more = ""
+    playlist_offset = 0
+    num_songs = 0
 
-    return result
+    if include_songs:
+        # If the playlist is large, only include the first page of it: the browser will load the rest as needed
+        num_songs = count_songs(lib, key, recurse=True)
+        stop = None
+        if LAZY_PLAYLIST_THRESHOLD and num_songs > LAZY_PLAYLIST_THRESHOLD:
+            stop = LAZY_PLAYLIST_PAGE_SIZE
+            playlist_more = root + API_LIST_PREFIX.lstrip("/") + "".join(part + "/" for part in parts)
+            playlist_offset = len(dirs) + stop
+
+        # Get all media files at or below this location, and construct the list items
+        fill = PLAYLIST_ITEM_TEMPLATE.fill
+        playlist_items = ( fill(SONG_FILENAME=song_constructed_filepath,
+                                ALBUMART=thumbnail_url(art_constructed_filepath, THUMBNAIL_SONG_SIZE)
+                                         if art_constructed_filepath is not DEFAULT_ART else default_art,
+                                SONG_NAME=song_display_name,
+                                ALBUM_NAME=song_display_album)
+                           for (song_display_name, song_display_album, song_constructed_filepath, art_constructed_filepath)
+                           in get_all_songs(lib, key, recurse=True, stop=stop) )
+
+        refresh_path = "*_"
+
+    # Get the album art
+    art_filepath = get_art_filepath(lib, key, rng)
+    if not art_filepath:
+        art_filepath = default_art
+
+    return playlist_template.render_chunks({
+        "TITLE":title,
+        # The audioplayer and equaliser javascript files
+        "AUDIOPLAY_JS":root + static_files["/munic.js"].url,
+        "MUNEQ_JS":root + static_files["/muneq.js"].url,
+        "MUNIC_CSS":root + static_files["/munic.css"].url,
+        "TITLE0":display_names[0],
+        "TITLE1":display_names[1],
+        "TITLE2":display_names[2],
+        "BG_COL0":colours[0],
+        "BG_COL1":colours[1],
+        "BG_COL2":colours[2],
+        "PLAYLIST_LINKS":playlist_links,
+        # If there are no playlist links, hide the whole section
+        "LINKS_CLASS":"" if playlist_links else "hidden",
+        "PLAYLIST_ITEMS":playlist_items,
+        "PLAYLIST_MORE":playlist_more,
+        "PLAYLIST_OFFSET":str(playlist_offset),
+        "PLAYLIST_TOTAL":str(len(dirs) + num_songs),
+        "ALBUMART":art_filepath,
+        # The redirect path, which is either "_" if we are not showing songs, or "*_" if we are
+        "REFRESH":refresh_path,
+        "ROOT":root })
+
+class LibraryIndex:
+    """ A persistent record of the contents of every directory scanned, stored next to the script.
+    For each directory path it holds the directory's mtime, its subdirectories, music files, graphic files (with sizes)
+    and unknown extensions.  A rescan only re-lists directories whose mtime has changed -- adding, removing or renaming
+    an entry changes the mtime of the containing directory, so unchanged directories can be taken from the index. """
+
+    # Bump this if the format of the entries changes, so that old index files are ignored
+    VERSION = 1
 
+    known_music_formats = (".mp3", ".mp4", ".m4a", ".ogg", ".wav", ".flac", ".wma")
+    known_graphic_formats = (".jpg", ".jpeg", ".gif", ".bmp", ".png")
+
+    """ Constructor """
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+        # Dict of directory path:entry dict, where each entry contains:
+        #  - "mtime" (modification time of the directory, in ns)
+        #  - "dirs" (sorted list of subdirectory names)
+        #  - "music" (sorted list of music filenames)
+        #  - "graphics" (sorted list of tuples of (graphic filename, size))
+        #  - "unknown" (list of unknown file extensions)
+        self.dirs = {}
+
+        # Dict of library node key:list of directory paths which are merged into that node (see path_key)
+        self.contributors = {}
+
+    """ Load the index from disk, if present.  Returns True if it was loaded. """
+    def load(self):
+        try:
+            with open(self.filepath, "rb") as f:
+                version, dirs = pickle.load(f)
+        except FileNotFoundError:
+            logging.info("No library index found at {}".format(self.filepath))
+            return False
+        except Exception as e:
+            logging.warning("Failed to read library index {}: {}".format(self.filepath, e))
+            return False
+
+        if version != LibraryIndex.VERSION:
+            logging.info("Ignoring library index {} with old version {}".format(self.filepath, version))
+            return False
+
+        self.dirs = dirs
+        logging.info("Loaded library index of {} directories from {}".format(len(self.dirs), self.filepath))
+        return True
+
+    """ Save the index to disk.  It is written to a temporary file first, so a crash never leaves a half-written index. """
+    def save(self):
+        temp_filepath = self.filepath + ".tmp"
+        try:
+            with open(temp_filepath, "wb") as f:
+                pickle.dump((LibraryIndex.VERSION, self.dirs), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_filepath, self.filepath)
+        except OSError as e:
+            logging.warning("Failed to write library index {}: {}".format(self.filepath, e))
+
+    """ List a single directory, returning its index entry, or None if it could not be read. """
+    def list_dir(self, path, mtime):
+        subdirs = []
+        music = []
+        graphics = []
+        unknown = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    name = entry.name
+                    try:
+                        # Follow symlinks, as os.walk(followlinks=True) did
+                        if entry.is_dir():
+                            subdirs.append(name)
+                            continue
+                    except OSError:
+                        continue
+
+                    lower_name = name.lower()
+                    if lower_name.endswith(LibraryIndex.known_music_formats):
+                        music.append(name)
+                    elif lower_name.endswith(LibraryIndex.known_graphic_formats):
+                        try:
+                            graphics.append((name, entry.stat().st_size))
+                        except OSError:
+                            pass
+                    else:
+                        extension = os.path.splitext(name)[1]
+                        if extension not in unknown:
+                            unknown.append(extension)
+        except OSError as e:
+            logging.warning("Failed to list directory {}: {}".format(path, e))
+            return None
+
+        subdirs.sort()
+        music.sort()
+        graphics.sort()
+        return { "mtime":mtime, "dirs":subdirs, "music":music, "graphics":graphics, "unknown":unknown }
+
+    """ Scan the directory tree below 'top' (or just 'top' itself, if 'recurse' is False), reusing entries from 'old_dirs'
+    for directories whose mtime has not changed.
+    Returns a tuple of (dict of path:entry, number of directories (re-)listed, number of songs added, number of songs removed). """
+    def scan_tree(self, old_dirs, top, recurse = True):
+        new_dirs = {}
+        num_listed = 0
+        num_added = 0
+        num_removed = 0
+
+        to_visit = [top]
+        while to_visit:
+            path = to_visit.pop()
+            # Guard against the same directory being reached twice (e.g. via symlinks)
+            if path in new_dirs:
+                continue
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except OSError as e:
+                logging.warning("Failed to stat directory {}: {}".format(path, e))
+                continue
+
+            entry = old_dirs.get(path)
+            if entry is None or entry["mtime"] != mtime:
+                old_music = entry["music"] if entry else []
+                entry = self.list_dir(path, mtime)
+                num_listed += 1
+                if entry is None:
+                    continue
+
+                # Count the songs which have appeared or disappeared in this directory
+                new_music = set(entry["music"])
+                num_added += len(new_music.difference(old_music))
+                num_removed += len(set(old_music).difference(new_music))
+
+            new_dirs[path] = entry
+            if recurse:
+                # Visit subdirs in alphabetical order (the stack pops from the end)
+                to_visit.extend(os.path.join(path, subdir) for subdir in reversed(entry["dirs"]))
+
+        return (new_dirs, num_listed, num_added, num_removed)
+
+    """ Bring the index up to date with the given media dirs.
+    Only directories which are new, or whose mtime has changed, are listed; directories which no longer exist are dropped.
+    The media dirs, and then each of their top-level subdirectories, are scanned in parallel on SCAN_THREADS threads,
+    since on network mounts the time is dominated by waiting for the server rather than by our own processing.
+    The results are merged in media dir order and then alphabetical order, so the outcome does not depend on timing.
+    Returns a tuple of (number of directories (re-)listed, number of songs added, number of songs removed). """
+    def scan(self, media_dirs):
+        old_dirs = self.dirs
+        new_dirs = {}
+        num_listed = 0
+        num_added = 0
+        num_removed = 0
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(SCAN_THREADS, 1), thread_name_prefix="LibraryScan") as executor:
+            # List the media dirs themselves
+            for media_dir in media_dirs:
+                logging.info("Scanning media dir {}".format(media_dir))
+            root_futures = [ executor.submit(self.scan_tree, old_dirs, media_dir, False) for media_dir in media_dirs ]
+
+            # As each is listed, fan out across its subdirectories.  Keep the futures in order for merging.
+            futures = []
+            for media_dir, root_future in zip(media_dirs, root_futures):
+                futures.append(root_future)
+                root_dirs = root_future.result()[0]
+                if media_dir in root_dirs:
+                    for subdir in root_dirs[media_dir]["dirs"]:
+                        futures.append(executor.submit(self.scan_tree, old_dirs, os.path.join(media_dir, subdir)))
+
+            for future in futures:
+                tree_dirs, tree_num_listed, tree_num_added, tree_num_removed = future.result()
+                for path, entry in tree_dirs.items():
+                    # The same directory may be reached twice (e.g. overlapping media dirs); the first wins
+                    new_dirs.setdefault(path, entry)
+                num_listed += tree_num_listed
+                num_added += tree_num_added
+                num_removed += tree_num_removed
+
+        # Songs in directories which have disappeared altogether have been removed
+        for path, entry in old_dirs.items():
+            if path not in new_dirs:
+                num_removed += len(entry["music"])
+
+        logging.info("Library index scan complete: {} directories, {} re-listed, {} songs added, {} removed"
+            .format(len(new_dirs), num_listed, num_added, num_removed))
+        self.dirs = new_dirs
+        return (num_listed, num_added, num_removed)
+
+    """ Get the media dir which contains the given directory path, or None """
+    def media_dir_for(self, media_dirs, path):
+        for media_dir in media_dirs:
+            if path == media_dir or (path.startswith(media_dir) and (media_dir.endswith("/") or path[len(media_dir)] == "/")):
+                return media_dir
+        return None
+
+    """ Get the key of the library node for a directory: a tuple of the simplified names of its path below the media dir.
+    Directories from different media dirs, or with near-identical names, which have the same key are merged into one node. """
+    def path_key(self, media_dir, path):
+        # 'path' is the full path to the files, e.g. /media/NAS_MEDIA/music/Queen/A Day At The Races"
+        # Remove the root from the path to give the interesting part.
+        # Simplify the name, so that near-duplicates (Guns'n'Roses, Guns N Roses) are treated as the same.
+        sub_path = path[len(media_dir):].lstrip("/").rstrip("/")
+        return tuple(simplify(part) for part in sub_path.split("/") if part)
+
+    """ Record a directory as contributing to the library node for its key.
+    Contributors are kept in the order in which a scan visits them (media dir order, then alphabetical depth-first),
+    which determines which of several identically-named songs wins. """
+    def add_contributor(self, media_dirs, path):
+        media_dir = self.media_dir_for(media_dirs, path)
+        contributors = self.contributors.setdefault(self.path_key(media_dir, path), [])
+        contributors.append(path)
+        contributors.sort(key=lambda p: (media_dirs.index(self.media_dir_for(media_dirs, p)), p.split("/")))
+
+    """ Remove a directory from the contributors to its library node """
+    def remove_contributor(self, media_dirs, path):
+        key = self.path_key(self.media_dir_for(media_dirs, path), path)
+        contributors = self.contributors.get(key, [])
+        if path in contributors:
+            contributors.remove(path)
+        if not contributors:
+            self.contributors.pop(key, None)
+
+    """ Fill in the media and graphic of the library node with the given key from all the directories contributing to it """
+    def fill_node(self, node, key):
+        media = {}
+        # The root always has a graphic: the Munic logo, unless a media dir has one of its own
+        graphic = None if key else LibraryFile("graphic", "munic.png", script_path, "munic.png")
+
+        for path in self.contributors.get(key, []):
+            entry = self.dirs[path]
+            # (The directory path and filenames are the index's own strings, shared rather than copied)
+            for music_file in entry["music"]:
+                # Get the song name from the filename by stripping the extension
+                song_name = os.path.splitext(music_file)[0]
+                simplified_songname = simplify(song_name)
+
+                # Insert the item, keyed by song name
+                media[simplified_songname] = LibraryFile("song", song_name, path, music_file)
+
+            # Use the largest graphic
+            largest_size = 0
+            for graphic_filename, size in entry["graphics"]:
+                if size > largest_size:
+                    graphic = LibraryFile("graphic", graphic_filename, path, graphic_filename)
+                    largest_size = size
+
+        node.media = media
+        node.graphic = graphic
+
+    """ Get the display name for the library node with the given key: the real name of the first directory contributing to it """
+    def display_name(self, key):
+        contributors = self.contributors.get(key)
+        return os.path.basename(contributors[0].rstrip("/")) if contributors else key[-1]
+
+    """ Create a new, empty library node for the given key """
+    def new_node(self, key):
+        return LibraryNode(self.display_name(key))
+
+    """ Build the library data structure (see load_library) from the contents of the index. """
+    def build_library(self, media_dirs):
+        library = Library(None)
+        # TODO Don't put empty stuff in, create ditionary entries when needed
+        num_songs = 0
+        num_graphics = 0
+        unknown_extensions = []
+
+        # Work out which directories contribute to each node of the library
+        self.contributors = {}
+        for media_dir in media_dirs:
+            to_visit = [media_dir]
+            while to_visit:
+                path = to_visit.pop()
+                entry = self.dirs.get(path)
+                if entry is None:
+                    continue
+                to_visit.extend(os.path.join(path, subdir) for subdir in reversed(entry["dirs"]))
+
+                self.contributors.setdefault(self.path_key(media_dir, path), []).append(path)
+                num_songs += len(entry["music"])
+
+                # Add the extensions of any unknown files to the unknown extensions list.
+                # This gives the user a clue that they have unknown media types.
+                for unknown_extension in entry["unknown"]:
+                    if unknown_extension not in unknown_extensions:
+                        unknown_extensions.append(unknown_extension)
+
+        # Create a node for every key which has media or graphics, along with its parents.
+        for key, contributors in self.contributors.items():
+            if key and not any(self.dirs[path]["music"] or self.dirs[path]["graphics"] for path in contributors):
+                continue
+            base_dict = library
+            for depth, part in enumerate(key):
+                if not part in base_dict.dirs:
+                    base_dict.dirs[part] = self.new_node(key[:depth+1])
+                base_dict = base_dict.dirs[part]
+            self.fill_node(base_dict, key)
+            if key and base_dict.graphic:
+                num_graphics += 1
+
+        # Ensure the root is filled in even if the media dirs are empty
+        if not library.graphic:
+            self.fill_node(library, ())
+
+        logging.info("Loaded {} songs and {} graphics".format(num_songs, num_graphics))
+        logging.info("Unknown media types: {}".format(unknown_extensions))
+
+        return index_library(library)
+
+    """ Forget a directory and everything below it.  Adds the forgotten paths to 'changed' and returns the number of songs removed. """
+    def forget(self, media_dirs, path, changed):
+        num_removed = 0
+        to_forget = [path]
+        while to_forget:
+            path = to_forget.pop()
+            entry = self.dirs.pop(path, None)
+            if entry is None:
+                continue
+            self.remove_contributor(media_dirs, path)
+            changed.add(path)
+            num_removed += len(entry["music"])
+            to_forget.extend(os.path.join(path, subdir) for subdir in entry["dirs"])
+        return num_removed
+
+    """ List a new directory and everything below it.  Adds the listed paths to 'changed' and returns the number of songs added. """
+    def add_tree(self, media_dirs, path, changed):
+        num_added = 0
+        to_visit = [path]
+        while to_visit:
+            path = to_visit.pop()
+            if path in self.dirs:
+                continue
+            try:
+                entry = self.list_dir(path, os.stat(path).st_mtime_ns)
+            except OSError:
+                continue
+            if entry is None:
+                continue
+            self.dirs[path] = entry
+            self.add_contributor(media_dirs, path)
+            changed.add(path)
+            num_added += len(entry["music"])
+            to_visit.extend(os.path.join(path, subdir) for subdir in entry["dirs"])
+        return num_added
+
+    """ Re-list the given directories, e.g. because the filesystem reported changes in them.
+    New subdirectories are listed in full; subdirectories which have gone are forgotten.
+    Returns a tuple of (set of directory paths changed, number of songs added, number of songs removed). """
+    def update(self, media_dirs, paths):
+        changed = set()
+        num_added = 0
+        num_removed = 0
+        for path in paths:
+            media_dir = self.media_dir_for(media_dirs, path)
+            if media_dir is None:
+                continue
+
+            old_entry = self.dirs.get(path)
+            # Ignore directories we do not know about (and whose parent we do not know about): they are not in the library.
+            if old_entry is None and path != media_dir and os.path.dirname(path) not in self.dirs:
+                continue
+
+            try:
+                entry = self.list_dir(path, os.stat(path).st_mtime_ns)
+            except OSError:
+                entry = None
+
+            # If the directory has gone, forget it and everything below it
+            if entry is None:
+                num_removed += self.forget(media_dirs, path, changed)
+                continue
+
+            self.dirs[path] = entry
+            changed.add(path)
+            if old_entry is None:
+                self.add_contributor(media_dirs, path)
+                old_entry = { "dirs":[], "music":[] }
+
+            new_music = set(entry["music"])
+            num_added += len(new_music.difference(old_entry["music"]))
+            num_removed += len(set(old_entry["music"]).difference(new_music))
+
+            old_subdirs = set(old_entry["dirs"])
+            new_subdirs = set(entry["dirs"])
+            for subdir in new_subdirs.difference(old_subdirs):
+                num_added += self.add_tree(media_dirs, os.path.join(path, subdir), changed)
+            for subdir in old_subdirs.difference(new_subdirs):
+                num_removed += self.forget(media_dirs, os.path.join(path, subdir), changed)
+
+        return (changed, num_added, num_removed)
+
+    """ Return a copy of the library with the nodes for the given changed directories rebuilt.
+    Only the nodes on the way down to the changed ones are copied; everything else is shared with the old library,
+    which is left untouched for the benefit of any requests still using it. """
+    def update_library(self, library, media_dirs, changed_paths):
+        keys = set()
+        for path in changed_paths:
+            media_dir = self.media_dir_for(media_dirs, path)
+            if media_dir is not None:
+                keys.add(self.path_key(media_dir, path))
+
+        new_library = Library(library.display_name, library.media, dict(library.dirs), library.graphic)
+        # The nodes which have been copied, and so may be modified. (Holding them also prevents their ids being reused.)
+        copied = { id(new_library):new_library }
+
+        # Deepest first, so that emptied children are removed before their parents are considered
+        for key in sorted(keys, key=len, reverse=True):
+            nodes = [new_library]
+            for depth, part in enumerate(key):
+                dirs = nodes[-1].dirs
+                node = dirs.get(part)
+                if node is None:
+                    node = self.new_node(key[:depth+1])
+                elif id(node) not in copied:
+                    # The first contributing directory may have changed (e.g. been renamed)
+                    node = LibraryNode(self.display_name(key[:depth+1]), node.media, dict(node.dirs), node.graphic)
+                copied[id(node)] = node
+                dirs[part] = node
+                nodes.append(node)
+
+            self.fill_node(nodes[-1], key)
+
+            # Remove nodes which are now empty, working upwards (but never the root)
+            for depth in range(len(key), 0, -1):
+                node = nodes[depth]
+                if node.media or node.graphic or node.dirs:
+                    break
+                del nodes[depth-1].dirs[key[depth-1]]
+
+        # The positions of everything in the flattened lists may have changed, so rebuild them
+        return index_library(new_library)
+
+class LibraryScanner:
+    """ Rescans the library in a background thread, so that browsing and streaming never wait for a rescan.
+    A scan is triggered by request_scan() (from /_ or SIGHUP), or every LIBRARY_RESCAN_INTERVAL seconds if that is set.
+    Changes reported by the LibraryWatcher are applied with request_update(), which re-lists just those directories.
+    The new library is built off to the side and then swapped in by rebinding the global "library" in one step; the old
+    structure is never modified, so requests already walking it are unaffected. """
+
+    # Minimum interval between saves of the index after incremental updates, in seconds
+    INDEX_SAVE_INTERVAL = 60
+
+    """ Constructor """
+    def __init__(self, media_dirs, interval = 0):
+        self.media_dirs = media_dirs
+        self.interval = interval
+
+        # Set to wake the thread when a scan or update is requested
+        self.trigger = threading.Event()
+
+        # What has been requested: a full scan, and/or the directories to update. Protected by self.lock.
+        self.lock = threading.Lock()
+        self.full_scan_requested = False
+        self.dirty_paths = set()
+
+        # Whether the index has changes not yet saved, and when it was last saved
+        self.index_unsaved = False
+        self.last_index_save = time.monotonic()
+
+        # Status of the current and last scans, for reporting
+        self.scanning = False
+        self.num_scans = 0
+        self.num_updates = 0
+        self.last_scan_finished = None
+        self.last_scan_duration = None
+        self.last_num_listed = 0
+        self.last_num_added = 0
+        self.last_num_removed = 0
+
+        self.thread = threading.Thread(target=self.run, name="LibraryScanner", daemon=True)
+
+    """ Start the background thread """
+    def start(self):
+        self.thread.start()
+
+    """ Request a scan.  Returns immediately; if a scan is already in progress, another will follow it. """
+    def request_scan(self):
+        logging.info("Library rescan requested")
+        with self.lock:
+            self.full_scan_requested = True
+        self.trigger.set()
+
+    """ Request that the given directories be re-listed and the library updated.  Returns immediately. """
+    def request_update(self, paths):
+        with self.lock:
+            self.dirty_paths.update(paths)
+        self.trigger.set()
+
+    """ Thread main loop: wait for a scan or update to be requested (or the interval to expire) and perform it """
+    def run(self):
+        while True:
+            self.trigger.wait(timeout=self.interval if self.interval else None)
+            self.trigger.clear()
+            with self.lock:
+                # If we woke up without a request for an update, the interval expired or a scan was requested
+                full_scan = self.full_scan_requested or not self.dirty_paths
+                dirty_paths = self.dirty_paths
+                self.full_scan_requested = False
+                self.dirty_paths = set()
+            try:
+                if full_scan:
+                    self.scan()
+                else:
+                    self.update(dirty_paths)
+                if library_watcher:
+                    library_watcher.sync()
+            except Exception:
+                logging.exception("Library rescan failed")
+                self.scanning = False
+
+    """ Update the library index and swap in a freshly-built library """
+    def scan(self):
+        global library
+        self.scanning = True
+        start_time = time.monotonic()
+
+        num_listed, num_added, num_removed = library_index.scan(self.media_dirs)
+        if num_listed:
+            new_library = library_index.build_library(self.media_dirs)
+            # The atomic swap: requests in flight keep their reference to the old library
+            library = new_library
+            page_cache.clear()
+            self.index_unsaved = True
+        self.save_index(force=True)
+
+        self.last_scan_duration = time.monotonic() - start_time
+        self.last_scan_finished = time.time()
+        self.last_num_listed = num_listed
+        self.last_num_added = num_added
+        self.last_num_removed = num_removed
+        self.num_scans += 1
+        self.scanning = False
+        logging.info("Library rescan took {:.2f}s".format(self.last_scan_duration))
+
+    """ Re-list the given directories and swap in a library with just the affected nodes rebuilt """
+    def update(self, paths):
+        global library
+        start_time = time.monotonic()
+
+        changed, num_added, num_removed = library_index.update(self.media_dirs, paths)
+        if changed:
+            library = library_index.update_library(library, self.media_dirs, changed)
+            page_cache.clear()
+            self.index_unsaved = True
+            self.save_index()
+
+        self.num_updates += 1
+        logging.info("Library update of {} directories ({} songs added, {} removed) took {:.3f}s"
+            .format(len(changed), num_added, num_removed, time.monotonic() - start_time))
+
+    """ Save the index if it has changed -- but, unless forced, not more often than INDEX_SAVE_INTERVAL """
+    def save_index(self, force = False):
+        if not self.index_unsaved:
+            return
+        if force or time.monotonic() - self.last_index_save > LibraryScanner.INDEX_SAVE_INTERVAL:
+            library_index.save()
+            self.index_unsaved = False
+            self.last_index_save = time.monotonic()
+
+    """ Get a dict describing the state of the scanner """
+    def status(self):
+        return { "scanning":self.scanning or self.trigger.is_set(),
+                 "num_scans":self.num_scans,
+                 "num_updates":self.num_updates,
+                 "last_scan_finished":self.last_scan_finished,
+                 "last_scan_duration":self.last_scan_duration,
+                 "directories_listed":self.last_num_listed,
+                 "songs_added":self.last_num_added,
+                 "songs_removed":self.last_num_removed }
+
+class LibraryWatcher:
+    """ Watches the media dirs with inotify (Linux only) and passes changed directories to the LibraryScanner,
+    so that the library stays live without rescans.  Events are batched until the filesystem has been quiet for
+    SETTLE_TIME, so that e.g. copying in an album results in one update rather than one per file.
+    If inotify is not available, or the watch limit (/proc/sys/fs/inotify/max_user_watches) is reached, watching
+    stops and the scanner falls back to periodic mtime-based rescans. """
+
+    # inotify constants, from <sys/inotify.h>
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_MOVE_SELF = 0x00000800
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ONLYDIR = 0x01000000
+    IN_ISDIR = 0x40000000
+
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+    # Header of each event read from the inotify file descriptor: wd, mask, cookie, len (followed by len bytes of name)
+    EVENT_HEADER = struct.Struct("iIII")
+
+    # Time to wait for the filesystem to go quiet before passing on changes, and the most we will wait, in seconds
+    SETTLE_TIME = 2
+    MAX_SETTLE_TIME = 10
+
+    """ Constructor.  Raises OSError if inotify is not available. """
+    def __init__(self, scanner):
+        self.scanner = scanner
+
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+
+        # Maps of watch descriptor:directory path and back again. Protected by self.lock.
+        self.lock = threading.Lock()
+        self.paths = {}
+        self.wds = {}
+        self.failed = False
+
+        self.thread = threading.Thread(target=self.run, name="LibraryWatcher", daemon=True)
+
+    """ Add watches for all directories in the library index, then start the background thread.  Returns False if
+    the directories could not all be watched.  Must be called before the scanner is started. """
+    def start(self):
+        if not self.sync():
+            return False
+        self.thread.start()
+        return True
+
+    """ Watch any directories in the library index which are not yet watched.
+    Called after every scan or update, from the scanner thread. Returns False if watching has failed. """
+    def sync(self):
+        if self.failed:
+            return False
+        with self.lock:
+            for path in library_index.dirs.keys() - self.wds.keys():
+                wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), LibraryWatcher.WATCH_MASK)
+                if wd < 0:
+                    errno = ctypes.get_errno()
+                    if errno == ENOSPC:
+                        self.fail("inotify watch limit reached after {} directories".format(len(self.wds)))
+                        return False
+                    # The directory may have been removed since it was listed
+                    logging.debug("Failed to watch {}: {}".format(path, os.strerror(errno)))
+                    continue
+
+                # A moved directory keeps its watch descriptor, so forget its old path
+                old_path = self.paths.get(wd)
+                if old_path is not None:
+                    self.wds.pop(old_path, None)
+                self.paths[wd] = path
+                self.wds[path] = wd
+
+            # Forget paths which are no longer in the index (renamed away, or their watch was removed)
+            for path in self.wds.keys() - library_index.dirs.keys():
+                self.paths.pop(self.wds.pop(path), None)
+
+        logging.debug("Watching {} directories".format(len(self.wds)))
+        return True
+
+    """ Stop watching, and fall back to periodic rescans """
+    def fail(self, reason):
+        logging.warning("Stopping watching media dirs ({}); falling back to rescanning every {}s"
+            .format(reason, WATCH_FALLBACK_RESCAN_INTERVAL))
+        self.failed = True
+        os.close(self.fd)
+        if not self.scanner.interval:
+            self.scanner.interval = WATCH_FALLBACK_RESCAN_INTERVAL
+
+    """ Thread main loop: read events and pass the affected directories to the scanner once things settle down """
+    def run(self):
+        dirty_paths = set()
+        first_event_time = None
+        while not self.failed:
+            # Wait for events; if we have some pending, only until they should be passed on
+            timeout = None
+            if dirty_paths:
+                timeout = min(LibraryWatcher.SETTLE_TIME, first_event_time + LibraryWatcher.MAX_SETTLE_TIME - time.monotonic())
+            try:
+                readable, _, _ = select.select([self.fd], [], [], max(timeout, 0) if timeout is not None else None)
+                data = os.read(self.fd, 65536) if readable else b""
+            except OSError as e:
+                if not self.failed:
+                    self.fail("error reading inotify events: {}".format(e))
+                return
+
+            # Nothing happened for a while: pass on the changes
+            if not data:
+                self.scanner.request_update(dirty_paths)
+                dirty_paths = set()
+                first_event_time = None
+                continue
+
+            overflowed = False
+            offset = 0
+            with self.lock:
+                while offset < len(data):
+                    wd, mask, cookie, length = LibraryWatcher.EVENT_HEADER.unpack_from(data, offset)
+                    offset += LibraryWatcher.EVENT_HEADER.size
+                    name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+                    offset += length
+
+                    if mask & LibraryWatcher.IN_Q_OVERFLOW:
+                        overflowed = True
+                        continue
+                    path = self.paths.get(wd)
+                    if path is None:
+                        continue
+                    if mask & LibraryWatcher.IN_IGNORED:
+                        # The watch has been removed (e.g. the directory was deleted)
+                        self.paths.pop(wd, None)
+                        if self.wds.get(path) == wd:
+                            self.wds.pop(path)
+                        continue
+                    if mask & (LibraryWatcher.IN_DELETE_SELF | LibraryWatcher.IN_MOVE_SELF):
+                        # The parent directory sees this as well; update the directory itself so it is forgotten
+                        dirty_paths.add(path)
+                        continue
+
+                    # Only changes to directories, music and graphics affect the library
+                    lower_name = name.lower()
+                    if mask & LibraryWatcher.IN_ISDIR or lower_name.endswith(LibraryIndex.known_music_formats) \
+                            or lower_name.endswith(LibraryIndex.known_graphic_formats):
+                        dirty_paths.add(path)
+
+            if overflowed:
+                # We have lost events, so we cannot know what changed: rescan (which is cheap for unchanged directories)
+                logging.warning("inotify event queue overflowed; rescanning")
+                dirty_paths = set()
+                first_event_time = None
+                self.scanner.request_scan()
+            elif dirty_paths and first_event_time is None:
+                first_event_time = time.monotonic()
 
 # TODO Remove empty directories (may need to repeat until none are found as diretory may become empty if we remove its only subdir)
-def load_library(media_dirs):
-    # Walk the given path, creating a data structure as follows:
-    # A recursive structure of a dict representing the top level, containing:
-    #  - "display_name" (properly-formatted name, for display)
-    #  - "media" (dict of simplified-songname:tuple of (songname:filepath) )
-    #  - "dirs" (dict of simplified-dirname:directory-dict like the top level)
-    #  - "graphic_name" (graphic name, for the HTML/request, if present)
-    #  - "graphic_filepath" (graphic local filepath, if present)
-    # The filenames will be the full filepath of the file.
+def load_library(media_dirs, rescan = True):
+    # Create a data structure as follows:
+    # A recursive structure of LibraryNodes, the top level being a Library, each containing:
+    #  - display_name (properly-formatted name, for display)
+    #  - media (dict of simplified-songname:LibraryFile)
+    #  - dirs (dict of simplified-dirname:LibraryNode like the top level)
+    #  - graphic (LibraryFile, if present)
+    # The Library also holds flattened lists of songs and graphics (see index_library).
     # Directories will be indexed by "simplfied" name: a lower-case, alpha-numeric version of the real name, with the first "the" removed.
     # Because we want to be able to overlay multiple directories, we cannot simply walk and create the structure as we find it.
     # Instead we check whether each directory exists and add it if not.
     # This has the desirable side-effects of merging directories with effectively the same name, and de-duplicating any songs
     # with identical artist/album/name.
     # The location of the bottom level will be that of the script, so that the default graphic can be found.
+    #
+    # The structure is built from the persistent library index.  If rescan is True, the index is first brought up to date,
+    # re-listing only directories which have changed.  If rescan is False and an index was found on disk, it is used as-is,
+    # which makes startup near-instant; a refresh (/_) will pick up any changes.
+    if not rescan and library_index.dirs:
+        logging.info("Building library from saved index without rescanning")
+    else:
+        num_listed, num_added, num_removed = library_index.scan(media_dirs)
+        if num_listed:
+            library_index.save()
 
-    known_music_formats = (".mp3", ".mp4", ".m4a", ".ogg", ".wav", ".flac", ".wma")
-    known_grapic_formats = (".jpg", ".jpeg", ".gif", ".bmp", ".png")
-
-    graphic_filepath = os.path.join(script_path, "munic.png")
-    library = { "display_name":None, "media":{}, "dirs":{}, "graphic_name":"munic.png", "graphic_filepath":graphic_filepath }
-    # TODO Don't put empty stuff in, create ditionary entries when needed
-    num_songs = 0
-    num_graphics = 0
-    unknown_extensions = []
-    for media_dir in media_dirs:
-        logging.info("Scanning media dir {}".format(media_dir))
-        for path, dirs, files in os.walk(media_dir, followlinks=True):
-            # Get files with music extensions, graphic extensions and unknown extensions
-            music_files = [file for file in files if file.lower().endswith(known_music_formats) ]
-            graphic_files = [file for file in files if file.lower().endswith(known_grapic_formats)]
-            unknown_files = [file for file in files if file not in music_files and file not in graphic_files]
-
-            if music_files or graphic_files:
-                # 'path' is the full path to the files, e.g. /media/NAS_MEDIA/music/Queen/A Day At The Races"
-                # Remove the root from the path to give the interesting part
-                sub_path = path[len(media_dir):].lstrip("/").rstrip("/")
-
-                # Ensure the dicts for this path exit in the library, and get the library dictionary into which the files should be added.
-                # Simplify the name, so that near-duplicates (Guns'n'Roses, Guns N Roses) are treated as the same.
-                parts = sub_path.split("/")
-                base_dict = library
-                for part in parts:
-                    if part:    # (Directory might be empty meaning the root -- don't create a new dict for it!)
-                        part_simplified = simplify(part)
-                        if not part_simplified in base_dict["dirs"]:
-                            base_dict["dirs"][part_simplified] = { "display_name":part, "media":{}, "dirs":{}, "graphic_name":None, "graphic_filepath":None }
-                        base_dict = base_dict["dirs"][part_simplified]
-
-                for music_file in music_files:
-                    # Get the song name from the filename by stripping the extension
-                    song_name = os.path.splitext(music_file)[0]
-                    simplified_songname = simplify(song_name)
-                    song_filepath = os.path.join(path, music_file)
-
-                    # Insert the item, keyed by song name, with the full path as value
-                    base_dict["media"][simplified_songname] = (song_name, song_filepath)
-
-                    num_songs += 1
-
-                largest_size = 0
-                for graphic_filename in graphic_files:
-                    graphic_filepath = os.path.join(path, graphic_filename)
-                    size = os.path.getsize(graphic_filepath)
-                    if size > largest_size:
-                        base_dict["graphic_name"] = graphic_filename
-                        base_dict["graphic_filepath"] = graphic_filepath
-                        num_graphics += 1
-                        largest_size = size
-
-            # Add the extensions of any unknown files to the unknown extensions list.
-            # This gives the user a clue that they have unknown media types.
-            for unknown_file in unknown_files:
-                unknown_extension = os.path.splitext(unknown_file)[1]
-                if unknown_extension not in unknown_extensions:
-                    unknown_extensions.append(unknown_extension)
-
-        logging.info("Loaded {} songs and {} graphics".format(num_songs, num_graphics))
-        logging.info("Unknown media types: {}".format(unknown_extensions))
-
-    return library
+    return library_index.build_library(media_dirs)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG, format='%(asctime)s %(thread)d %(levelname)s %(funcName)s %(message)s')
@@ -837,16 +3797,76 @@ if __name__ == '__main__':
     # All arguments are media dirs
     media_dirs = sys.argv[1:]
 
-    # Load the library of songs to serve
-    library = load_library(media_dirs)
+    # Load the page template
+    playlist_template = load_template("playlist.html")
+
+    # Create the cache of rendered pages
+    page_cache = PageCache(PAGE_CACHE_MAX_BYTES)
+
+    # Older versions of Python do not know the type of WebP files (thumbnails, and perhaps album art).  (Before any
+    # mime types are looked up, as they are cached.)
+    mimetypes.add_type("image/webp", ".webp")
+
+    # Load the static files, and compress them ready to send
+    static_files = load_static_files()
+
+    # Load the persistent library index, and from it the library of songs to serve.
+    # If an index was saved by a previous run, use it without rescanning so that we start up quickly.
+    library_index = LibraryIndex(os.path.join(script_path, "munic_library.idx"))
+    index_loaded = library_index.load()
+    library = load_library(media_dirs, rescan=not index_loaded)
+
+    # Create the background scanner
+    library_scanner = LibraryScanner(media_dirs, LIBRARY_RESCAN_INTERVAL)
+
+    # Watch the media dirs, if requested. (Before starting the scanner, which will then keep the watches up to date.)
+    if WATCH_MEDIA_DIRS:
+        try:
+            watcher = LibraryWatcher(library_scanner)
+        except (OSError, AttributeError) as e:
+            logging.warning("Cannot watch media dirs ({}); rescanning every {}s instead".format(e, WATCH_FALLBACK_RESCAN_INTERVAL))
+            if not library_scanner.interval:
+                library_scanner.interval = WATCH_FALLBACK_RESCAN_INTERVAL
+        else:
+            if watcher.start():
+                library_watcher = watcher
+
+    # Start the background scanner. If we started from a saved index, rescan straight away to pick up any changes.
+    library_scanner.start()
+    if index_loaded:
+        library_scanner.request_scan()
+
+    # SIGHUP requests a full rescan. (Just set the flag and the trigger: logging, or taking the scanner's lock, from a
+    # signal handler can deadlock.)
+    def sighup(signum, frame):
+        library_scanner.full_scan_requested = True
+        library_scanner.trigger.set()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, sighup)
 
     # Serve on all interfaces, port 4444
-    server = ThreadingSimpleServer(('0.0.0.0', 4444), Handler)
+    if ASYNC_SERVER:
+        ssl_context = None
+        if USE_HTTPS:
+            import ssl
+            ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            ssl_context.load_cert_chain(certfile='./cert.pem', keyfile='./key.pem')
+        server = AsyncServer(('0.0.0.0', 4444), Handler, ssl_context)
+    else:
+        server = ThreadingSimpleServer(('0.0.0.0', 4444), Handler)
 
     # Delete any old transcode outputs. We do this after setting up the server so that if an instance is already running, we do not delete its transcodes.
+    transcode_cache = TranscodeCache(TRANSCODE_CACHE_DIR or os.path.join(script_path, "transcode_cache"), TRANSCODE_CACHE_MAX_BYTES)
     Transcoder.CleanUp()
+    transcode_scheduler = TranscodeScheduler(MAX_SIMULTANEOUS_TRANSCODES)
+    transcode_scheduler.start()
+
+    # Set up the thumbnail cache
+    thumbnailer = Thumbnailer(TranscodeCache(THUMBNAIL_CACHE_DIR or os.path.join(script_path, "thumbnail_cache"), THUMBNAIL_CACHE_MAX_BYTES),
+                              THUMBNAIL_MAX_SIMULTANEOUS)
+    thumbnailer.cache.load()
 
-    if USE_HTTPS:
+    if USE_HTTPS and not ASYNC_SERVER:
         import ssl
         server.socket = ssl.wrap_socket(server.socket, keyfile='./key.pem', certfile='./cert.pem', server_side=True)
     logging.info("Serving on port 4444")
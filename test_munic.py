@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+# Tests for Munic's servers, run against a small library built in memory (the media files are never read).
+# Usage: python3 -m unittest test_munic
+
+import os
+import tempfile
+import threading
+import http.client
+import unittest
+
+import munic
+
+""" Build a library index of artists, each with albums of songs.  'artists' is a dict of artist name:list of album
+names.  Returns the LibraryIndex and the media dirs. """
+def make_index(artists, songs_per_album = 2):
+    media_dir = "/test"
+    index = munic.LibraryIndex(os.devnull)
+    index.dirs[media_dir] = { "mtime":0, "dirs":sorted(artists), "music":[], "graphics":[], "unknown":[] }
+    for artist, albums in artists.items():
+        artist_dir = os.path.join(media_dir, artist)
+        index.dirs[artist_dir] = { "mtime":0, "dirs":sorted(albums), "music":[], "graphics":[], "unknown":[] }
+        for album in albums:
+            songs = [ "{:02d} Song {}.mp3".format(song, song) for song in range(songs_per_album) ]
+            index.dirs[os.path.join(artist_dir, album)] = { "mtime":0, "dirs":[], "music":songs, "graphics":[], "unknown":[] }
+    return index, [media_dir]
+
+class AsyncServerTest(unittest.TestCase):
+    """ Requests to the AsyncServer """
+
+    def setUp(self):
+        munic.script_path = os.path.dirname(os.path.realpath(__file__))
+        index, media_dirs = make_index({ "Solo":["Only Album"], "Band":["First", "Second"] })
+        munic.library = index.build_library(media_dirs)
+        munic.page_cache = munic.PageCache(munic.PAGE_CACHE_MAX_BYTES)
+        self.server = munic.AsyncServer(("127.0.0.1", 0), munic.Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join(5)
+
+    def connect(self):
+        return http.client.HTTPConnection("127.0.0.1", self.server.server_address[1], timeout=10)
+
+    def test_single_subdir_redirect(self):
+        # A directory with no songs and one subdirectory redirects to it, and the connection can be used again
+        connection = self.connect()
+        for path, location in (("/solo/", "onlyalbum/"), ("/solo/*", "onlyalbum/*")):
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(response.status, 303)
+            self.assertEqual(response.getheader("Location"), location)
+        connection.close()
+
+    def test_not_found(self):
+        # A 404 has an (empty) body of known length, so the connection can be used again
+        connection = self.connect()
+        for path in ("/nobody/", "/solo/onlyalbum/nothing.mp3", "/solo/"):
+            connection.request("GET", path)
+            response = connection.getresponse()
+            response.read()
+            self.assertEqual(response.status, 303 if path == "/solo/" else 404)
+        connection.close()
+
+    def test_idle_connection_closed(self):
+        # A keep-alive connection with no request for KEEPALIVE_TIMEOUT is closed
+        keepalive_timeout = munic.KEEPALIVE_TIMEOUT
+        munic.KEEPALIVE_TIMEOUT = 0.2
+        try:
+            connection = self.connect()
+            connection.request("GET", "/solo/")
+            connection.getresponse().read()
+            connection.sock.settimeout(5)
+            self.assertEqual(connection.sock.recv(1), b"")
+            self.assertEqual(self.server.status()["connections"], 0)
+            connection.close()
+        finally:
+            munic.KEEPALIVE_TIMEOUT = keepalive_timeout
+
+class TranscodeCacheTest(unittest.TestCase):
+    """ The cache of transcoded files """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = munic.TranscodeCache(self.directory.name, 1000000)
+        self.cache.load()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def add(self, key, mtime):
+        partial_path = self.cache.partial_path(key, ".ogg")
+        with open(partial_path, "wb") as f:
+            f.write(b"x" * 100)
+        os.utime(partial_path, (mtime, mtime))
+        return self.cache.add(key, ".ogg", partial_path)
+
+    def test_get_keeps_mtime(self):
+        # Using a cached file does not change its mtime (which its ETag is made from), but is remembered over a restart
+        first = self.add("first", 1000)
+        second = self.add("second", 2000)
+        os.utime(first, (1000, 1000))
+        os.utime(second, (2000, 2000))
+        self.assertEqual(self.cache.get("first", ".ogg"), first)
+        self.assertEqual(os.stat(first).st_mtime, 1000)
+        reloaded = munic.TranscodeCache(self.directory.name, 1000000)
+        reloaded.load()
+        self.assertEqual(list(reloaded.files), [second, first])
+
+if __name__ == '__main__':
+    unittest.main()